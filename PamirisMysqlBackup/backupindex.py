@@ -0,0 +1,300 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# The backup index. Every backup adds an entry to `backup_index.json` in
+# full_path, so restore and fetch find the backups they need with a binary
+# search instead of listing directories with tens of thousands of files.
+#
+# The index is a list of chains sorted by time, a chain being a full backup
+# and the incrementals taken on top of it:
+#
+#   {"version": 1, "chains": [{"full": {...}, "incrementals": [{...}, ...]}]}
+#
+# An entry records the artifact file, when the backup was taken, its size,
+# codec, whether it is encrypted, the binary log coordinates it covers and
+# the size and sha256 of each of its files. The checksums of the files written
+# by a pipeline were taken as they were written, only the others are read.
+
+import os
+import re
+import json
+import fcntl
+import time
+import bisect
+from datetime import datetime
+
+from pipeline import file_digest, written_digest
+
+INDEX_NAME = 'backup_index.json'
+INDEX_VERSION = 1
+
+_NAME = re.compile(r'^(full|inc)_(\d{8})_(\d{4})')
+
+class BackupIndexError(Exception):
+    """raised when the index can not answer a lookup"""
+
+def artifact_files(path, checksums=True):
+    """the files of the artifact `path` with their size and sha256
+
+    paths are relative to the directory holding the artifact, a chunked
+    backup directory lists every file in it. the metadata file and the block
+    index of a seekable backup written next to the artifact are listed as well.
+    """
+    parent = os.path.dirname(path.rstrip('/'))
+    if os.path.isdir(path):
+        paths = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            paths.extend([os.path.join(root, name) for name in sorted(files)])
+    else:
+        paths = [path]
+    for suffix in ('.idx', '.meta'):
+        if os.path.exists(path.rstrip('/') + suffix):
+            paths.append(path.rstrip('/') + suffix)
+
+    files = []
+    for f in paths:
+        files.append({
+            'path': os.path.relpath(f, parent),
+            'size': os.path.getsize(f),
+            'sha256': checksums and (written_digest(f) or file_digest(f)) or None,
+        })
+    return files
+
+def make_entry(kind, artifact, when, metadata, binlog=None, checksums=True):
+    """the index entry for the backup `artifact` taken at the datetime `when`"""
+    metadata = metadata or {}
+    files = artifact_files(artifact, checksums)
+    entry = {
+        'kind': kind,
+        'file': os.path.basename(artifact.rstrip('/')),
+        'time': when.strftime('%Y%m%d_%H%M'),
+        'timestamp': int(time.mktime(when.timetuple())),
+        'size': sum([f['size'] for f in files]),
+        'files': files,
+        'codec': metadata.get('codec'),
+        'level': metadata.get('level'),
+        'encrypted': bool(metadata.get('encrypted')),
+        'binlog': binlog,
+    }
+    if metadata.get('compaction'):
+        # what compaction.py folded away
+        entry['compaction'] = metadata['compaction']
+    if metadata.get('synthetic'):
+        # the backups a synthetic full backup was consolidated from
+        entry['synthetic'] = metadata['synthetic']
+    return entry
+
+class BackupIndex(object):
+    """the index of the backups in a full_path
+
+    chains are kept sorted by the time of their full backup and incrementals
+    by their own, lookups are binary searches over the sorted times and binary
+    log coordinates, which are kept up to date by add_full and
+    add_incremental and rebuilt when `chains` is replaced.
+    """
+
+    def __init__(self, path, data=None):
+        self.path = path
+        self._chains = []
+        self._reset()
+        self.exists = False
+        self.lock_file = None
+        self._load(data)
+
+    def _load(self, data):
+        """read the index from `path`, or from `data` when it was read elsewhere"""
+        if data is None:
+            try:
+                f = open(self.path)
+            except IOError:
+                return
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        data = json.loads(data)
+        if data.get('version', 1) > INDEX_VERSION:
+            raise BackupIndexError('%s was written by a newer version (%s)' % (self.path, data['version']))
+        self.chains = data.get('chains', [])
+        self.exists = True
+
+    def _reset(self):
+        self._starts_cache = None
+        self._binlog_chains = None
+        # by id() of the chain: its incrementals list and their keys
+        self._incremental_keys = {}
+
+    def _get_chains(self):
+        return self._chains
+
+    def _set_chains(self, chains):
+        self._chains = chains
+        self._reset()
+
+    chains = property(_get_chains, _set_chains)
+
+    def lock(self):
+        """take the index for an update and read it again
+
+        backups taken at the same time (a full backup while the binary log
+        stream writes its segments) would otherwise lose each other's entries.
+        """
+        self.lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self._load(None)
+
+    def unlock(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def save(self):
+        """atomically write the index"""
+        data = {'version': INDEX_VERSION, 'chains': self.chains}
+        f = open(self.path + '.partial', 'w')
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(self.path + '.partial', self.path)
+        self.exists = True
+
+    def _starts(self):
+        if self._starts_cache is None:
+            self._starts_cache = [c['full']['timestamp'] for c in self.chains]
+        return self._starts_cache
+
+    def _binlog_starts(self):
+        """(binary log coordinates of the full backups that have one, their chains)"""
+        if self._binlog_chains is None:
+            chains = [c for c in self.chains if c['full'].get('binlog')]
+            self._binlog_chains = ([_entry_coordinate(c['full']) for c in chains], chains)
+        return self._binlog_chains
+
+    def _incrementals(self, chain):
+        """(times of the incrementals of `chain`, binary log coordinates of those that have one, those incrementals)"""
+        incs = chain['incrementals']
+        keys = self._incremental_keys.get(id(chain))
+        # prune replaces the incrementals of the chains it trims, the keys
+        # hold on to the list they were made from
+        if keys is None or keys[0] is not incs:
+            with_binlog = [e for e in incs if e.get('binlog')]
+            keys = (incs, [e['timestamp'] for e in incs],
+                    [_entry_coordinate(e) for e in with_binlog], with_binlog)
+            self._incremental_keys[id(chain)] = keys
+        return keys[1:]
+
+    def add_full(self, entry):
+        """start a new chain with the full backup `entry`"""
+        chain = {'full': entry, 'incrementals': []}
+        i = bisect.bisect_right(self._starts(), entry['timestamp'])
+        self.chains.insert(i, chain)
+        self._starts_cache.insert(i, entry['timestamp'])
+        if entry.get('binlog'):
+            coordinates, chains = self._binlog_starts()
+            j = bisect.bisect_right(coordinates, _entry_coordinate(entry))
+            coordinates.insert(j, _entry_coordinate(entry))
+            chains.insert(j, chain)
+
+    def add_incremental(self, entry):
+        """add the incremental `entry` to the chain it was taken on
+
+        a segment of the binary log stream, which records where in the log it
+        starts, belongs to the last full backup taken before that position
+        even when it was written after a newer one.
+        """
+        chain = self.chain_at(entry['timestamp'])
+        binlog = entry.get('binlog') or {}
+        if 'start' in binlog:
+            coordinates, chains = self._binlog_starts()
+            i = bisect.bisect_right(coordinates, _coordinate(binlog['file'], binlog['start']))
+            if i > 0:
+                chain = chains[i - 1]
+        if chain is None:
+            raise BackupIndexError('no full backup before %s for incremental %s' % (entry['time'], entry['file']))
+        times, coordinates, with_binlog = self._incrementals(chain)
+        i = bisect.bisect_right(times, entry['timestamp'])
+        chain['incrementals'].insert(i, entry)
+        times.insert(i, entry['timestamp'])
+        if binlog:
+            j = bisect.bisect_right(coordinates, _entry_coordinate(entry))
+            coordinates.insert(j, _entry_coordinate(entry))
+            with_binlog.insert(j, entry)
+
+    def chain_at(self, timestamp):
+        """the chain whose full backup is the latest one taken at or before `timestamp`"""
+        i = bisect.bisect_right(self._starts(), timestamp)
+        if i == 0:
+            return None
+        return self.chains[i - 1]
+
+    def latest_full(self):
+        if not self.chains:
+            return None
+        return self.chains[-1]['full']
+
+    def resolve(self, timestamp):
+        """the full backup and the incrementals, in order, to restore the state at `timestamp`"""
+        chain = self.chain_at(timestamp)
+        if chain is None:
+            raise BackupIndexError('there is no full backup taken before %s' %
+                    (datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')))
+        i = bisect.bisect_right(self._incrementals(chain)[0], timestamp)
+        return chain['full'], chain['incrementals'][:i]
+
+    def resolve_until(self, timestamp=None, coordinate=None):
+        """the full backup and the incrementals holding the events up to a stop point
+
+        the stop point is a unix time or a binary log coordinate (log name,
+        position). unlike resolve() this includes the first incremental
+        taken after the stop point, the events between the previous backup
+        and the stop point are in it. incrementals further on are left out.
+        """
+        if coordinate is None:
+            chain = self.chain_at(timestamp)
+            if chain is None:
+                raise BackupIndexError('there is no full backup taken before %s' %
+                        (datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')))
+            i = bisect.bisect_right(self._incrementals(chain)[0], timestamp)
+            return chain['full'], chain['incrementals'][:i + 1]
+
+        stop = _coordinate(coordinate[0], coordinate[1])
+        coordinates, chains = self._binlog_starts()
+        i = bisect.bisect_right(coordinates, stop)
+        if i == 0:
+            raise BackupIndexError('there is no full backup taken before %s:%d' % coordinate)
+        chain = chains[i - 1]
+        times, coordinates, incs = self._incrementals(chain)
+        i = bisect.bisect_left(coordinates, stop)
+        return chain['full'], incs[:i + 1]
+
+def _coordinate(name, position):
+    return (int(name.rsplit('.', 1)[1]), position)
+
+def _entry_coordinate(entry):
+    return _coordinate(entry['binlog']['file'], entry['binlog']['position'])
+
+def rebuild(index, full_path, inc_path, prefix, read_metadata):
+    """fill `index` from the file names of the backups taken before there was one
+
+    this lists the directories once, after that the index is kept up to date
+    by every backup. `read_metadata` returns the metadata of an artifact.
+    the files are not read, so these entries have no checksums.
+    """
+    entries = []
+    for kind, path in (('full', full_path), ('inc', inc_path or full_path)):
+        for name in os.listdir(path):
+            if not name.startswith(prefix) or name.endswith(('.meta', '.idx', '.partial')):
+                continue
+            m = _NAME.match(name[len(prefix):])
+            if m is None or m.group(1) != kind:
+                continue
+            when = datetime.strptime(m.group(2) + m.group(3), '%Y%m%d%H%M')
+            artifact = os.path.join(path, name)
+            entries.append(make_entry(kind, artifact, when, read_metadata(artifact), checksums=False))
+
+    # fulls first so every incremental finds its chain
+    entries.sort(key=lambda e: (e['kind'] != 'full', e['timestamp']))
+    for entry in entries:
+        if entry['kind'] == 'full':
+            index.add_full(entry)
+        elif index.chain_at(entry['timestamp']) is not None:
+            index.add_incremental(entry)
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Benchmarks. Runs a full backup, an incremental, a restore, a fetch and a
+# verify of a synthetic dataset end to end, with the stand-ins in bin/ taking the place of
+# mysqldump, mysql and mysqlbinlog, so no MySQL server is needed. Everything
+# is written under a work directory, fetch copies from it with the local
+# transport.
+#
+# Every action is run `runs` times from scratch and reported with the median of
+# its wall and cpu time, the bytes it handled and their throughput, the peak
+# resident memory of pmb.py and the commands it ran, and the peak disk space
+# of the directories it writes to. The results are saved as json, to compare
+# the next version with:
+#
+#   $ python benchmark/bench.py --rows=200000 --output=before.json
+#   $ python benchmark/bench.py --rows=200000 --compare=before.json
+#
+# The bytes of an action are the sql dumped by a full backup, the binary logs
+# read by an incremental, the sql loaded by a restore, the sql written by a
+# fetch and the backups read by verify. --config= names a config file whose options are laid over the
+# benchmark's own, to measure other settings ([Compression], [Parallel]...).
+
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import tempfile
+import socket
+import StringIO
+import threading
+import subprocess
+import ConfigParser
+
+import dataset
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PMB = os.path.join(os.path.dirname(HERE), 'pmb.py')
+
+ACTIONS = ('full', 'incremental', 'restore', 'fetch', 'verify')
+
+USAGE = """usage: bench.py [options]
+
+  --databases=N   databases in the dataset (1)
+  --tables=N      tables per database (4)
+  --rows=N        rows per table (10000)
+  --width=N       bytes of payload per row (200)
+  --binlogs=N     binary logs the incremental reads (2)
+  --events=N      transactions per binary log (1000)
+  --hot=N         row based binary logs updating N hot rows per table (0, statements)
+  --runs=N        times every action is run, the median is reported (3)
+  --actions=A,B   actions to report, of full,incremental,restore,fetch,verify (all)
+  --config=FILE   options laid over the benchmark's config.cfg
+  --work=DIR      work directory (a temporary one)
+  --output=FILE   save the results as json
+  --compare=FILE  compare with results saved by an earlier run
+"""
+
+CONFIG = """[Main]
+tmp = %(work)s/tmp/
+
+[Backup]
+full_path = %(work)s/full/
+inc_path = %(work)s/inc/
+bin_log_path = %(work)s/binlogs/
+bin_log_name = mysql-bin
+file_prefix = bench_
+username = bench
+password = bench
+database = bench0
+db_host = localhost
+streaming = true
+
+[Encryption]
+enabled = false
+key_name =
+passphrase_file =
+
+[Logging]
+log_path = %(work)s/pmb.log
+
+[Metrics]
+report_path = %(work)s/reports/
+
+[Fetch]
+connection_string = localhost
+transport = local
+remote_full_path = %(work)s/full/
+remote_inc_path = %(work)s/inc/
+local_save_path = %(work)s/fetched/
+"""
+
+# the directories each action writes to
+_DIRECTORIES = {
+    'full': ('full',),
+    'incremental': ('inc',),
+    'restore': ('tmp',),
+    'fetch': ('tmp', 'fetched'),
+    'verify': (),
+}
+
+class BenchError(Exception):
+    """raised when a benchmarked action fails"""
+
+def disk_usage(paths):
+    """bytes of the files under `paths`"""
+    total = 0
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    # removed while we looked
+                    pass
+    return total
+
+class _DiskSampler(threading.Thread):
+    """the most disk space `paths` took up while an action ran"""
+
+    def __init__(self, paths, interval=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.paths = paths
+        self.interval = interval
+        self.peak = disk_usage(paths)
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            self.peak = max(self.peak, disk_usage(self.paths))
+            self.done.wait(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.peak = max(self.peak, disk_usage(self.paths))
+        return self.peak
+
+class _Counter(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def close(self):
+        pass
+
+def dump_size(spec):
+    """bytes of sql in a dump of every database of the dataset"""
+    counter = _Counter()
+    dataset.Rows(spec).dump(counter, spec['databases'])
+    return counter.size
+
+class Bench(object):
+    """runs the actions in the work directory `work`"""
+
+    def __init__(self, work, params, overrides=None):
+        self.work = work
+        self.params = params
+        self.overrides = overrides
+        self.spec = None
+        self.config = os.path.join(work, 'config.cfg')
+
+    def setup(self):
+        if os.path.exists(self.work):
+            shutil.rmtree(self.work)
+        for name in ('full', 'inc', 'tmp', 'fetched', 'reports', 'binlogs'):
+            os.makedirs(os.path.join(self.work, name))
+
+        self.spec = dataset.new(os.path.join(self.work, 'dataset.json'), self.work, **self.params)
+        dataset.rotate(self.spec)
+
+        config = ConfigParser.RawConfigParser()
+        config.readfp(StringIO.StringIO(CONFIG % {'work': self.work}))
+        if self.overrides is not None:
+            extra = ConfigParser.RawConfigParser()
+            if not extra.read(self.overrides):
+                raise BenchError('could not read %s' % (self.overrides))
+            for section in extra.sections():
+                if not config.has_section(section):
+                    config.add_section(section)
+                for option, value in extra.items(section):
+                    config.set(section, option, value)
+        f = open(self.config, 'w')
+        config.write(f)
+        f.close()
+
+    def pmb(self, action, args, directories, stdin=None):
+        """run pmb.py `action`, returns what it took"""
+        env = dict(os.environ)
+        env['PATH'] = os.path.join(HERE, 'bin') + os.pathsep + env.get('PATH', '')
+        env[dataset.ENVIRONMENT] = os.path.join(self.work, 'dataset.json')
+
+        output = open(os.path.join(self.work, 'pmb.out'), 'a')
+        sampler = _DiskSampler([os.path.join(self.work, d) for d in directories])
+        sampler.start()
+        started = time.time()
+        try:
+            process = subprocess.Popen([sys.executable, PMB, '--config=%s' % (self.config),
+                    action, '--quiet'] + args,
+                    stdin=subprocess.PIPE,
+                    stdout=output,
+                    stderr=output,
+                    env=env,
+                    close_fds=True)
+            process.stdin.write(stdin or '')
+            process.stdin.close()
+            # wait4 for the resources of pmb.py and everything it waited for
+            pid, status, usage = os.wait4(process.pid, 0)
+        finally:
+            wall = time.time() - started
+            disk = sampler.stop()
+            output.close()
+
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+            raise BenchError('pmb.py %s failed, see %s' % (action, os.path.join(self.work, 'pmb.out')))
+        return {
+            'wall': wall,
+            'cpu': usage.ru_utime + usage.ru_stime,
+            'max_rss': usage.ru_maxrss,
+            'disk': disk,
+            'stages': self._stages(action),
+        }
+
+    def _stages(self, action):
+        """the stages of the run report pmb.py wrote for `action`"""
+        reports = sorted([n for n in os.listdir(os.path.join(self.work, 'reports'))
+                if n.startswith('pmb_%s_' % (action)) and n.endswith('.json')])
+        if not reports:
+            return []
+        f = open(os.path.join(self.work, 'reports', reports[-1]))
+        try:
+            return json.load(f)['stages']
+        finally:
+            f.close()
+
+    def run(self, actions, sql_bytes):
+        """run the actions once from scratch, returns the figures of each"""
+        self.setup()
+        results = {}
+
+        results['full'] = self.pmb('backup', ['--full', '--all-databases'], _DIRECTORIES['full'])
+        results['full']['bytes'] = sql_bytes
+
+        if 'incremental' in actions:
+            logs = []
+            for n in range(self.spec['binlogs']):
+                if n:
+                    dataset.rotate(self.spec)
+                dataset.write_transactions(self.spec, self.spec['events'])
+                logs.append(dataset.binlogs(self.spec)[-1])
+            binlog_bytes = sum([os.path.getsize(l) for l in logs])
+            results['incremental'] = self.pmb('backup', ['--incremental', '--all-databases'],
+                    _DIRECTORIES['incremental'])
+            results['incremental']['bytes'] = binlog_bytes
+
+        # the backups were all taken during the last minute
+        now = time.localtime()
+        moment = ['--date=%s' % (time.strftime('%Y%m%d', now)), '--time=%s' % (time.strftime('%H%M', now))]
+
+        if 'restore' in actions:
+            loaded = os.path.join(self.work, 'mysql.loaded')
+            if os.path.exists(loaded):
+                os.remove(loaded)
+            results['restore'] = self.pmb('restore', moment + ['--all-databases'],
+                    _DIRECTORIES['restore'], stdin='yes\n')
+            f = open(loaded)
+            results['restore']['bytes'] = sum([int(line) for line in f if line.strip()])
+            f.close()
+
+        if 'fetch' in actions:
+            results['fetch'] = self.pmb('fetch', moment, _DIRECTORIES['fetch'])
+            results['fetch']['bytes'] = disk_usage([os.path.join(self.work, 'fetched')])
+
+        if 'verify' in actions:
+            results['verify'] = self.pmb('verify', [], _DIRECTORIES['verify'])
+            results['verify']['bytes'] = disk_usage([os.path.join(self.work, d) for d in ('full', 'inc')])
+
+        return dict([(a, results[a]) for a in actions])
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def summarize(runs):
+    """the median of every figure of every action over `runs`"""
+    summary = {}
+    for action in runs[0]:
+        figures = [r[action] for r in runs]
+        entry = dict([(key, _median([f[key] for f in figures]))
+                for key in ('wall', 'cpu', 'bytes', 'max_rss', 'disk')])
+        entry['throughput'] = entry['wall'] > 0 and entry['bytes'] / entry['wall'] or None
+        entry['walls'] = [f['wall'] for f in figures]
+        # the stages of the run closest to the median
+        entry['stages'] = min(figures, key=lambda f: abs(f['wall'] - entry['wall']))['stages']
+        summary[action] = entry
+    return summary
+
+def version():
+    """the commit of the tree being benchmarked"""
+    try:
+        process = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+                cwd=HERE, stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        out = process.communicate()[0].strip()
+    except OSError:
+        return None
+    if process.returncode != 0:
+        return None
+    return out
+
+def _mb(value):
+    return value / 1048576.0
+
+def table(results):
+    lines = ['%-12s %9s %9s %10s %9s %13s %14s' %
+            ('action', 'wall s', 'cpu s', 'MB', 'MB/s', 'peak rss MB', 'peak disk MB')]
+    for action in ACTIONS:
+        r = results['actions'].get(action)
+        if r is None:
+            continue
+        lines.append('%-12s %9.2f %9.2f %10.1f %9.1f %13.1f %14.1f' % (
+                action, r['wall'], r['cpu'], _mb(r['bytes']), _mb(r['throughput'] or 0),
+                r['max_rss'] / 1024.0, _mb(r['disk'])))
+    return lines
+
+def compare(results, earlier):
+    """lines comparing `results` with the `earlier` ones, changes in percent"""
+    lines = ['compared with %s (%s)' % (earlier.get('version'), earlier.get('date'))]
+    if earlier.get('dataset') != results['dataset'] or earlier.get('settings') != results['settings']:
+        lines.append('WARNING: the dataset or settings differ, the figures are not comparable')
+    lines.append('%-12s %9s %9s %13s %14s' % ('action', 'wall', 'MB/s', 'peak rss', 'peak disk'))
+
+    def change(new, old):
+        if not old:
+            return '-'
+        return '%+.1f%%' % ((new - old) * 100.0 / old)
+
+    for action in ACTIONS:
+        new = results['actions'].get(action)
+        old = earlier.get('actions', {}).get(action)
+        if new is None or old is None:
+            continue
+        lines.append('%-12s %9s %9s %13s %14s' % (action,
+                change(new['wall'], old['wall']),
+                change(new['throughput'] or 0, old['throughput'] or 0),
+                change(new['max_rss'], old['max_rss']),
+                change(new['disk'], old['disk'])))
+    return lines
+
+def main():
+    try:
+        options, args = getopt.gnu_getopt(sys.argv[1:], 'h',
+                ['databases=', 'tables=', 'rows=', 'width=', 'binlogs=', 'events=', 'hot=',
+                 'runs=', 'actions=', 'config=', 'work=', 'output=', 'compare=', 'help'])
+    except getopt.GetoptError, e:
+        sys.stderr.write('%s\n%s' % (e, USAGE))
+        sys.exit(2)
+
+    params = {'databases': 1, 'tables': 4, 'rows': 10000, 'width': 200, 'binlogs': 2, 'events': 1000, 'hot': 0}
+    runs = 3
+    actions = list(ACTIONS)
+    overrides = work = output = earlier = None
+    for o, a in options:
+        if o in ('-h', '--help'):
+            sys.stdout.write(USAGE)
+            return
+        elif o[2:] in params:
+            params[o[2:]] = int(a)
+        elif o == '--runs':
+            runs = max(1, int(a))
+        elif o == '--actions':
+            actions = [x.strip() for x in a.split(',') if x.strip()]
+            for action in actions:
+                if action not in ACTIONS:
+                    sys.stderr.write('unknown action %s\n%s' % (action, USAGE))
+                    sys.exit(2)
+        elif o == '--config':
+            overrides = os.path.abspath(a)
+        elif o == '--work':
+            work = os.path.abspath(a)
+        elif o == '--output':
+            output = a
+        elif o == '--compare':
+            f = open(a)
+            earlier = json.load(f)
+            f.close()
+
+    temporary = work is None
+    if temporary:
+        # kept when an action fails, for its output
+        work = tempfile.mkdtemp(prefix='pmb-bench-')
+
+    settings = None
+    if overrides is not None:
+        f = open(overrides)
+        settings = f.read()
+        f.close()
+
+    bench = Bench(os.path.join(work, 'run'), params, overrides)
+    try:
+        sql_bytes = None
+        results = []
+        for n in range(runs):
+            if sql_bytes is None:
+                bench.setup()
+                sql_bytes = dump_size(bench.spec)
+            sys.stderr.write('run %d of %d...\n' % (n + 1, runs))
+            results.append(bench.run(actions, sql_bytes))
+    except BenchError, e:
+        sys.stderr.write('%s\n' % (e))
+        sys.exit(1)
+    if temporary:
+        shutil.rmtree(work, ignore_errors=True)
+
+    summary = {
+        'version': version(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'python': sys.version.split()[0],
+        'dataset': params,
+        'settings': settings,
+        'runs': runs,
+        'actions': summarize(results),
+    }
+    for line in table(summary):
+        print line
+    if earlier is not None:
+        print
+        for line in compare(summary, earlier):
+            print line
+    if output is not None:
+        f = open(output, 'w')
+        json.dump(summary, f, indent=1, sort_keys=True)
+        f.write('\n')
+        f.close()
+
+if __name__ == '__main__':
+    main()
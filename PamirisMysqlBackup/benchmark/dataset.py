@@ -0,0 +1,267 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Synthetic datasets for the benchmarks. A dataset is a small json file saying
+# how many databases, tables, rows and binary logs there are and how wide the
+# rows are. The stand-ins for mysqldump, mysql and mysqlbinlog in bin/ generate
+# the rows from it as they go, so nothing big is kept around and every run of
+# the same dataset dumps the same bytes.
+#
+# Rows are an id, a short name and a payload cut out of a pool of words, which
+# compresses about like real text columns do. The binary logs are real v4 logs
+# (see binlog.py): every transaction is a BEGIN, an INSERT or UPDATE and an
+# XID event, the way InnoDB writes them. With `hot` rows the logs are row
+# based: the INSERT is a table map and a write rows event, and the UPDATEs
+# change the payload of the first `hot` rows of every table over and over.
+
+import os
+import sys
+import json
+import time
+import glob
+import random
+import struct
+
+ENVIRONMENT = 'PMB_BENCH_DATASET'
+
+ROWS_PER_INSERT = 500
+
+_WORDS = ('order customer shipped pending invoice total street city country '
+        'payment refund item quantity price discount note status express '
+        'warehouse delivered cancelled account email phone comment review').split()
+
+_EVENT_HEADER = struct.Struct('<IBIIIH')
+QUERY_EVENT = 2
+ROTATE_EVENT = 4
+FORMAT_DESCRIPTION_EVENT = 15
+XID_EVENT = 16
+TABLE_MAP_EVENT = 19
+WRITE_ROWS_EVENT = 30
+UPDATE_ROWS_EVENT = 31
+STMT_END_F = 1
+
+# the post header lengths of the event types of a 5.7 format description
+_POST_HEADER_LENGTHS = ('\x38\x0d\x00\x08\x00\x12\x00\x04\x04\x04\x04\x12\x00\x00\x5f\x00\x04'
+        '\x1a\x08\x00\x00\x00\x08\x08\x08\x02\x00\x00\x00\x0a\x0a\x0a\x2a\x2a\x00\x12\x34\x00')
+
+def new(path, directory, databases=1, tables=4, rows=10000, width=200,
+        binlogs=2, events=1000, hot=0, seed=1):
+    """write the description of a dataset to `path`, its binary logs go to `directory`/binlogs"""
+    spec = {
+        'directory': os.path.abspath(directory),
+        'databases': ['bench%d' % (d) for d in range(databases)],
+        'tables': ['table%02d' % (t) for t in range(tables)],
+        'rows': rows,
+        'width': width,
+        'binlogs': binlogs,
+        'events': events,
+        'hot': hot,
+        'seed': seed,
+    }
+    f = open(path, 'w')
+    json.dump(spec, f, indent=1)
+    f.close()
+    return spec
+
+def load(path=None):
+    """the dataset at `path`, or the one the environment names"""
+    f = open(path or os.environ[ENVIRONMENT])
+    try:
+        spec = json.load(f)
+    finally:
+        f.close()
+    # names go into binary logs, they must be byte strings
+    for key in ('directory', 'databases', 'tables'):
+        if isinstance(spec[key], list):
+            spec[key] = [str(name) for name in spec[key]]
+        else:
+            spec[key] = str(spec[key])
+    return spec
+
+class Rows(object):
+    """the rows of the tables of a dataset"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        rng = random.Random(spec['seed'])
+        words = []
+        length = 0
+        while length < 65536 + spec['width']:
+            word = rng.choice(_WORDS)
+            if rng.random() < 0.2:
+                word = '%s%d' % (word, rng.randint(0, 99999))
+            words.append(word)
+            length += len(word) + 1
+        self.pool = ' '.join(words)
+
+    def payload(self, i):
+        offset = (i * 2654435761) % (len(self.pool) - self.spec['width'])
+        return self.pool[offset:offset + self.spec['width']]
+
+    def version(self, i, version):
+        """the payload of row `i` after its `version`th update"""
+        if version == 0:
+            return self.payload(i)
+        return self.payload(self.spec['rows'] + version * 1000003 + i)
+
+    def image(self, table, i, version=0):
+        """the row image of row `i` in a row event: id int, name varchar(64), payload text"""
+        name = '%s-%d' % (table, i)
+        payload = self.version(i, version)
+        return '\0' + struct.pack('<i', i) + chr(len(name)) + name + struct.pack('<H', len(payload)) + payload
+
+    def values(self, table, i):
+        """the sql of row `i` of `table`"""
+        return "(%d,'%s-%d','%s')" % (i, table, i, self.payload(i))
+
+    def dump(self, out, databases, no_data=False):
+        """write the tables of `databases` like mysqldump does"""
+        out.write('-- MySQL dump 10.13  Distrib 5.7 (pmb benchmark stand-in)\n')
+        out.write("\n/*!40103 SET @OLD_TIME_ZONE=@@TIME_ZONE */;\n/*!40103 SET TIME_ZONE='+00:00' */;\n")
+        for database in databases:
+            out.write('\n--\n-- Current Database: `%s`\n--\n' % (database))
+            out.write('\nCREATE DATABASE /*!32312 IF NOT EXISTS*/ `%s`;\n\nUSE `%s`;\n' % (database, database))
+            for table in self.spec['tables']:
+                out.write('\n--\n-- Table structure for table `%s`\n--\n\n' % (table))
+                out.write('DROP TABLE IF EXISTS `%s`;\n' % (table))
+                out.write('CREATE TABLE `%s` (\n  `id` int(11) NOT NULL,\n  `name` varchar(64) DEFAULT NULL,\n'
+                        '  `payload` text,\n  PRIMARY KEY (`id`)\n) ENGINE=InnoDB DEFAULT CHARSET=utf8;\n' % (table))
+                if no_data:
+                    continue
+                out.write('\n--\n-- Dumping data for table `%s`\n--\n\nLOCK TABLES `%s` WRITE;\n' % (table, table))
+                for start in range(1, self.spec['rows'] + 1, ROWS_PER_INSERT):
+                    end = min(start + ROWS_PER_INSERT, self.spec['rows'] + 1)
+                    out.write('INSERT INTO `%s` VALUES %s;\n' %
+                            (table, ','.join([self.values(table, i) for i in xrange(start, end)])))
+                out.write('UNLOCK TABLES;\n')
+        out.write('/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;\n\n-- Dump completed\n')
+
+def binlog_directory(spec):
+    return os.path.join(spec['directory'], 'binlogs')
+
+def binlogs(spec):
+    """the paths of the binary logs, oldest first"""
+    return sorted(glob.glob(os.path.join(binlog_directory(spec), 'mysql-bin.[0-9]*')))
+
+def _event(timestamp, type_code, body, position):
+    length = _EVENT_HEADER.size + len(body)
+    return _EVENT_HEADER.pack(timestamp, type_code, 1, length, position + length, 0) + body
+
+def _query(database, sql):
+    # thread id, execution time, database length, error code, status variables length
+    return struct.pack('<IIBHH', 1, 0, len(database), 0, 0) + database + '\0' + sql
+
+def rotate(spec, timestamp=None):
+    """close the current binary log with a rotate event and start the next one, like FLUSH LOGS"""
+    timestamp = timestamp or int(time.time())
+    if not os.path.isdir(binlog_directory(spec)):
+        os.makedirs(binlog_directory(spec))
+    logs = binlogs(spec)
+    sequence = 1
+    if logs:
+        sequence = int(logs[-1].rsplit('.', 1)[1]) + 1
+    name = 'mysql-bin.%06d' % (sequence)
+
+    if logs:
+        f = open(logs[-1], 'ab')
+        f.write(_event(timestamp, ROTATE_EVENT, struct.pack('<Q', 4) + name, f.tell()))
+        f.close()
+
+    # checksums are off: the algorithm is 0, the checksum of the event 0 too
+    data = '\xfebin'
+    data += _event(timestamp, FORMAT_DESCRIPTION_EVENT,
+            struct.pack('<H', 4) + '5.7.0-pmb-bench'.ljust(50, '\0') + struct.pack('<IB', timestamp, 19) +
+            _POST_HEADER_LENGTHS + '\0' + struct.pack('<I', 0),
+            len(data))
+    f = open(os.path.join(binlog_directory(spec), name), 'wb')
+    f.write(data)
+    f.close()
+    return name
+
+def _table_map(spec, database, table):
+    table_id = 100 + spec['databases'].index(database) * len(spec['tables']) + spec['tables'].index(table)
+    # id int, name varchar(64) utf8, payload text: their types, metadata and nullable columns
+    return (struct.pack('<Q', table_id)[:6] + struct.pack('<H', 1) +
+            chr(len(database)) + database + '\0' + chr(len(table)) + table + '\0' +
+            '\x03\x03\x0f\xfc' + '\x03' + struct.pack('<H', 192) + '\x02' + '\x06'), table_id
+
+def _rows(table_id, images, update=False):
+    bitmap = '\x07'
+    if update:
+        bitmap += '\x07'
+    return struct.pack('<Q', table_id)[:6] + struct.pack('<HH', STMT_END_F, 2) + '\x03' + bitmap + images
+
+def _row_updates(spec, count):
+    """the number of hot row updates written before, and now `count` more"""
+    path = os.path.join(binlog_directory(spec), 'row_updates')
+    done = 0
+    if os.path.exists(path):
+        f = open(path)
+        done = int(f.read())
+        f.close()
+    f = open(path, 'w')
+    f.write('%d' % (done + count))
+    f.close()
+    return done
+
+def write_transactions(spec, count, timestamp=None):
+    """append `count` transactions to the current binary log"""
+    timestamp = timestamp or int(time.time())
+    rows = Rows(spec)
+    logs = binlogs(spec)
+    hot = spec.get('hot', 0)
+    if hot:
+        update = _row_updates(spec, count / 2)
+        rows_per_cycle = len(spec['databases']) * len(spec['tables']) * hot
+    f = open(logs[-1], 'ab')
+    try:
+        position = f.tell()
+        for n in xrange(count):
+            database = spec['databases'][n % len(spec['databases'])]
+            table = spec['tables'][n % len(spec['tables'])]
+            i = spec['rows'] + n + 1
+            data = _event(timestamp, QUERY_EVENT, _query(database, 'BEGIN'), position)
+            if hot:
+                if n % 2:
+                    # the hot rows of every table take turns
+                    cycle, row = divmod(update, rows_per_cycle)
+                    database = spec['databases'][row % len(spec['databases'])]
+                    table = spec['tables'][row / len(spec['databases']) % len(spec['tables'])]
+                    i = row / len(spec['databases']) / len(spec['tables']) + 1
+                    images = rows.image(table, i, cycle) + rows.image(table, i, cycle + 1)
+                    update += 1
+                else:
+                    images = rows.image(table, i)
+                table_map, table_id = _table_map(spec, database, table)
+                data += _event(timestamp, TABLE_MAP_EVENT, table_map, position + len(data))
+                data += _event(timestamp, n % 2 and UPDATE_ROWS_EVENT or WRITE_ROWS_EVENT,
+                        _rows(table_id, images, n % 2), position + len(data))
+            else:
+                if n % 2:
+                    sql = "UPDATE `%s` SET `payload`='%s' WHERE `id`=%d" % (table, rows.payload(i), n + 1)
+                else:
+                    sql = 'INSERT INTO `%s` VALUES %s' % (table, rows.values(table, i))
+                data += _event(timestamp, QUERY_EVENT, _query(database, sql), position + len(data))
+            data += _event(timestamp, XID_EVENT, struct.pack('<Q', n + 1), position + len(data))
+            f.write(data)
+            position += len(data)
+    finally:
+        f.close()
+
+def read_events(path):
+    """yields (position, header, body) of the events of the binary log `path`, - for stdin"""
+    if path == '-':
+        data = sys.stdin.read()
+    else:
+        f = open(path, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    position = 4
+    while position + _EVENT_HEADER.size <= len(data):
+        header = _EVENT_HEADER.unpack(data[position:position + _EVENT_HEADER.size])
+        length = header[3]
+        if position + length > len(data):
+            break
+        yield position, header, data[position + _EVENT_HEADER.size:position + length]
+        position += length
@@ -0,0 +1,395 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Binary log catalog. The catalog is a small json file that remembers every binary log with its
+# size, end position, the time of its first and last event and a checksum. It
+# is brought up to date from a directory scan or SHOW BINARY LOGS, only reading
+# the event headers that were added since the last time, and it remembers how
+# far the backups have captured the logs.
+#
+# Binary log capture. Closed binary logs never change again, so instead of
+# copying every byte with `cp` they are either read where they are, or given a
+# stable name in a staging directory with a hard link. Only when that is not
+# possible (a different filesystem) is the data copied, and then by the kernel
+# with a reflink or copy_file_range rather than through user space.
+
+import os
+import re
+import json
+import errno
+import fcntl
+import bisect
+import struct
+import shutil
+import ctypes
+import ctypes.util
+import logging
+
+from pipeline import file_digest
+
+logger = logging.getLogger("PMB LOG")
+
+# ioctl asking the filesystem (btrfs, xfs, ...) to share the blocks of a file
+FICLONE = 0x40049409
+
+STAGING_MODES = ('inplace', 'link', 'copy')
+
+BINLOG_MAGIC = '\xfebin'
+
+# timestamp, type code, server id, event length, next position, flags
+EVENT_HEADER = struct.Struct('<IBIIIH')
+
+CATALOG_VERSION = 1
+
+class BinlogError(Exception):
+    """raised when binary logs can not be captured"""
+
+def read_event_headers(f, offset=4):
+    """yields (offset, header) for every complete event of the binary log `f` from `offset`
+
+    an event that is still being written (the end of the active log) is
+    left out, it will be read the next time.
+    """
+    size = os.fstat(f.fileno()).st_size
+    while offset + EVENT_HEADER.size <= size:
+        f.seek(offset)
+        header = EVENT_HEADER.unpack(f.read(EVENT_HEADER.size))
+        length = header[3]
+        if length < EVENT_HEADER.size or offset + length > size:
+            break
+        yield offset, header
+        offset += length
+
+class BinlogCatalog(object):
+    """the persistent catalog of the binary logs named `name` in `bin_log_path`
+
+    entries are kept sorted by sequence number, so lookups by name or
+    sequence number are binary searches over `sequences`, the sorted
+    sequence numbers, which are rebuilt only when the entries change.
+    """
+
+    def __init__(self, path, bin_log_path, name):
+        self.path = path
+        self.bin_log_path = bin_log_path
+        self.name = name
+        self.pattern = re.compile(r'^%s\.(\d+)$' % (re.escape(name)))
+        self.entries = []
+        self._sequences = None
+        # the sequence number of the last log the backups have captured
+        self.captured_through = None
+        self._load()
+
+    def _load(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        self.entries = sorted(data.get('binlogs', []), key=lambda e: e['sequence'])
+        self.captured_through = data.get('captured_through')
+
+    def save(self):
+        """atomically write the catalog"""
+        data = {
+            'version': CATALOG_VERSION,
+            'binlogs': self.entries,
+            'captured_through': self.captured_through,
+        }
+        f = open(self.path + '.partial', 'w')
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(self.path + '.partial', self.path)
+
+    def sequence(self, name):
+        """the sequence number of the log called `name`, None if it isn't one of ours"""
+        m = self.pattern.match(os.path.basename(name))
+        if m is None:
+            return None
+        return int(m.group(1))
+
+    def refresh(self, logs=None):
+        """bring the catalog up to date
+
+        `logs` is a list of (name, size) as returned by SHOW BINARY LOGS. when
+        it is None the bin_log_path directory is scanned instead. only events
+        written since the last refresh are read, and a log gets its checksum
+        once, when it is closed.
+        """
+        if logs is None:
+            logs = []
+            for name in os.listdir(self.bin_log_path):
+                if self.sequence(name) is not None:
+                    logs.append((name, os.path.getsize(os.path.join(self.bin_log_path, name))))
+
+        known = dict([(e['name'], e) for e in self.entries])
+        for name, size in logs:
+            if name not in known:
+                entry = {
+                    'name': name,
+                    'sequence': self.sequence(name),
+                    'size': 0,
+                    'end_position': 4,
+                    'first_event': None,
+                    'last_event': None,
+                    'sha256': None,
+                    'closed': False,
+                    'ignored': False,
+                }
+                known[name] = entry
+                self.entries.append(entry)
+            known[name]['size'] = int(size)
+
+        self.entries.sort(key=lambda e: e['sequence'])
+        self._sequences = None
+        for i, entry in enumerate(self.entries):
+            entry['closed'] = i < len(self.entries) - 1
+            if entry['end_position'] < entry['size'] or (entry['closed'] and entry['sha256'] is None):
+                self._scan(entry)
+
+    def _scan(self, entry):
+        path = os.path.join(self.bin_log_path, entry['name'])
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            # purged, or on a server we can only reach through SHOW BINARY LOGS
+            return
+
+        try:
+            if f.read(4) != BINLOG_MAGIC:
+                entry['end_position'] = entry['size']
+            else:
+                for offset, header in read_event_headers(f, entry['end_position']):
+                    if entry['first_event'] is None:
+                        entry['first_event'] = header[0]
+                    entry['last_event'] = header[0]
+                    entry['end_position'] = offset + header[3]
+        finally:
+            f.close()
+
+        if entry['closed'] and entry['sha256'] is None:
+            entry['sha256'] = file_digest(path)
+
+    def latest(self):
+        """the newest log, the one being written"""
+        if not self.entries:
+            raise BinlogError('no binary logs named %s found in %s' % (self.name, self.bin_log_path))
+        return self.entries[-1]
+
+    def sequences(self):
+        """the sequence numbers of the entries, in order"""
+        if self._sequences is None:
+            self._sequences = [e['sequence'] for e in self.entries]
+        return self._sequences
+
+    def find(self, name):
+        """the entry of the log `name`"""
+        i = bisect.bisect_left(self.sequences(), self.sequence(name))
+        if i < len(self.entries) and self.entries[i]['name'] == os.path.basename(name):
+            return self.entries[i]
+        return None
+
+    def between(self, first, last):
+        """entries with a sequence number from `first` to `last`, ignored ones left out"""
+        start = bisect.bisect_left(self.sequences(), first)
+        end = bisect.bisect_right(self.sequences(), last)
+        return [e for e in self.entries[start:end] if not e['ignored']]
+
+    def ignore(self, first, last):
+        """never capture the logs `first` to `last`, say because a restore wrote them"""
+        for entry in self.entries:
+            if first <= entry['sequence'] <= last:
+                entry['ignored'] = True
+
+    def adopt(self, other):
+        """take over what `other`, the catalog of the same logs for another target, read of them
+
+        the logs aren't scanned and checksummed again for every target. what
+        is ignored and streamed stays this catalog's own.
+        """
+        known = dict([(e['name'], e) for e in self.entries])
+        oldest = self.entries and self.entries[0]['sequence'] or 0
+        for theirs in other.entries:
+            entry = known.get(theirs['name'])
+            if entry is None:
+                if theirs['sequence'] < oldest:
+                    # forgotten here
+                    continue
+                entry = dict(theirs)
+                entry['ignored'] = False
+                entry.pop('streamed', None)
+                self.entries.append(entry)
+            else:
+                for key in ('size', 'end_position', 'first_event', 'last_event', 'sha256', 'closed'):
+                    entry[key] = theirs[key]
+        self.entries.sort(key=lambda e: e['sequence'])
+        self._sequences = None
+
+    def forget(self, before):
+        """drop the entries of the logs before the sequence number `before` the server purged, returns how many
+
+        a log still in bin_log_path would be added again by the next refresh.
+        """
+        kept = []
+        for entry in self.entries:
+            if entry['sequence'] < before and entry['closed'] and \
+                    not os.path.exists(os.path.join(self.bin_log_path, entry['name'])):
+                continue
+            kept.append(entry)
+        forgotten = len(self.entries) - len(kept)
+        self.entries = kept
+        self._sequences = None
+        return forgotten
+
+    def migrate(self, bin_log_info, ignore_logs):
+        """take over the state of the bin_log_info and ignore_logs files of older versions"""
+        if self.captured_through is None and os.path.exists(bin_log_info):
+            f = open(bin_log_info)
+            for line in f:
+                if line.startswith('before:'):
+                    self.captured_through = self.sequence(line[len('before:'):].strip())
+            f.close()
+
+        if os.path.exists(ignore_logs):
+            import pickle
+            f = open(ignore_logs, 'rb')
+            try:
+                for path in pickle.load(f):
+                    entry = self.find(path)
+                    if entry is not None:
+                        entry['ignored'] = True
+            except Exception:
+                pass
+            f.close()
+            os.remove(ignore_logs)
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        copy_file_range = libc.copy_file_range
+    except (OSError, AttributeError):
+        return None
+    copy_file_range.restype = ctypes.c_ssize_t
+    copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    return copy_file_range
+
+_copy_file_range = _load_libc()
+
+def _kernel_copy(src, dst):
+    """copy the open file `src` into `dst` without it passing through user space
+
+    returns False when neither a reflink nor copy_file_range is possible here.
+    """
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except (IOError, OSError):
+        pass
+
+    if _copy_file_range is None:
+        return False
+
+    size = os.fstat(src.fileno()).st_size
+    copied = 0
+    while copied < size:
+        n = _copy_file_range(src.fileno(), None, dst.fileno(), None, size - copied, 0)
+        if n < 0:
+            e = ctypes.get_errno()
+            if copied == 0 and e in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                return False
+            raise OSError(e, os.strerror(e))
+        if n == 0:
+            break
+        copied += n
+    return True
+
+def copy_file(source, destination, bucket=None):
+    """copy `source` to `destination`, letting the kernel do the work if it can
+
+    with a throttle.TokenBucket `bucket` the copy is paced by it instead.
+    """
+    src = open(source, 'rb')
+    try:
+        dst = open(destination, 'wb')
+        try:
+            if bucket is not None:
+                while True:
+                    block = src.read(1024 * 1024)
+                    if not block:
+                        break
+                    bucket.consume(len(block))
+                    dst.write(block)
+            elif not _kernel_copy(src, dst):
+                src.seek(0)
+                shutil.copyfileobj(src, dst, 4 * 1024 * 1024)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+def _already_staged(source, staged):
+    try:
+        a = os.stat(source)
+        b = os.stat(staged)
+    except OSError:
+        return False
+    if (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino):
+        return True
+    return a.st_size == b.st_size and int(a.st_mtime) <= int(b.st_mtime)
+
+def stage(paths, staging_path, mode='link', bucket=None):
+    """give the closed binary logs `paths` a stable name for the conversion
+
+    `inplace` returns the logs where they are, which is safe as long as MySQL
+    doesn't purge them while they are read. `link` hard links them into
+    `staging_path` and falls back to copying across filesystems, `copy`
+    always copies. logs staged by an earlier, interrupted run are reused.
+    copies are paced by `bucket` when one is given. returns the paths to read.
+    """
+    if mode not in STAGING_MODES:
+        raise BinlogError('unknown binlog staging mode "%s" (use one of %s)' %
+                (mode, ', '.join(STAGING_MODES)))
+
+    if mode == 'inplace':
+        return list(paths)
+
+    if not os.path.isdir(staging_path):
+        os.makedirs(staging_path)
+
+    staged = []
+    for path in paths:
+        target = os.path.join(staging_path, os.path.basename(path))
+        if _already_staged(path, target):
+            logger.info('%s already staged' % (os.path.basename(path)))
+            staged.append(target)
+            continue
+
+        if os.path.exists(target):
+            os.remove(target)
+
+        linked = False
+        if mode == 'link':
+            try:
+                os.link(path, target)
+                linked = True
+            except OSError, e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise BinlogError('could not link %s: %s' % (path, e))
+
+        if not linked:
+            try:
+                copy_file(path, target, bucket)
+            except (IOError, OSError), e:
+                raise BinlogError('could not copy %s: %s' % (path, e))
+
+        staged.append(target)
+    return staged
+
+def unstage(staged, paths):
+    """remove the staged names again, never the binary logs themselves"""
+    originals = set([os.path.abspath(p) for p in paths])
+    for path in staged:
+        if os.path.abspath(path) not in originals and os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,270 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Binary log demultiplexer. The incremental of a database used to be
+# `mysqlbinlog --database=<db>` over every binary log written since the last
+# backup, so backing up forty databases of one server decoded the same logs
+# forty times. The demultiplexer reads each log once and splits its events by
+# database, every database getting a binary log of its own (the magic number,
+# the format description of each log and the transactions touching it) that
+# its mysqlbinlog, compressor and gpg turn into its incremental on the fly.
+#
+# An event belongs to the database mysqlbinlog --database would give it to:
+#
+#   * a statement (a query event) to its default database, together with the
+#     intvar, rand and user variable events in front of it
+#   * a table map to the database of the table it maps, and a row event to the
+#     database of its table map
+#   * the BEGIN and the XID or COMMIT around a transaction go to every database
+#     the transaction touched, each one getting its own part of it
+#
+# GTID events are left out like mysqlbinlog --skip-gtids does: replaying a
+# transaction's GTID once per database would have the server skip all but the
+# first. Rotate, stop and heartbeat events aren't replayed either, nor events
+# flagged ignorable. Any other event (LOAD DATA, partial json updates,
+# compressed transaction payloads, incidents, XA, MariaDB's own events) can't
+# be split and stops the backup with a DemuxError rather than being lost, as
+# do row events and XIDs outside a transaction.
+#
+# Events aren't changed, their checksums stay valid. Their end positions are
+# those of the original log, mysqlbinlog only prints them.
+
+import os
+import struct
+import logging
+
+from binlog import BINLOG_MAGIC, EVENT_HEADER
+
+logger = logging.getLogger("PMB LOG")
+
+BLOCK_SIZE = 1024 * 1024
+
+QUERY_EVENT = 2
+STOP_EVENT = 3
+ROTATE_EVENT = 4
+INTVAR_EVENT = 5
+RAND_EVENT = 13
+USER_VAR_EVENT = 14
+FORMAT_DESCRIPTION_EVENT = 15
+XID_EVENT = 16
+TABLE_MAP_EVENT = 19
+HEARTBEAT_LOG_EVENT = 27
+ROWS_QUERY_EVENT = 29
+GTID_LOG_EVENT = 33
+ANONYMOUS_GTID_LOG_EVENT = 34
+PREVIOUS_GTIDS_LOG_EVENT = 35
+
+# write, update and delete rows, v0 to v2
+ROWS_EVENTS = (20, 21, 22, 23, 24, 25, 30, 31, 32)
+# events describing the statement that follows them
+STATEMENT_CONTEXT_EVENTS = (INTVAR_EVENT, RAND_EVENT, USER_VAR_EVENT, ROWS_QUERY_EVENT)
+# events that are left out, see above
+SKIPPED_EVENTS = (STOP_EVENT, ROTATE_EVENT, HEARTBEAT_LOG_EVENT, GTID_LOG_EVENT,
+        ANONYMOUS_GTID_LOG_EVENT, PREVIOUS_GTIDS_LOG_EVENT)
+# a server that doesn't know an event with this flag may skip it
+LOG_EVENT_IGNORABLE_F = 0x80
+
+# thread id, execution time, database length, error code, status variables length
+_QUERY_HEADER = struct.Struct('<IIBHH')
+# checksummed events end with a crc32
+_CHECKSUM_SIZE = 4
+
+class DemuxError(Exception):
+    """raised when a binary log can not be split"""
+
+class Output(object):
+    """where the events of `database` from the logs named `logs` go: `f`, a writable file
+
+    a write that fails (its pipeline died) is remembered in `error`, the
+    output gets nothing more and the others carry on.
+    """
+
+    def __init__(self, database, logs, f):
+        self.database = database
+        self.logs = set(logs)
+        self.f = f
+        self.started = False
+        self.error = None
+        self.bytes = 0
+        self.transactions = 0
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        try:
+            if not self.started:
+                self.f.write(BINLOG_MAGIC)
+                self.started = True
+            self.f.write(data)
+            self.bytes += len(data)
+        except (IOError, OSError), e:
+            self.error = e
+
+def read_events(f, offset=4):
+    """yields (header, event) for every complete event of the binary log `f` from `offset`
+
+    with `offset` None `f` is a stream, read from where it is.
+    """
+    if offset is None:
+        offset = 4
+    else:
+        f.seek(offset)
+    buf = ''
+    position = 0
+    while True:
+        if len(buf) - position < EVENT_HEADER.size:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                return
+            buf = buf[position:] + block
+            position = 0
+            continue
+        header = EVENT_HEADER.unpack_from(buf, position)
+        length = header[3]
+        if length < EVENT_HEADER.size:
+            raise DemuxError('%s: bad event length %d at %d' % (getattr(f, 'name', 'stream'), length, offset))
+        if len(buf) - position < length:
+            block = f.read(max(BLOCK_SIZE, length))
+            if not block:
+                # still being written
+                return
+            buf = buf[position:] + block
+            position = 0
+            continue
+        yield header, buf[position:position + length]
+        position += length
+        offset += length
+
+def skipped(header):
+    """whether the event of `header` is left out of the logs written"""
+    return header[1] in SKIPPED_EVENTS or bool(header[5] & LOG_EVENT_IGNORABLE_F)
+
+def describe(header, what='an event'):
+    """`what` with the position and type of the event of `header`, for errors"""
+    return '%s at %d (type %d)' % (what, header[4] - header[3], header[1])
+
+def is_statement(sql, statement):
+    # with checksums on, the crc32 of the event follows the statement
+    return sql == statement or (len(sql) == len(statement) + _CHECKSUM_SIZE and sql.startswith(statement))
+
+def query_event(event):
+    """(default database, statement) of a query event"""
+    body = EVENT_HEADER.size
+    thread_id, exec_time, db_length, error_code, status_length = _QUERY_HEADER.unpack_from(event, body)
+    start = body + _QUERY_HEADER.size + status_length
+    return event[start:start + db_length], event[start + db_length + 1:]
+
+def table_id(event):
+    """the table id of a table map or row event"""
+    body = EVENT_HEADER.size
+    return struct.unpack('<Q', event[body:body + 6] + '\0\0')[0]
+
+def _table_map(event):
+    """(table id, database) of a table map event"""
+    # table id, flags, database length
+    start = EVENT_HEADER.size + 8
+    return table_id(event), event[start + 1:start + 1 + ord(event[start])]
+
+class _Transaction(object):
+    def __init__(self, begin):
+        self.begin = begin
+        # the events of each database, in the order the databases came up
+        self.databases = []
+        self.events = {}
+        self.tables = {}
+
+    def add(self, database, events):
+        if database not in self.events:
+            self.databases.append(database)
+            self.events[database] = []
+        self.events[database].extend(events)
+
+def _emit(outputs, transaction, end):
+    for database in transaction.databases:
+        targets = outputs.get(database)
+        if not targets:
+            continue
+        data = ''.join([transaction.begin] + transaction.events[database] + [end])
+        for output in targets:
+            output.write(data)
+            output.transactions += 1
+
+def split(path, name, outputs):
+    """send the events of the binary log `path`, called `name`, to the `outputs` reading it
+
+    returns the number of bytes read.
+    """
+    by_database = {}
+    for output in outputs:
+        if name in output.logs and output.error is None:
+            by_database.setdefault(output.database, []).append(output)
+    if not by_database:
+        return 0
+
+    f = open(path, 'rb')
+    try:
+        if f.read(4) != BINLOG_MAGIC:
+            raise DemuxError('%s is not a binary log' % (path))
+        transaction = None
+        context = []
+        for header, event in read_events(f):
+            type_code = header[1]
+            if type_code == FORMAT_DESCRIPTION_EVENT:
+                for targets in by_database.values():
+                    for output in targets:
+                        output.write(event)
+            elif type_code == QUERY_EVENT:
+                database, sql = query_event(event)
+                if is_statement(sql, 'BEGIN'):
+                    transaction = _Transaction(event)
+                    context = []
+                elif transaction is not None and (is_statement(sql, 'COMMIT') or is_statement(sql, 'ROLLBACK')):
+                    _emit(by_database, transaction, event)
+                    transaction = None
+                elif transaction is not None:
+                    transaction.add(database, context + [event])
+                    context = []
+                else:
+                    # a statement of its own, like ddl
+                    data = ''.join(context + [event])
+                    context = []
+                    for output in by_database.get(database, []):
+                        output.write(data)
+                        output.transactions += 1
+            elif type_code in (XID_EVENT, TABLE_MAP_EVENT) or type_code in ROWS_EVENTS:
+                if transaction is None:
+                    raise DemuxError('%s: %s is outside a transaction' %
+                            (path, describe(header, 'a row event or XID')))
+                if type_code == XID_EVENT:
+                    _emit(by_database, transaction, event)
+                    transaction = None
+                elif type_code == TABLE_MAP_EVENT:
+                    mapped, database = _table_map(event)
+                    transaction.tables[mapped] = database
+                    transaction.add(database, context + [event])
+                    context = []
+                else:
+                    database = transaction.tables.get(table_id(event))
+                    if database is None:
+                        raise DemuxError('%s: row event without a table map' % (path))
+                    transaction.add(database, context + [event])
+                    context = []
+            elif type_code in STATEMENT_CONTEXT_EVENTS:
+                context.append(event)
+            elif not skipped(header):
+                raise DemuxError('%s: %s can not be split by database' % (path, describe(header)))
+        return f.tell()
+    finally:
+        f.close()
+
+def demultiplex(logs, outputs):
+    """one pass over `logs`, (name, path) pairs in log order, splitting them into `outputs`
+
+    returns the number of bytes read.
+    """
+    read = 0
+    for name, path in logs:
+        read += split(path, name, outputs)
+    for output in outputs:
+        if output.error is None:
+            logger.info('%s: %d transactions, %d bytes' % (output.database, output.transactions, output.bytes))
+    return read
@@ -0,0 +1,257 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Continuous binary log streaming. Incrementals taken by cron are only as recent
+# as the last run, and every run makes MySQL rotate its logs with FLUSH LOGS.
+# The stream instead follows the binary logs while they are written and every
+# `interval` seconds turns the transactions added since the last time into a
+# small incremental, a segment, so the backups are a few seconds behind the
+# server and the logs rotate when MySQL decides to.
+#
+# The logs are read from bin_log_path, or from a spool directory that
+# `mysqlbinlog --read-from-remote-server --raw --stop-never` keeps writing
+# copies of the server's logs into. A segment always ends after a complete
+# transaction, mysqlbinlog would roll back one that was cut in half. Once a
+# segment is written the position it ends at is checkpointed in the binary log
+# catalog (`streamed`), so a restarted stream carries on where it stopped.
+#
+# Following the logs and writing the segments (mysqlbinlog, compression, gpg)
+# happen on separate threads, a slow segment doesn't hold up reading the logs.
+
+import os
+import fcntl
+import Queue
+import struct
+import tempfile
+import threading
+import subprocess
+import logging
+
+import binlog
+
+logger = logging.getLogger("PMB LOG")
+
+LOCK_NAME = 'binlog_stream.lock'
+
+QUERY_EVENT = 2
+# stop, rotate, xid and incident events end a transaction
+_END_EVENTS = (3, 4, 16, 26)
+
+# thread id, execution time, database length, error code, status variables length
+_QUERY_HEADER = struct.Struct('<IIBHH')
+
+class StreamError(Exception):
+    """raised when the binary logs can not be streamed"""
+
+def lock(full_path):
+    """make sure only one stream runs for `full_path`, returns the lock to keep open"""
+    f = open(os.path.join(full_path, LOCK_NAME), 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        f.close()
+        raise StreamError('another binary log stream is running for %s' % (full_path))
+    return f
+
+def running(full_path):
+    """True while a stream runs for `full_path`"""
+    path = os.path.join(full_path, LOCK_NAME)
+    if not os.path.exists(path):
+        return False
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except IOError:
+        return True
+    finally:
+        f.close()
+    return False
+
+def _opens_transaction(f, offset):
+    f.seek(offset + binlog.EVENT_HEADER.size)
+    thread_id, exec_time, db_length, error_code, status_length = \
+            _QUERY_HEADER.unpack(f.read(_QUERY_HEADER.size))
+    f.seek(status_length + db_length + 1, os.SEEK_CUR)
+    statement = f.read(8).upper()
+    return statement.startswith('BEGIN') or statement.startswith('XA START')
+
+def transaction_end(path, start, end):
+    """where the last transaction completed in the log `path` between `start` and `end` ends
+
+    returns (position, time of its last event, number of transactions), the
+    position is `start` when no transaction was completed in that range.
+    """
+    position, last_event, transactions = start, None, 0
+    f = open(path, 'rb')
+    try:
+        for offset, header in binlog.read_event_headers(f, start):
+            if offset + header[3] > end:
+                break
+            type_code = header[1]
+            if type_code in _END_EVENTS or (type_code == QUERY_EVENT and not _opens_transaction(f, offset)):
+                position = offset + header[3]
+                last_event = header[0]
+                if type_code in (QUERY_EVENT, 16):
+                    transactions += 1
+    finally:
+        f.close()
+    return position, last_event, transactions
+
+class BinlogStream(object):
+    """follow the binary logs of `catalog` and write them as segments
+
+    `refresh()` brings the catalog up to date. `write_segment(name, path,
+    start, end, last_event)` writes the events of the log `name` from `start`
+    to `end` as a backup, it is called on a thread of its own and in log
+    order. `relay` is the mysqlbinlog command line (without the first log)
+    copying the server's logs into the catalog's directory, it is restarted
+    when it exits.
+    """
+
+    def __init__(self, catalog, refresh, write_segment, interval=5, relay=None):
+        self.catalog = catalog
+        self.refresh = refresh
+        self.write_segment = write_segment
+        self.interval = interval
+        self.relay = relay
+        self.relay_process = None
+        self.relay_errors = None
+        # the catalog is refreshed by one thread and checkpointed by the other
+        self.lock = threading.Lock()
+        self.segments = Queue.Queue()
+        self.stopping = threading.Event()
+        self.errors = []
+        # where the next segment of each log starts
+        self.queued = {}
+
+    def stop(self):
+        """finish the segments that are queued and return from run()"""
+        self.stopping.set()
+
+    def run(self):
+        if self.catalog.captured_through is None:
+            raise StreamError('the binary log catalog does not know the last captured log, run a full backup first')
+
+        writer = threading.Thread(target=self._write)
+        writer.daemon = True
+        writer.start()
+        try:
+            while not self.stopping.is_set():
+                self._keep_relay()
+                self._follow()
+                self.stopping.wait(self.interval)
+        finally:
+            self.stopping.set()
+            self.segments.put(None)
+            while writer.is_alive():
+                writer.join(1)
+            self._stop_relay()
+
+        if self.errors:
+            raise StreamError('; '.join(self.errors))
+
+    def _follow(self):
+        self.lock.acquire()
+        try:
+            self.refresh()
+            entries = [dict(e) for e in self.catalog.entries
+                    if e['sequence'] > self.catalog.captured_through]
+        finally:
+            self.lock.release()
+
+        for entry in entries:
+            start = self.queued.get(entry['name'], entry.get('streamed') or 4)
+            end = entry['end_position']
+            if start >= end:
+                continue
+
+            if entry['ignored']:
+                # written by a restore, it is never backed up
+                if entry['closed']:
+                    self._queue(entry, start, end, None, False)
+                continue
+
+            path = os.path.join(self.catalog.bin_log_path, entry['name'])
+            if not os.path.exists(path):
+                # not relayed yet
+                break
+            try:
+                position, last_event, transactions = transaction_end(path, start, end)
+            except IOError, e:
+                raise StreamError('could not read %s: %s' % (path, e))
+
+            if entry['closed'] and position < end and os.path.getsize(path) >= end:
+                # a transaction the server never finished, mysqlbinlog
+                # rolls it back the way the server did
+                position, last_event = end, entry['last_event']
+                transactions += 1
+            if position > start:
+                self._queue(entry, start, position, last_event, transactions > 0)
+
+    def _queue(self, entry, start, end, last_event, write):
+        self.queued[entry['name']] = end
+        self.segments.put((entry['name'], start, end, last_event, write))
+
+    def _write(self):
+        while True:
+            item = self.segments.get()
+            if item is None:
+                return
+            if self.errors:
+                continue
+            name, start, end, last_event, write = item
+            try:
+                if write:
+                    self.write_segment(name, os.path.join(self.catalog.bin_log_path, name),
+                            start, end, last_event)
+                self._checkpoint(name, end)
+            except (Exception, SystemExit), e:
+                logger.error('Could not write the segment of %s from %d to %d: %s' % (name, start, end, e))
+                self.errors.append('%s %d-%d: %s' % (name, start, end, e))
+                self.stopping.set()
+
+    def _checkpoint(self, name, end):
+        """remember that `name` is backed up to `end`, logs backed up to their end are captured"""
+        self.lock.acquire()
+        try:
+            self.catalog.find(name)['streamed'] = end
+            for entry in self.catalog.entries:
+                if entry['sequence'] != self.catalog.captured_through + 1:
+                    continue
+                if not entry['closed'] or (entry.get('streamed') or 4) < entry['end_position']:
+                    break
+                self.catalog.captured_through = entry['sequence']
+                if self.relay is not None:
+                    # the spooled copy isn't needed any more
+                    path = os.path.join(self.catalog.bin_log_path, entry['name'])
+                    if os.path.exists(path):
+                        os.remove(path)
+            self.catalog.save()
+        finally:
+            self.lock.release()
+
+    def _keep_relay(self):
+        if self.relay is None:
+            return
+        if self.relay_process is not None:
+            if self.relay_process.poll() is None:
+                return
+            self.relay_errors.seek(0)
+            logger.warn('mysqlbinlog exited with %d, restarting it: %s' %
+                    (self.relay_process.returncode, self.relay_errors.read().strip()))
+            self.relay_errors.close()
+
+        first = '%s.%06d' % (self.catalog.name, self.catalog.captured_through + 1)
+        logger.info('Relaying the binary logs from %s into %s' % (first, self.catalog.bin_log_path))
+        self.relay_errors = tempfile.TemporaryFile()
+        self.relay_process = subprocess.Popen(self.relay + [first],
+                stdout=open(os.devnull, 'w'),
+                stderr=self.relay_errors,
+                close_fds=True)
+
+    def _stop_relay(self):
+        if self.relay_process is not None:
+            if self.relay_process.poll() is None:
+                self.relay_process.terminate()
+            self.relay_process.wait()
+            self.relay_process = None
+            self.relay_errors.close()
@@ -0,0 +1,505 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Row change compaction. With row based binary logs a hot row updated a
+# thousand times is a thousand row images in the incremental, and a thousand
+# updates when it is replayed. The compactor sits between the binary logs and
+# mysqlbinlog and folds the row changes of a window of transactions (`window`
+# of them, at most `window_seconds` apart) into their net effect:
+#
+#   * an insert followed by updates is an insert of the last image
+#   * updates of a row are one update from its first to its last image, or
+#     nothing when the row ends up as it was
+#   * an insert followed by a delete is nothing, updates followed by a delete
+#     a delete of the first image
+#
+# A row is followed by its whole image, so no key needs to be known: the
+# before image of a change is the after image of the change it follows. The
+# net changes are written as one transaction, in the order their rows first
+# changed, where the last transaction of the window was.
+#
+# Only transactions made of full image row changes (binlog_row_image=FULL) of
+# the `tables` compacted are folded. Anything else (statements, ddl, partial
+# images) closes the window and passes through untouched, as does the end of
+# each log, so the order of everything around a window is kept. GTID, rotate
+# and stop events are left out like binlogdemux.py does, and any other event
+# outside a transaction stops the compaction with a CompactionError.
+#
+# Folding reorders row changes inside a window: two rows swapping a unique key
+# value in separate transactions may conflict on replay, and foreign keys are
+# not checked while a window is applied. So no table is compacted unless it is
+# named in `tables`, and a point in time restore to a point inside a window
+# stops before the window.
+
+import zlib
+import struct
+import fnmatch
+import logging
+
+import binlogdemux
+from binlog import BINLOG_MAGIC, EVENT_HEADER
+from binlogdemux import (QUERY_EVENT, FORMAT_DESCRIPTION_EVENT, XID_EVENT, TABLE_MAP_EVENT,
+        ROWS_QUERY_EVENT, STATEMENT_CONTEXT_EVENTS)
+
+logger = logging.getLogger("PMB LOG")
+
+# the row events written for a window are cut at about this size
+ROWS_EVENT_SIZE = 8192
+
+# write, update and delete rows v1, v2 is 7 more
+WRITE_ROWS_EVENT = 23
+UPDATE_ROWS_EVENT = 24
+DELETE_ROWS_EVENT = 25
+_KINDS = {23: 'write', 24: 'update', 25: 'delete', 30: 'write', 31: 'update', 32: 'delete'}
+
+# row event flags
+STMT_END_F = 0x1
+NO_FOREIGN_KEY_CHECKS_F = 0x2
+
+# checksum algorithm of the format description event, since 5.6.1
+_CHECKSUM_CRC32 = 1
+_CHECKSUM_SIZE = 4
+
+# bytes a value takes in a row image by column type, see _column_size
+_FIXED_SIZES = {1: 1, 2: 2, 3: 4, 6: 0, 7: 4, 8: 8, 9: 3, 10: 3, 11: 3, 12: 8, 13: 1, 14: 3}
+# types with a one byte, two byte and big endian two byte metadata
+_META_BYTE = (4, 5, 17, 18, 19, 245, 249, 250, 251, 252, 255)
+_META_SHORT = (15, 16, 253)
+_META_PAIR = (246, 247, 248, 254)
+_DECIMAL_DIGITS = (0, 1, 1, 2, 2, 3, 3, 4, 4, 4)
+
+class CompactionError(Exception):
+    """raised when the binary log stream can not be compacted"""
+
+def _packed_int(data, pos):
+    """(value, position after it) of the length encoded integer at `pos`"""
+    first = ord(data[pos])
+    if first < 251:
+        return first, pos + 1
+    if first == 252:
+        return struct.unpack_from('<H', data, pos + 1)[0], pos + 3
+    if first == 253:
+        return struct.unpack('<I', data[pos + 1:pos + 4] + '\0')[0], pos + 4
+    return struct.unpack_from('<Q', data, pos + 1)[0], pos + 9
+
+def _pack_int(value):
+    if value < 251:
+        return chr(value)
+    if value < 65536:
+        return '\xfc' + struct.pack('<H', value)
+    if value < 16777216:
+        return '\xfd' + struct.pack('<I', value)[:3]
+    return '\xfe' + struct.pack('<Q', value)
+
+def _full_bitmap(columns):
+    bitmap = '\xff' * (columns / 8)
+    if columns % 8:
+        bitmap += chr((1 << (columns % 8)) - 1)
+    return bitmap
+
+def _checksum_size(event):
+    """size of the checksum the events after the format description event `event` end with"""
+    body = event[EVENT_HEADER.size:]
+    version = []
+    for part in body[2:52].rstrip('\0').split('-')[0].split('.')[:3]:
+        try:
+            version.append(int(part))
+        except ValueError:
+            version.append(0)
+    if version < [5, 6, 1]:
+        return 0
+    # the algorithm and the checksum of the event itself close it
+    return ord(body[-_CHECKSUM_SIZE - 1]) == _CHECKSUM_CRC32 and _CHECKSUM_SIZE or 0
+
+def _column_size(type_code, meta):
+    """bytes a value of a column takes in a row image, negative for a value
+    following a little endian length of that many bytes. None for types that
+    aren't known
+    """
+    if type_code in _FIXED_SIZES:
+        return _FIXED_SIZES[type_code]
+    if type_code in (4, 5):
+        # float and double, their size is the metadata
+        return meta
+    if type_code in (15, 253):
+        return meta > 255 and -2 or -1
+    if type_code == 16:
+        # bit: whole bytes and the bits left over
+        return (meta >> 8) + (meta & 0xff and 1 or 0)
+    if type_code in (17, 18, 19):
+        # timestamp2, datetime2 and time2 with `meta` fractional digits
+        return {17: 4, 18: 5, 19: 3}[type_code] + (meta + 1) / 2
+    if type_code == 246:
+        precision, scale = meta >> 8, meta & 0xff
+        integral = precision - scale
+        return (integral / 9 * 4 + _DECIMAL_DIGITS[integral % 9] +
+                scale / 9 * 4 + _DECIMAL_DIGITS[scale % 9])
+    if type_code in (245, 249, 250, 251, 252, 255):
+        # json, blobs and geometry, the metadata is the size of their length
+        return -meta
+    if type_code in (247, 248, 254):
+        real_type, length = meta >> 8, meta & 0xff
+        if real_type & 0x30 != 0x30:
+            # char columns longer than 255 keep two bits of their length in the type
+            length |= ((real_type & 0x30) ^ 0x30) << 4
+            real_type |= 0x30
+        if real_type in (247, 248):
+            # enum and set
+            return length
+        return length > 255 and -2 or -1
+    return None
+
+class _TableMap(object):
+    """the table a table map event maps, with the size of its columns"""
+
+    def __init__(self, event):
+        self.event = event
+        self.table_id = binlogdemux.table_id(event)
+        pos = EVENT_HEADER.size + 8
+        length = ord(event[pos])
+        self.database = event[pos + 1:pos + 1 + length]
+        pos += length + 2
+        length = ord(event[pos])
+        self.table = event[pos + 1:pos + 1 + length]
+        pos += length + 2
+        self.columns, pos = _packed_int(event, pos)
+        types = [ord(c) for c in event[pos:pos + self.columns]]
+        pos += self.columns
+        length, pos = _packed_int(event, pos)
+        metadata = event[pos:pos + length]
+
+        self.key = (self.database, self.table)
+        self.null_bytes = (self.columns + 7) / 8
+        self.bitmap = _full_bitmap(self.columns)
+        self.sizes = []
+        offset = 0
+        for type_code in types:
+            meta = 0
+            if type_code in _META_BYTE:
+                meta = ord(metadata[offset])
+                offset += 1
+            elif type_code in _META_SHORT:
+                meta = struct.unpack_from('<H', metadata, offset)[0]
+                offset += 2
+            elif type_code in _META_PAIR:
+                meta = ord(metadata[offset]) << 8 | ord(metadata[offset + 1])
+                offset += 2
+            size = _column_size(type_code, meta)
+            if size is None:
+                # not a type we know how to skip over
+                self.sizes = None
+                break
+            self.sizes.append(size)
+
+    def image_end(self, data, pos):
+        """the end of the row image at `pos`"""
+        nulls = data[pos:pos + self.null_bytes]
+        pos += self.null_bytes
+        for i, size in enumerate(self.sizes):
+            if ord(nulls[i >> 3]) & (1 << (i & 7)):
+                continue
+            if size < 0:
+                value = struct.unpack('<I', data[pos:pos - size] + '\0' * (4 + size))[0]
+                pos += value - size
+            else:
+                pos += size
+        return pos
+
+    def rows(self, event, checksum):
+        """the row images of the row event `event`, [image] or [before, after]
+        for updates. None when the images aren't full images
+        """
+        type_code = ord(event[4])
+        pos = EVENT_HEADER.size + 8
+        if type_code >= 30:
+            # v2 row events carry extra data, its length counts itself
+            pos += struct.unpack_from('<H', event, pos)[0]
+        columns, pos = _packed_int(event, pos)
+        if columns != self.columns:
+            return None
+        images = _KINDS[type_code] == 'update' and 2 or 1
+        for i in range(images):
+            bitmap = event[pos:pos + self.null_bytes]
+            # the bits past the last column may be set too
+            if ''.join([chr(ord(b) & ord(m)) for b, m in zip(bitmap, self.bitmap)]) != self.bitmap:
+                return None
+            pos += self.null_bytes
+        end = len(event) - checksum
+        rows = []
+        while pos < end:
+            row = []
+            for i in range(images):
+                start = pos
+                pos = self.image_end(event, pos)
+                row.append(event[start:pos])
+            rows.append(row)
+        if pos != end:
+            raise CompactionError('row event of %s.%s does not match its table map' % (self.database, self.table))
+        return rows
+
+class _Window(object):
+    """the net row changes of the transactions folded so far
+
+    `changes` are [table, kind, before image, after image] in the order
+    their rows first changed, a change folded away has no kind. `current`
+    finds the change of a row by its table and current image.
+    """
+
+    def __init__(self, begin, timestamp):
+        self.begin = begin
+        self.end = None
+        self.header = None
+        self.first_time = timestamp
+        self.transactions = 0
+        self.changes = []
+        self.current = {}
+        self.tables = {}
+        self.v2 = True
+
+    def add(self, table, kind, row):
+        key = table.key
+        if kind == 'write':
+            change = [key, 'write', None, row[0]]
+            self.changes.append(change)
+            self.current[(key, row[0])] = change
+            return
+        change = self.current.pop((key, row[0]), None)
+        if kind == 'delete':
+            if change is None:
+                self.changes.append([key, 'delete', row[0], None])
+            elif change[1] == 'write':
+                change[1] = None
+            else:
+                change[1], change[3] = 'delete', None
+            return
+        if change is None:
+            change = [key, 'update', row[0], row[1]]
+            self.changes.append(change)
+        else:
+            change[3] = row[1]
+            if change[1] == 'update' and change[2] == row[1]:
+                # back where it started
+                change[1] = None
+                return
+        self.current[(key, row[1])] = change
+
+class Compactor(object):
+    """pipeline filter compacting the row changes of the binary log stream it reads
+
+    `window` is the number of transactions folded into one and
+    `window_seconds` the time they may span, `tables` fnmatch patterns of the
+    tables (database.table) that are compacted, none when it is empty. what
+    went in and came out is counted in `stats`.
+    """
+
+    def __init__(self, window=1000, window_seconds=60, tables=None):
+        self.window_size = max(1, window)
+        self.window_seconds = window_seconds
+        self.patterns = tables or []
+        self.stats = {
+            'window': self.window_size,
+            'window_seconds': window_seconds,
+            'transactions_in': 0,
+            'transactions_out': 0,
+            'rows_in': 0,
+            'rows_out': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+        }
+        self.writer = None
+        self.window = None
+        self.checksum = 0
+        self.tables = {}
+        self.compacted = {}
+
+    def __call__(self, reader, writer):
+        if reader.read(4) != BINLOG_MAGIC:
+            raise CompactionError('the input is not a binary log')
+        self.writer = writer
+        self._write(BINLOG_MAGIC)
+        transaction = None
+        context = []
+        for header, event in binlogdemux.read_events(reader, None):
+            self.stats['bytes_in'] += len(event)
+            type_code = header[1]
+            if transaction is not None:
+                transaction.append(event)
+                if type_code == XID_EVENT:
+                    self._end(transaction, header)
+                    transaction = None
+                elif type_code == QUERY_EVENT:
+                    database, sql = binlogdemux.query_event(event)
+                    if binlogdemux.is_statement(sql, 'COMMIT'):
+                        self._end(transaction, header)
+                        transaction = None
+                    elif binlogdemux.is_statement(sql, 'ROLLBACK'):
+                        # changes of non transactional tables, replayed as they were
+                        self._end(transaction, header, False)
+                        transaction = None
+            elif type_code == QUERY_EVENT and binlogdemux.is_statement(binlogdemux.query_event(event)[1], 'BEGIN'):
+                transaction = [event]
+                context = []
+            elif type_code in STATEMENT_CONTEXT_EVENTS:
+                context.append(event)
+            elif type_code in (QUERY_EVENT, FORMAT_DESCRIPTION_EVENT):
+                # a statement of its own or the start of the next log
+                self._flush()
+                if type_code == FORMAT_DESCRIPTION_EVENT:
+                    self.checksum = _checksum_size(event)
+                    self.tables = {}
+                else:
+                    self.stats['transactions_in'] += 1
+                    self.stats['transactions_out'] += 1
+                self._write(''.join(context + [event]))
+                context = []
+            elif not binlogdemux.skipped(header):
+                raise CompactionError('%s outside a transaction can not be compacted' %
+                        (binlogdemux.describe(header)))
+        self._flush()
+        if transaction is not None:
+            # cut short, it goes on the way it came
+            self._write(''.join(transaction))
+        if self.stats['rows_in']:
+            logger.info('Compacted %d row changes of %d transactions into %d row changes of %d transactions' %
+                    (self.stats['rows_in'], self.stats['transactions_in'],
+                     self.stats['rows_out'], self.stats['transactions_out']))
+
+    def _write(self, data):
+        self.writer.write(data)
+        self.stats['bytes_out'] += len(data)
+
+    def _compact(self, table):
+        if table.key not in self.compacted:
+            name = '%s.%s' % table.key
+            self.compacted[table.key] = table.sizes is not None and \
+                    bool([p for p in self.patterns if fnmatch.fnmatchcase(name, p)])
+        return self.compacted[table.key]
+
+    def _changes(self, transaction):
+        """(table map, kind, rows) of the row events of `transaction`, None if it can't be folded"""
+        changes = []
+        for event in transaction[1:-1]:
+            type_code = ord(event[4])
+            if type_code == TABLE_MAP_EVENT:
+                table = _TableMap(event)
+                self.tables[table.table_id] = table
+                if not self._compact(table):
+                    return None
+            elif type_code in _KINDS:
+                table = self.tables.get(binlogdemux.table_id(event))
+                if table is None or not self._compact(table):
+                    return None
+                rows = table.rows(event, self.checksum)
+                if rows is None:
+                    return None
+                changes.append((table, _KINDS[type_code], type_code >= 30, rows))
+            elif type_code != ROWS_QUERY_EVENT:
+                return None
+        return changes
+
+    def _end(self, transaction, header, committed=True):
+        """`transaction` ended with the event of `header`, fold it into the window or pass it on
+
+        a window only ever ends in an XID or COMMIT, a transaction that was
+        rolled back is never folded.
+        """
+        self.stats['transactions_in'] += 1
+        changes = committed and self._changes(transaction) or None
+        if not changes:
+            self._flush()
+            self._write(''.join(transaction))
+            self.stats['transactions_out'] += 1
+            return
+        timestamp = header[0]
+        if self.window is not None and timestamp - self.window.first_time >= self.window_seconds:
+            self._flush()
+        if self.window is None:
+            self.window = _Window(transaction[0], timestamp)
+        window = self.window
+        for table, kind, v2, rows in changes:
+            window.tables[table.key] = table
+            window.v2 = v2
+            self.stats['rows_in'] += len(rows)
+            for row in rows:
+                window.add(table, kind, row)
+        window.end = transaction[-1]
+        window.header = header
+        window.transactions += 1
+        if window.transactions >= self.window_size:
+            self._flush()
+
+    def _flush(self):
+        """write the net changes of the window as one transaction"""
+        window = self.window
+        if window is None:
+            return
+        self.window = None
+        changes = [c for c in window.changes if c[1] is not None]
+        if not changes:
+            # it all cancelled out
+            return
+
+        # the changes of a table and kind in a row make a statement: its
+        # table map and row events of up to ROWS_EVENT_SIZE bytes
+        parts = [window.begin]
+        i = 0
+        while i < len(changes):
+            key, kind = changes[i][:2]
+            images = []
+            while i < len(changes) and changes[i][0] == key and changes[i][1] == kind:
+                change = changes[i]
+                images.append((change[2] or '') + (change[3] or ''))
+                i += 1
+            table = window.tables[key]
+            parts.append(table.event)
+            event = []
+            size = 0
+            for n, image in enumerate(images):
+                event.append(image)
+                size += len(image)
+                if size >= ROWS_EVENT_SIZE or n == len(images) - 1:
+                    parts.append(self._rows_event(window, table, kind, event, n == len(images) - 1))
+                    event = []
+                    size = 0
+        parts.append(window.end)
+        self._write(''.join(parts))
+        self.stats['transactions_out'] += 1
+        self.stats['rows_out'] += len(changes)
+
+    def _rows_event(self, window, table, kind, images, last):
+        type_code = {'write': WRITE_ROWS_EVENT, 'update': UPDATE_ROWS_EVENT, 'delete': DELETE_ROWS_EVENT}[kind]
+        # the changes are no longer in the order they were checked in
+        flags = NO_FOREIGN_KEY_CHECKS_F
+        if last:
+            flags |= STMT_END_F
+        body = struct.pack('<Q', table.table_id)[:6] + struct.pack('<H', flags)
+        if window.v2:
+            type_code += 7
+            body += struct.pack('<H', 2)
+        body += _pack_int(table.columns) + table.bitmap
+        if kind == 'update':
+            body += table.bitmap
+        body += ''.join(images)
+        timestamp, old_type, server_id, length, end_position, event_flags = window.header
+        header = EVENT_HEADER.pack(timestamp, type_code, server_id,
+                EVENT_HEADER.size + len(body) + self.checksum, end_position, 0)
+        if not self.checksum:
+            return header + body
+        return header + body + struct.pack('<I', zlib.crc32(header + body) & 0xffffffff)
+
+def read_logs(paths):
+    """pipeline filter writing the binary logs `paths` as one stream, what a Compactor reads"""
+    def read(reader, writer):
+        writer.write(BINLOG_MAGIC)
+        for path in paths:
+            f = open(path, 'rb')
+            try:
+                if f.read(4) != BINLOG_MAGIC:
+                    raise CompactionError('%s is not a binary log' % (path))
+                while True:
+                    block = f.read(binlogdemux.BLOCK_SIZE)
+                    if not block:
+                        break
+                    writer.write(block)
+            finally:
+                f.close()
+    return read
@@ -0,0 +1,289 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Compression codecs. gzip is done in-process, zstd and lz4 through their
+# command line tools. The codec and settings a backup was written with are
+# kept in a small metadata file next to it so restore and fetch can pick
+# the matching decoder.
+#
+# Multi-threaded gzip. The stream is cut into blocks which are compressed on a
+# thread pool (zlib releases the GIL while it works) and written out in order.
+# Every block is a complete gzip member carrying its compressed size in a
+# 'PM' extra field, the same trick BGZF uses, so the output is still plain
+# gzip that `gzip -d` and `zcat` understand while our own decompressor can
+# find the block boundaries and inflate the blocks in parallel as well.
+#
+# A stream cut at a member boundary would still be valid gzip, so like BGZF the
+# compressor closes it with an empty member, and marks its members with an
+# mtime of 1 to say the stream ends with one. A marked stream without it is
+# truncated. Streams from before the marker and foreign gzip (which must end
+# in a complete member) are still read.
+
+import os
+import zlib
+import json
+import struct
+import collections
+from multiprocessing.pool import ThreadPool
+
+from pipeline import BLOCK_SIZE, current_stage, charge_cpu
+
+# gzip member header with FEXTRA set: magic, deflate, flags, mtime, xfl, os
+# (255 = unknown), xlen and the 'PM' subfield holding the member size.
+_HEADER = struct.Struct('<BBBBIBBH2sHI')
+_TRAILER = struct.Struct('<II')
+_MEMBER_OVERHEAD = _HEADER.size + _TRAILER.size
+# the mtime of the members of a stream closed by an empty member
+_MARKED = 1
+
+class CompressionError(Exception):
+    """raised when a compressed stream is corrupt"""
+
+def compress_block(args):
+    """`args` is (data, level), returns data as a gzip member of our own"""
+    data, level = args
+    return _member(data, level, 0)
+
+def _marked_block(args):
+    data, level = args
+    return _member(data, level, _MARKED)
+
+def _member(data, level, mtime):
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = c.compress(data) + c.flush()
+    header = _HEADER.pack(0x1f, 0x8b, 8, 4, mtime, 0, 255, 8, 'PM', 4,
+            len(body) + _MEMBER_OVERHEAD)
+    trailer = _TRAILER.pack(zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + body + trailer
+
+def decompress_block(member):
+    """the data of a gzip member written by compress_block"""
+    body = member[_HEADER.size:-_TRAILER.size]
+    crc, size = _TRAILER.unpack(member[-_TRAILER.size:])
+    data = zlib.decompress(body, -zlib.MAX_WBITS)
+    if zlib.crc32(data) & 0xffffffff != crc or len(data) & 0xffffffff != size:
+        raise CompressionError('crc mismatch in compressed block')
+    return data
+
+def ordered_map(func, items, workers):
+    """like pool.imap but never runs more than 2 x `workers` items ahead
+
+    this is what keeps the memory of the compressor bounded: at most that
+    many blocks are in flight between the reader and the writer.
+    """
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    # the pool's cpu time belongs to the pipeline stage using it
+    func = charge_cpu(current_stage(), func)
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+def _read_blocks(reader, block_size):
+    while True:
+        block = reader.read(block_size)
+        if not block:
+            break
+        yield block
+
+def compressor(level=6, workers=4, block_size=BLOCK_SIZE):
+    """returns a pipeline filter compressing its input to gzip on `workers` threads"""
+    def compress(reader, writer):
+        blocks = ((data, level) for data in _read_blocks(reader, block_size))
+        for member in ordered_map(_marked_block, blocks, workers):
+            writer.write(member)
+        # the end of the stream, which also makes an empty input a valid gzip file
+        writer.write(_marked_block(('', level)))
+    return compress
+
+def _read_members(buffered):
+    """yields our gzip members, or (None, data) once the stream turns out to be foreign"""
+    while True:
+        header = buffered.read(_HEADER.size)
+        if not header:
+            return
+        if len(header) == _HEADER.size:
+            fields = _HEADER.unpack(header)
+            if fields[:4] == (0x1f, 0x8b, 8, 4) and fields[7:10] == (8, 'PM', 4):
+                rest = buffered.read(fields[10] - _HEADER.size)
+                if len(rest) != fields[10] - _HEADER.size:
+                    raise CompressionError('truncated compressed block')
+                yield header + rest
+                continue
+        yield None, header
+        return
+
+class _Buffered(object):
+    def __init__(self, reader):
+        self.reader = reader
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            data = self.reader.read(size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return ''.join(chunks)
+
+def _inflate_stream(prefix, reader, writer):
+    """plain single threaded inflate of any (multi member) gzip stream, which must not end in the middle of a member"""
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = prefix
+    while True:
+        while data:
+            writer.write(d.decompress(data))
+            data = d.unused_data
+            if data:
+                # the next member of a multi member file
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = reader.read(BLOCK_SIZE)
+        if not data:
+            break
+    # zlib of python 2 can't tell whether a member ended: past its end a byte
+    # is left unused, inside it the byte is inflated
+    probe = d.copy()
+    try:
+        probe.decompress('x')
+    except zlib.error:
+        pass
+    if probe.unused_data != 'x':
+        raise CompressionError('truncated gzip stream')
+    writer.write(d.flush())
+
+def decompressor(workers=4):
+    """returns a pipeline filter inflating gzip on `workers` threads
+
+    streams written by `compressor` are inflated block by block in parallel,
+    anything else (say a file from the gzip command) falls back to a plain
+    single threaded inflate.
+    """
+    def decompress(reader, writer):
+        buffered = _Buffered(reader)
+        foreign = []
+        # whether any member was read, they are marked, and the last one read is the end
+        state = {'read': False, 'marked': False, 'ended': False}
+
+        def members():
+            for member in _read_members(buffered):
+                if isinstance(member, tuple):
+                    foreign.append(member[1])
+                    state['read'] = True
+                    return
+                state['read'] = True
+                marked = _HEADER.unpack_from(member)[4] == _MARKED
+                state['marked'] = state['marked'] or marked
+                state['ended'] = marked and _TRAILER.unpack(member[-_TRAILER.size:])[1] == 0
+                yield member
+
+        for data in ordered_map(decompress_block, members(), workers):
+            writer.write(data)
+
+        if not state['read']:
+            raise CompressionError('empty compressed stream, no member and no end marker in it')
+        if state['marked'] and not state['ended']:
+            raise CompressionError('truncated compressed stream, its end marker is missing')
+        if foreign:
+            _inflate_stream(foreign[0], reader, writer)
+    return decompress
+
+class Codec(object):
+    """a compression codec, adds its stages to a pipeline"""
+    name = None
+    extension = None
+
+    def add_compress(self, p, level, workers, long_window=0, block_size=BLOCK_SIZE):
+        raise NotImplementedError
+
+    def add_decompress(self, p, workers):
+        raise NotImplementedError
+
+class GzipCodec(Codec):
+    """in-process multi-threaded gzip, compatible with everything"""
+    name = 'gzip'
+    extension = '.gz'
+
+    def add_compress(self, p, level, workers, long_window=0, block_size=BLOCK_SIZE):
+        p.add_filter(compressor(level, workers, block_size), 'compress')
+
+    def add_decompress(self, p, workers):
+        p.add_filter(decompressor(workers), 'decompress')
+
+class ZstdCodec(Codec):
+    """zstd, multi-threaded and with an optional long matching window"""
+    name = 'zstd'
+    extension = '.zst'
+
+    def add_compress(self, p, level, workers, long_window=0, block_size=BLOCK_SIZE):
+        args = ['zstd', '-c', '-q', '-%d' % (level), '-T%d' % (workers)]
+        if level > 19:
+            args.append('--ultra')
+        if long_window:
+            args.append('--long=%d' % (long_window))
+        p.add_command(args)
+
+    def add_decompress(self, p, workers):
+        # allow the biggest window there is, frames written without --long
+        # don't need it but it costs nothing either.
+        p.add_command(['zstd', '-dc', '-q', '--long=31'])
+
+class Lz4Codec(Codec):
+    """lz4, the fastest of them for incrementals"""
+    name = 'lz4'
+    extension = '.lz4'
+
+    def add_compress(self, p, level, workers, long_window=0, block_size=BLOCK_SIZE):
+        p.add_command(['lz4', '-c', '-q', '-%d' % (level)])
+
+    def add_decompress(self, p, workers):
+        p.add_command(['lz4', '-dc', '-q'])
+
+CODECS = dict([(c.name, c()) for c in (GzipCodec, ZstdCodec, Lz4Codec)])
+
+def get_codec(name):
+    """returns the codec called `name`"""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise CompressionError('unknown compression codec "%s" (use one of %s)' %
+                (name, ', '.join(sorted(CODECS))))
+
+def codec_for_file(path):
+    """guess the codec of `path` from its extension, None if it isn't compressed"""
+    if path.endswith(('.gpg', '.enc')):
+        path = path[:-4]
+    for codec in CODECS.values():
+        if path.endswith(codec.extension):
+            return codec
+    return None
+
+def _metadata_path(artifact):
+    return artifact.rstrip('/') + '.meta'
+
+def write_metadata(artifact, metadata):
+    """atomically write the metadata of `artifact` next to it"""
+    path = _metadata_path(artifact)
+    f = open(path + '.partial', 'w')
+    json.dump(metadata, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(path + '.partial', path)
+
+def read_metadata(artifact):
+    """returns the metadata written with `artifact`, or None for older backups"""
+    try:
+        f = open(_metadata_path(artifact))
+    except IOError:
+        return None
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def is_metadata(path):
+    return path.endswith('.meta')
@@ -0,0 +1,364 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Deduplicated full backups. The dump stream is cut into content-defined
+# chunks and every chunk is stored once in a repository, compressed (and
+# encrypted) on its own and named after the sha256 of its content, or its
+# HMAC-SHA256 under the key of the repository when it is encrypted, so the
+# names don't tell which chunks of a backup are equal to which. A backup is
+# then only a small chunk index listing the chunks of its stream in order, so
+# a day where most tables didn't change writes little more than the index.
+#
+# Chunk boundaries only depend on the bytes right before them, so an insert
+# early in a table moves the boundaries of the chunk it lands in but not of
+# the ones after it. Cut points are looked for at the end of a line or between
+# two rows of an extended INSERT ('),('), where a crc32 of the preceding bytes
+# has its low `mask_bits` bits clear, between `min_size` and `max_size`.
+#
+# Repository layout:
+#
+#   <repository>/chunks/ab/ab12...ef.z[.gpg]
+#   <repository>/key
+#   <repository>/lock
+#   <repository>/users
+#
+# The key chunks are named with is made with an encrypted repository and kept
+# in the clear in `key_file` on the backup host, which can't decrypt. `key`
+# holds it wrapped by gpg and a check value of it, and every chunk index holds
+# the wrapped key too, so restore and fetch unwrap it to verify the chunks.
+#
+# Backups hold a shared lock on the repository until they are in their backup
+# index, garbage collection an exclusive one. A repository can be shared by the targets of a
+# scheduler, `users` lists the backup index of every full_path that stored
+# chunks in it, one path per line, and garbage collection keeps the chunks
+# any of their backups refer to. A repository made before there was a list
+# gets one whose first line is a '!': it may miss users, and garbage is
+# not collected until the list is checked and the line removed.
+
+import os
+import re
+import hmac
+import json
+import base64
+import zlib
+import fcntl
+import hashlib
+import subprocess
+import tempfile
+import logging
+
+import encryption
+from pipeline import BLOCK_SIZE
+from compression import ordered_map
+
+logger = logging.getLogger("PMB LOG")
+
+DEDUP_FORMAT = 'pmb-dedup'
+DEDUP_VERSION = 1
+EXTENSION = '.dedup'
+USERS_NAME = 'users'
+KEY_NAME = 'key'
+KEY_SIZE = 32
+
+_ANCHOR = re.compile(r'\n|\),\(')
+_WINDOW = 64
+
+class DedupError(Exception):
+    """raised when the repository can not store or return a chunk"""
+
+def hash_chunk(chunk, key=None):
+    """the name of `chunk`, its sha256 or its HMAC-SHA256 under `key`"""
+    if key is None:
+        return hashlib.sha256(chunk).hexdigest()
+    return hmac.new(key, chunk, hashlib.sha256).hexdigest()
+
+def _key_check(key):
+    return hmac.new(key, 'pmb dedup key check', hashlib.sha256).hexdigest()
+
+class Chunker(object):
+    """cut a stream into content-defined chunks"""
+
+    def __init__(self, min_size=512 * 1024, mask_bits=13, max_size=8 * 1024 * 1024):
+        self.min_size = min_size
+        self.mask = (1 << mask_bits) - 1
+        self.max_size = max_size
+
+    def _cut(self, buf):
+        for m in _ANCHOR.finditer(buf, self.min_size, self.max_size):
+            end = m.end()
+            if zlib.crc32(buf[end - _WINDOW:end]) & self.mask == 0:
+                return end
+        return self.max_size
+
+    def chunks(self, reader):
+        """yields the chunks of the stream `reader`"""
+        buf = ''
+        eof = False
+        while True:
+            while not eof and len(buf) < self.max_size:
+                block = reader.read(BLOCK_SIZE)
+                if not block:
+                    eof = True
+                    break
+                buf += block
+            if len(buf) <= self.min_size and eof:
+                if buf:
+                    yield buf
+                return
+            cut = self._cut(buf)
+            yield buf[:cut]
+            buf = buf[cut:]
+
+class Repository(object):
+    """the chunk store in `path`
+
+    `level` is the zlib level chunks are compressed with. `encrypt` and
+    `decrypt` are the command lines of the encryption (gpg reading stdin and
+    writing stdout), chunks are stored in the clear when `encrypt` is None.
+    `key_file` holds the key the chunks of an encrypted repository are named
+    with.
+    """
+
+    def __init__(self, path, level=6, encrypt=None, decrypt=None, workers=4, key_file=None):
+        self.path = path
+        self.level = level
+        self.encrypt = encrypt
+        self.decrypt = decrypt
+        self.workers = max(1, workers)
+        self.key_file = key_file
+        self.lock_file = None
+
+    def _chunk_path(self, chunk_id, encrypted):
+        name = chunk_id + '.z'
+        if encrypted:
+            name += '.gpg'
+        return os.path.join(self.path, 'chunks', chunk_id[:2], name)
+
+    def lock(self, exclusive=False):
+        if not os.path.isdir(os.path.join(self.path, 'chunks')):
+            os.makedirs(os.path.join(self.path, 'chunks'))
+            # a new repository knows all of its users
+            open(os.path.join(self.path, USERS_NAME), 'a').close()
+        self.lock_file = open(os.path.join(self.path, 'lock'), 'a')
+        fcntl.flock(self.lock_file, exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH)
+
+    def users(self):
+        """(backup index paths, whether the list is complete), None for a repository without a list"""
+        try:
+            f = open(os.path.join(self.path, USERS_NAME))
+        except IOError:
+            return None
+        try:
+            lines = [line.strip() for line in f if line.strip()]
+        finally:
+            f.close()
+        complete = not [line for line in lines if line.startswith('!')]
+        return [line for line in lines if not line.startswith('!')], complete
+
+    def register(self, index_path):
+        """add the backup index `index_path` to the users of the repository"""
+        index_path = os.path.abspath(index_path)
+        f = open(os.path.join(self.path, USERS_NAME), 'a+')
+        try:
+            # backups registering at once only hold a shared lock on the repository
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            lines = [line.strip() for line in f]
+            if index_path not in lines:
+                if not lines and os.listdir(os.path.join(self.path, 'chunks')):
+                    f.write('! chunks were stored before this list, add the backup index of every target using the repository and remove this line\n')
+                f.write(index_path + '\n')
+        finally:
+            f.close()
+
+    def chunk_key(self):
+        """(key, wrapped key) new chunks are named with, (None, None) without encryption
+
+        the first backup into an encrypted repository makes the key, or takes
+        the one in `key_file` when this host already has one.
+        """
+        if self.encrypt is None:
+            return None, None
+        if self.key_file is None:
+            raise DedupError('an encrypted repository needs a key_file')
+
+        key = None
+        try:
+            # O_EXCL: backups starting at once all keep the same key
+            fd = os.open(self.key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        except OSError:
+            pass
+        else:
+            key = os.urandom(KEY_SIZE)
+            os.write(fd, key)
+            os.close(fd)
+        if key is None:
+            f = open(self.key_file, 'rb')
+            key = f.read()
+            f.close()
+        if len(key) != KEY_SIZE:
+            raise DedupError('%s is %d bytes instead of %d' % (self.key_file, len(key), KEY_SIZE))
+
+        path = os.path.join(self.path, KEY_NAME)
+        if not os.path.exists(path):
+            record = {'wrapped': base64.b64encode(self._run(self.encrypt, key)), 'check': _key_check(key)}
+            write_index(path, record)
+        f = open(path)
+        try:
+            record = json.load(f)
+        finally:
+            f.close()
+        if record['check'] != _key_check(key):
+            raise DedupError('%s is not the key the chunks of %s are named with, copy it from the host that made the repository' %
+                    (self.key_file, self.path))
+        return key, base64.b64decode(record['wrapped'])
+
+    def unlock(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def _run(self, args, data):
+        process = subprocess.Popen(args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                close_fds=True)
+        out, err = process.communicate(data)
+        if process.returncode != 0:
+            raise DedupError('%s exited with %d: %s' % (args[0], process.returncode, err.strip()))
+        return out
+
+    def _store(self, item):
+        chunk_id, data = item
+        path = self._chunk_path(chunk_id, self.encrypt is not None)
+        if os.path.exists(path):
+            return False
+        data = zlib.compress(data, self.level)
+        if self.encrypt is not None:
+            data = self._run(self.encrypt, data)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # another worker made it first
+                pass
+        # the same chunk can be stored by two workers at once
+        fd, partial = tempfile.mkstemp(suffix='.partial', dir=os.path.dirname(path))
+        f = os.fdopen(fd, 'wb')
+        f.write(data)
+        f.close()
+        os.rename(partial, path)
+        return True
+
+    def _load(self, item):
+        chunk_id, size, encrypted, key = item
+        path = self._chunk_path(chunk_id, encrypted)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            raise DedupError('chunk %s is missing from %s' % (chunk_id, self.path))
+        data = f.read()
+        f.close()
+        if encrypted:
+            data = self._run(self.decrypt, data)
+        data = zlib.decompress(data)
+        if len(data) != size or hash_chunk(data, key) != chunk_id:
+            raise DedupError('chunk %s in %s is corrupt' % (chunk_id, self.path))
+        return data
+
+    def writer(self, index, chunker):
+        """returns a pipeline filter storing its input in the repository
+
+        the ids and sizes of the chunks are appended to `index['chunks']`,
+        and the totals are added to `index` once the stream is done. The
+        wrapped key of an encrypted repository goes in `index['key']`.
+        """
+        def store(reader, writer):
+            digest = hashlib.sha256()
+            stored = [0, 0]
+            key, wrapped = self.chunk_key()
+            if key is not None:
+                index['key'] = base64.b64encode(wrapped)
+
+            def items():
+                for chunk in chunker.chunks(reader):
+                    digest.update(chunk)
+                    chunk_id = hash_chunk(chunk, key)
+                    index['chunks'].append([chunk_id, len(chunk)])
+                    yield chunk_id, chunk
+
+            for new in ordered_map(self._store, items(), self.workers):
+                stored[int(new)] += 1
+
+            index['size'] = sum([c[1] for c in index['chunks']])
+            index['sha256'] = digest.hexdigest()
+            index['new_chunks'] = stored[1]
+            logger.info('Stored %d new chunks, %d were in the repository already' % (stored[1], stored[0]))
+        return store
+
+    def read(self, index, writer):
+        """write the stream of the chunk index `index` to `writer`"""
+        encrypted = index.get('encrypted', False)
+        key = None
+        if index.get('key'):
+            try:
+                key = encryption.unwrap_key(self.decrypt, base64.b64decode(index['key']))
+            except encryption.EncryptionError, e:
+                raise DedupError('the key the chunks are named with can not be unwrapped: %s' % (e))
+        items = ((chunk_id, size, encrypted, key) for chunk_id, size in index['chunks'])
+        for data in ordered_map(self._load, items, self.workers):
+            writer.write(data)
+
+    def collect_garbage(self, indexes):
+        """remove the chunks none of the chunk `indexes` refer to, returns how many"""
+        referenced = set()
+        for index in indexes:
+            referenced.update([c[0] for c in index['chunks']])
+
+        removed = 0
+        for root, dirs, files in os.walk(os.path.join(self.path, 'chunks')):
+            for name in files:
+                if name.split('.')[0] not in referenced:
+                    os.remove(os.path.join(root, name))
+                    removed += 1
+        return removed
+
+def new_index(repository, metadata):
+    return {
+        'format': DEDUP_FORMAT,
+        'version': DEDUP_VERSION,
+        'repository': os.path.abspath(repository),
+        'encrypted': bool(metadata.get('encrypted')),
+        'level': metadata.get('level'),
+        'chunks': [],
+    }
+
+def write_index(path, index):
+    """atomically write the chunk index of a backup"""
+    f = open(path + '.partial', 'w')
+    json.dump(index, f, separators=(',', ':'))
+    f.close()
+    os.rename(path + '.partial', path)
+
+def read_index(path):
+    f = open(path)
+    try:
+        index = json.load(f)
+    finally:
+        f.close()
+    if index.get('format') != DEDUP_FORMAT:
+        raise DedupError('%s is not a chunk index' % (path))
+    return index
+
+def chunk_files(index):
+    """the paths of the chunks of `index`, relative to the repository"""
+    suffix = '.z'
+    if index.get('encrypted'):
+        suffix += '.gpg'
+    seen = set()
+    files = []
+    for chunk_id, size in index['chunks']:
+        if chunk_id not in seen:
+            seen.add(chunk_id)
+            files.append(os.path.join('chunks', chunk_id[:2], chunk_id + suffix))
+    return files
@@ -0,0 +1,326 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Chunked encryption. gpg encrypts a stream on a single thread and was the
+# slowest stage of an encrypted backup. Here every artifact gets a random
+# AES-256 data key of its own, which gpg encrypts once with the [Encryption]
+# key_name public key, and the stream is cut into chunks that are encrypted
+# with AES-256-GCM on a thread pool (OpenSSL's libcrypto through ctypes, which
+# lets go of the GIL while it works), so encryption keeps up with the
+# multi-threaded compressor. Decryption unwraps the key with gpg once and
+# decrypts the chunks in parallel too, and as every chunk stands on its own it
+# can start at any of them.
+#
+# File layout (`.enc`):
+#
+#   header       'PMBCRYPT', version, chunk size, length of the wrapped key
+#   salt         16 random bytes
+#   wrapped key  the data key encrypted by gpg
+#   chunks       ciphertext of `chunk size` bytes (the last one shorter)
+#                followed by its 16 byte GCM tag
+#
+# The files of a chunked backup directory share their data key, so the chunks
+# of a file are encrypted with a key of its own, the HMAC-SHA256 of its salt
+# under the data key: two files never use the same key and nonce. Chunk i is
+# encrypted with the nonce i and authenticates its number and whether it is
+# the last one, so chunks can't be reordered, dropped or cut off the end
+# without decryption failing. Version 1 files had no salt and used the data
+# key itself, they are still read.
+
+import os
+import hmac
+import struct
+import hashlib
+import threading
+import subprocess
+import ctypes
+import ctypes.util
+
+from compression import ordered_map
+
+MAGIC = 'PMBCRYPT'
+VERSION = 2
+EXTENSION = '.enc'
+CHUNK_SIZE = 256 * 1024
+KEY_SIZE = 32
+TAG_SIZE = 16
+SALT_SIZE = 16
+
+# magic, version, chunk size, wrapped key length
+_HEADER = struct.Struct('>8sB3xII')
+# chunk number, last chunk
+_AAD = struct.Struct('>QB')
+_NONCE = struct.Struct('>4xQ')
+
+# EVP_CIPHER_CTX_ctrl commands
+_GCM_SET_IVLEN = 0x9
+_GCM_GET_TAG = 0x10
+_GCM_SET_TAG = 0x11
+
+_libcrypto = None
+_lock = threading.Lock()
+# the data keys unwrapped so far, by their wrapped form
+_keys = {}
+_keys_lock = threading.Lock()
+
+class EncryptionError(Exception):
+    """raised when an artifact can not be encrypted or decrypted"""
+
+def load():
+    """libcrypto with the signatures of the functions used here, raises EncryptionError without it"""
+    global _libcrypto
+    _lock.acquire()
+    try:
+        if _libcrypto is not None:
+            return _libcrypto
+        name = ctypes.util.find_library('crypto')
+        if name is None:
+            raise EncryptionError('chunked encryption needs libcrypto (OpenSSL), it was not found')
+        lib = ctypes.CDLL(name)
+        p, i = ctypes.c_void_p, ctypes.c_int
+        lib.EVP_CIPHER_CTX_new.restype = p
+        lib.EVP_CIPHER_CTX_new.argtypes = []
+        lib.EVP_CIPHER_CTX_free.argtypes = [p]
+        lib.EVP_aes_256_gcm.restype = p
+        lib.EVP_aes_256_gcm.argtypes = []
+        lib.EVP_CIPHER_CTX_ctrl.argtypes = [p, i, i, p]
+        for f in (lib.EVP_EncryptInit_ex, lib.EVP_DecryptInit_ex):
+            f.argtypes = [p, p, p, ctypes.c_char_p, ctypes.c_char_p]
+        for f in (lib.EVP_EncryptUpdate, lib.EVP_DecryptUpdate):
+            f.argtypes = [p, p, ctypes.POINTER(i), ctypes.c_char_p, i]
+        for f in (lib.EVP_EncryptFinal_ex, lib.EVP_DecryptFinal_ex):
+            f.argtypes = [p, p, ctypes.POINTER(i)]
+        _libcrypto = lib
+        return lib
+    finally:
+        _lock.release()
+
+def _check(result, what):
+    if result != 1:
+        raise EncryptionError('%s failed' % (what))
+
+def _gcm(encrypt, key, number, last, data, tag=None):
+    lib = load()
+    init = encrypt and lib.EVP_EncryptInit_ex or lib.EVP_DecryptInit_ex
+    update = encrypt and lib.EVP_EncryptUpdate or lib.EVP_DecryptUpdate
+    ctx = lib.EVP_CIPHER_CTX_new()
+    if not ctx:
+        raise EncryptionError('EVP_CIPHER_CTX_new failed')
+    try:
+        _check(init(ctx, lib.EVP_aes_256_gcm(), None, None, None), 'cipher setup')
+        _check(lib.EVP_CIPHER_CTX_ctrl(ctx, _GCM_SET_IVLEN, _NONCE.size, None), 'nonce setup')
+        _check(init(ctx, None, None, key, _NONCE.pack(number)), 'key setup')
+        n = ctypes.c_int(0)
+        aad = _AAD.pack(number, int(last))
+        _check(update(ctx, None, ctypes.byref(n), aad, len(aad)), 'authenticating chunk %d' % (number))
+        out = ctypes.create_string_buffer(len(data) + TAG_SIZE)
+        _check(update(ctx, ctypes.addressof(out), ctypes.byref(n), data, len(data)), 'chunk %d' % (number))
+        size = n.value
+        if encrypt:
+            _check(lib.EVP_EncryptFinal_ex(ctx, ctypes.addressof(out) + size, ctypes.byref(n)), 'chunk %d' % (number))
+            size += n.value
+            digest = ctypes.create_string_buffer(TAG_SIZE)
+            _check(lib.EVP_CIPHER_CTX_ctrl(ctx, _GCM_GET_TAG, TAG_SIZE, ctypes.addressof(digest)), 'tag of chunk %d' % (number))
+            return out.raw[:size] + digest.raw
+        digest = ctypes.create_string_buffer(tag, TAG_SIZE)
+        _check(lib.EVP_CIPHER_CTX_ctrl(ctx, _GCM_SET_TAG, TAG_SIZE, ctypes.addressof(digest)), 'tag of chunk %d' % (number))
+        if lib.EVP_DecryptFinal_ex(ctx, ctypes.addressof(out) + size, ctypes.byref(n)) != 1:
+            raise EncryptionError('chunk %d is corrupt or was tampered with' % (number))
+        return out.raw[:size + n.value]
+    finally:
+        lib.EVP_CIPHER_CTX_free(ctx)
+
+def seal(key, number, last, data):
+    """encrypt `data` as chunk `number` (the last one when `last`), returns it with its tag"""
+    return _gcm(True, key, number, last, data)
+
+def unseal(key, number, last, chunk):
+    """decrypt and authenticate a chunk written by seal"""
+    if len(chunk) < TAG_SIZE:
+        raise EncryptionError('chunk %d is truncated' % (number))
+    return _gcm(False, key, number, last, chunk[:-TAG_SIZE], chunk[-TAG_SIZE:])
+
+def _seal_item(item):
+    return seal(*item)
+
+def _unseal_item(item):
+    return unseal(*item)
+
+def _run(args, data):
+    process = subprocess.Popen(args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True)
+    out, err = process.communicate(data)
+    if process.returncode != 0:
+        raise EncryptionError('%s exited with %d: %s' % (args[0], process.returncode, err.strip()))
+    return out
+
+def _read_exactly(reader, size):
+    chunks = []
+    while size > 0:
+        data = reader.read(size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+def _chunks(reader, size):
+    """yields (number, last, data) for the pieces of `size` bytes of `reader`
+
+    there is always at least one, an empty stream is an empty last chunk.
+    """
+    number = 0
+    data = _read_exactly(reader, size)
+    while True:
+        following = ''
+        if len(data) == size:
+            following = _read_exactly(reader, size)
+        yield number, not following, data
+        if not following:
+            return
+        data = following
+        number += 1
+
+class DataKey(object):
+    """the data key of an artifact, made and wrapped with the command line `wrap` when first needed
+
+    the files of a chunked backup directory share one, so gpg runs once per backup.
+    """
+
+    def __init__(self, wrap):
+        self.wrap = wrap
+        self.key = None
+        self.wrapped = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """(key, wrapped key)"""
+        self.lock.acquire()
+        try:
+            if self.key is None:
+                key = os.urandom(KEY_SIZE)
+                self.wrapped = _run(self.wrap, key)
+                self.key = key
+            return self.key, self.wrapped
+        finally:
+            self.lock.release()
+
+def unwrap_key(unwrap, wrapped):
+    """the data key `wrapped`, decrypted with the command line `unwrap` once per run"""
+    _keys_lock.acquire()
+    try:
+        if wrapped not in _keys:
+            key = _run(unwrap, wrapped)
+            if len(key) != KEY_SIZE:
+                raise EncryptionError('the data key is %d bytes instead of %d' % (len(key), KEY_SIZE))
+            _keys[wrapped] = key
+        return _keys[wrapped]
+    finally:
+        _keys_lock.release()
+
+def file_key(key, salt):
+    """the key the chunks of a file with `salt` are encrypted with, the data key itself without one"""
+    if salt is None:
+        return key
+    return hmac.new(key, 'pmb file key' + salt, hashlib.sha256).digest()
+
+def read_header(f):
+    """(chunk size, wrapped key, salt, size of the header) of the encrypted file `f`
+
+    the salt is None in files of version 1.
+    """
+    name = getattr(f, 'name', 'stream')
+    header = _read_exactly(f, _HEADER.size)
+    if len(header) != _HEADER.size:
+        raise EncryptionError('%s is not an encrypted artifact' % (name))
+    magic, version, chunk_size, wrapped_size = _HEADER.unpack(header)
+    if magic != MAGIC:
+        raise EncryptionError('%s is not an encrypted artifact' % (name))
+    if version not in (1, VERSION):
+        raise EncryptionError('%s is encrypted with version %d of the format' % (name, version))
+    size = _HEADER.size + wrapped_size
+    salt = None
+    if version > 1:
+        salt = _read_exactly(f, SALT_SIZE)
+        size += SALT_SIZE
+        if len(salt) != SALT_SIZE:
+            raise EncryptionError('%s is truncated' % (name))
+    wrapped = _read_exactly(f, wrapped_size)
+    if len(wrapped) != wrapped_size:
+        raise EncryptionError('%s is truncated' % (name))
+    return chunk_size, wrapped, salt, size
+
+def encryptor(wrap, chunk_size=CHUNK_SIZE, workers=4, data_key=None):
+    """returns a pipeline filter encrypting its input on `workers` threads
+
+    `wrap` is the command line encrypting the data key (gpg reading stdin
+    and writing stdout). the key is a new one unless a DataKey is given.
+    """
+    load()
+    def encrypt(reader, writer):
+        key, wrapped = (data_key or DataKey(wrap)).get()
+        salt = os.urandom(SALT_SIZE)
+        writer.write(_HEADER.pack(MAGIC, VERSION, chunk_size, len(wrapped)) + salt + wrapped)
+        key = file_key(key, salt)
+        items = ((key, number, last, data) for number, last, data in _chunks(reader, chunk_size))
+        for chunk in ordered_map(_seal_item, items, max(1, workers)):
+            writer.write(chunk)
+    return encrypt
+
+def decryptor(unwrap, workers=4):
+    """returns a pipeline filter decrypting its input on `workers` threads
+
+    `unwrap` is the command line decrypting the data key.
+    """
+    load()
+    def decrypt(reader, writer):
+        chunk_size, wrapped, salt, start = read_header(reader)
+        key = file_key(unwrap_key(unwrap, wrapped), salt)
+        items = ((key, number, last, data) for number, last, data in _chunks(reader, chunk_size + TAG_SIZE))
+        for data in ordered_map(_unseal_item, items, max(1, workers)):
+            writer.write(data)
+    return decrypt
+
+class Reader(object):
+    """random access to the decrypted content of the encrypted file `path`
+
+    its data key is unwrapped with the command line `unwrap` once, reads
+    only decrypt the chunks they need and can run on several threads.
+    """
+
+    def __init__(self, path, unwrap):
+        load()
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self.chunk_size, wrapped, salt, self.start = read_header(f)
+        finally:
+            f.close()
+        self.key = file_key(unwrap_key(unwrap, wrapped), salt)
+        stored = os.path.getsize(path) - self.start
+        self.chunks = max(1, (stored + self.chunk_size + TAG_SIZE - 1) // (self.chunk_size + TAG_SIZE))
+
+    def read(self, offset, size):
+        """`size` bytes of the content from `offset`"""
+        if size <= 0:
+            return ''
+        stored = self.chunk_size + TAG_SIZE
+        first = offset // self.chunk_size
+        last = (offset + size - 1) // self.chunk_size
+        f = open(self.path, 'rb')
+        try:
+            f.seek(self.start + first * stored)
+            data = f.read((last - first + 1) * stored)
+        finally:
+            f.close()
+        plain = []
+        for number in range(first, last + 1):
+            chunk = data[(number - first) * stored:(number - first + 1) * stored]
+            plain.append(unseal(self.key, number, number == self.chunks - 1, chunk))
+        skip = offset - first * self.chunk_size
+        plain = ''.join(plain)[skip:skip + size]
+        if len(plain) != size:
+            raise EncryptionError('%s is truncated' % (self.path))
+        return plain
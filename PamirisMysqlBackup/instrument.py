@@ -0,0 +1,207 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Run reports. Every pipeline stage records what it used (see pipeline.py),
+# the run report adds that up per stage over a whole backup, restore or fetch,
+# together with the steps that don't run in a pipeline (staging binary logs,
+# transferring files...). Parallel dumps and loads run the same stage many
+# times at once, their wall times are added up like their cpu times, so they
+# say how much work the stage was rather than how long it took.
+#
+# The report is written as json, as a Prometheus textfile for node_exporter's
+# textfile collector, and as a table for --profile.
+
+import os
+import json
+import time
+import socket
+import resource
+import threading
+
+class RunReport(object):
+    """what the stages of the run of `action` used
+
+    `labels` are extra labels identifying the run, the kind of backup or the
+    target.
+    """
+
+    def __init__(self, action, labels=None):
+        self.action = action
+        self.labels = labels or {}
+        self.started = time.time()
+        self.finished = None
+        self.status = None
+        self.stages = []
+        self.by_name = {}
+        self.lock = threading.Lock()
+
+    def _stage(self, name):
+        stage = self.by_name.get(name)
+        if stage is None:
+            stage = {
+                'name': name,
+                'runs': 0,
+                'failed': 0,
+                'wall': 0.0,
+                'user': 0.0,
+                'system': 0.0,
+                'bytes_in': None,
+                'bytes_out': None,
+                'max_rss': None,
+            }
+            self.by_name[name] = stage
+            self.stages.append(stage)
+        return stage
+
+    def add(self, stats):
+        """add what one run of a stage used, a dict like pipeline stages report"""
+        self.lock.acquire()
+        try:
+            stage = self._stage(stats['name'])
+            stage['runs'] += 1
+            stage['failed'] += int(bool(stats.get('failed')))
+            stage['wall'] += stats.get('wall') or 0.0
+            stage['user'] += stats.get('user') or 0.0
+            stage['system'] += stats.get('system') or 0.0
+            for key in ('bytes_in', 'bytes_out'):
+                if stats.get(key) is not None:
+                    stage[key] = (stage[key] or 0) + stats[key]
+            if stats.get('max_rss') is not None:
+                stage['max_rss'] = max(stage['max_rss'] or 0, stats['max_rss'])
+        finally:
+            self.lock.release()
+
+    def add_pipeline(self, pipeline):
+        """pipeline.observe() callback"""
+        for stats in pipeline.stats:
+            self.add(stats)
+
+    def start(self, name):
+        """start timing a step that isn't a pipeline, returns the token for stop()"""
+        return (name, time.time(), _cpu())
+
+    def stop(self, token, bytes_in=None, bytes_out=None):
+        """the step started with start() is done, it read `bytes_in` and wrote `bytes_out`
+
+        its cpu time is the time of the whole process and its children
+        meanwhile, so it is only accurate when nothing else ran.
+        """
+        name, started, cpu = token
+        now = _cpu()
+        self.add({
+            'name': name,
+            'wall': time.time() - started,
+            'user': now[0] - cpu[0],
+            'system': now[1] - cpu[1],
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+        })
+
+    def finish(self, status):
+        """the run is over, `status` is its exit status"""
+        self.finished = time.time()
+        self.status = status
+
+    def data(self):
+        stages = []
+        for stage in self.stages:
+            stage = dict(stage)
+            stage['cpu'] = stage['user'] + stage['system']
+            stage['ratio'] = None
+            if stage['bytes_in'] and stage['bytes_out']:
+                stage['ratio'] = float(stage['bytes_in']) / stage['bytes_out']
+            stage['throughput'] = None
+            if stage['wall'] > 0 and stage['bytes_in'] is not None:
+                stage['throughput'] = stage['bytes_in'] / stage['wall']
+            stages.append(stage)
+        return {
+            'action': self.action,
+            'labels': self.labels,
+            'host': socket.gethostname(),
+            'started': self.started,
+            'duration': (self.finished or time.time()) - self.started,
+            'status': self.status,
+            'stages': stages,
+        }
+
+    def name(self):
+        """file name of the report, without extension"""
+        parts = [self.action] + [str(self.labels[k]) for k in sorted(self.labels)]
+        return 'pmb_' + '_'.join([p.replace('/', '_') for p in parts])
+
+    def write_json(self, directory):
+        """write the report into `directory`, one file per run, returns its path"""
+        path = os.path.join(directory, '%s_%s.json' %
+                (self.name(), time.strftime('%Y%m%d_%H%M%S', time.localtime(self.started))))
+        _write_atomically(path, json.dumps(self.data(), indent=1, sort_keys=True) + '\n')
+        return path
+
+    def write_prometheus(self, directory):
+        """write the report as `directory`/pmb_<action>....prom, replacing the last run's"""
+        data = self.data()
+        labels = dict(self.labels)
+        labels['action'] = self.action
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for extra, value in samples:
+                if value is None:
+                    continue
+                sample_labels = dict(labels)
+                sample_labels.update(extra)
+                lines.append('%s{%s} %s' % (name, _labels(sample_labels), repr(float(value))))
+
+        metric('pmb_run_timestamp_seconds', 'gauge', 'When the last run started.',
+                [({}, data['started'])])
+        metric('pmb_run_duration_seconds', 'gauge', 'How long the last run took.',
+                [({}, data['duration'])])
+        metric('pmb_run_success', 'gauge', 'Whether the last run succeeded.',
+                [({}, int(data['status'] == 0))])
+
+        stages = data['stages']
+        for key, name, help in (
+                ('wall', 'pmb_stage_wall_seconds', 'Wall time of a stage, summed over its runs.'),
+                ('cpu', 'pmb_stage_cpu_seconds', 'User and system cpu time of a stage.'),
+                ('bytes_in', 'pmb_stage_bytes_in', 'Bytes a stage read.'),
+                ('bytes_out', 'pmb_stage_bytes_out', 'Bytes a stage wrote.'),
+                ('ratio', 'pmb_stage_ratio', 'Bytes in per byte out, the compression ratio of a compressor.'),
+                ('max_rss', 'pmb_stage_max_rss_kilobytes', 'Peak resident memory of a stage command.')):
+            metric(name, 'gauge', help, [({'stage': s['name']}, s[key]) for s in stages])
+
+        path = os.path.join(directory, self.name() + '.prom')
+        _write_atomically(path, '\n'.join(lines) + '\n')
+        return path
+
+    def profile(self):
+        """the per stage breakdown as lines of a table"""
+        lines = ['%-24s %5s %9s %9s %12s %12s %7s %9s' %
+                ('stage', 'runs', 'wall s', 'cpu s', 'bytes in', 'bytes out', 'ratio', 'MB/s')]
+        for s in self.data()['stages']:
+            lines.append('%-24s %5d %9.2f %9.2f %12s %12s %7s %9s' % (
+                    s['name'][:24], s['runs'], s['wall'], s['cpu'],
+                    _value(s['bytes_in']), _value(s['bytes_out']),
+                    s['ratio'] is not None and '%.2f' % (s['ratio']) or '-',
+                    s['throughput'] is not None and '%.1f' % (s['throughput'] / 1048576) or '-'))
+        return lines
+
+def _cpu():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime)
+
+def _value(value):
+    if value is None:
+        return '-'
+    return str(value)
+
+def _labels(labels):
+    return ','.join(['%s="%s"' % (k, str(labels[k]).replace('\\', '\\\\').replace('"', '\\"'))
+            for k in sorted(labels)])
+
+def _write_atomically(path, data):
+    # the textfile collector must never see half a file
+    f = open(path + '.partial', 'w')
+    f.write(data)
+    f.close()
+    os.rename(path + '.partial', path)
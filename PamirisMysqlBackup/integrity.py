@@ -0,0 +1,176 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Backup verification. A damaged artifact or a hole in the binary log
+# coordinates otherwise only shows when a restore fails halfway through.
+# `pmb.py verify` checks the backups in the index without restoring them:
+#
+#   * every file of every backup is there, has the size and the sha256 that
+#     were recorded when it was written (see backupindex.artifact_files)
+#   * the chunks a deduplicated backup refers to are in its repository
+#   * the incrementals of a chain carry on exactly where the backup before
+#     them ended, no binary log events are missing or replayed twice
+#
+# The files are read by `workers` threads, one block at a time, so memory
+# stays bounded however big and however many the artifacts are. hashlib lets
+# go of the GIL while it hashes, the threads really run side by side.
+
+import os
+import Queue
+import threading
+import logging
+
+import dedup
+from pipeline import file_digest
+
+logger = logging.getLogger("PMB LOG")
+
+def _sequence(name):
+    return int(name.rsplit('.', 1)[1])
+
+def check_files(files, workers=4):
+    """check the size and sha256 of `files` with `workers` threads
+
+    `files` are dicts with the `path` to check, the `size` and `sha256`
+    recorded for it (sha256 None when none was). returns a list of problems,
+    and the number of bytes read.
+    """
+    jobs = Queue.Queue()
+    for f in files:
+        jobs.put(f)
+    problems = []
+    read = [0]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                f = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            problem = None
+            try:
+                size = os.path.getsize(f['path'])
+                if size != f['size']:
+                    problem = '%s is %d bytes, %d were written' % (f['path'], size, f['size'])
+                elif f.get('sha256') is not None:
+                    digest = file_digest(f['path'])
+                    lock.acquire()
+                    read[0] += size
+                    lock.release()
+                    if digest != f['sha256']:
+                        problem = '%s: sha256 %s does not match the one recorded (%s)' % (f['path'], digest, f['sha256'])
+            except (IOError, OSError), e:
+                problem = '%s: %s' % (f['path'], e.strerror or e)
+            if problem is not None:
+                lock.acquire()
+                problems.append(problem)
+                lock.release()
+
+    threads = [threading.Thread(target=work) for i in range(min(max(1, workers), len(files)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(problems), read[0]
+
+def check_chunks(index_path, repository=None):
+    """problems with the chunks of the chunk index `index_path`, they are only looked for
+
+    `repository` is where the chunks are, the one the index names by default.
+    """
+    try:
+        index = dedup.read_index(index_path)
+    except (IOError, ValueError, dedup.DedupError), e:
+        return ['%s: %s' % (index_path, e)]
+    repository = repository or index['repository']
+    missing = [name for name in dedup.chunk_files(index)
+            if not os.path.exists(os.path.join(repository, name))]
+    if missing:
+        return ['%d of the chunks of %s are missing from %s, %s first' %
+                (len(missing), os.path.basename(index_path), repository, missing[0])]
+    return []
+
+def _closing_event(name):
+    # the rotate event at the end of a log (header, position, name of the next
+    # log, checksum) holds no transaction, no backup has to include it
+    return 19 + 8 + len(name) + 4
+
+class Coordinates(object):
+    """binary log coordinates as (sequence, position), with the catalog to know where logs end
+
+    the end of a closed log is the same point as the start of the next one
+    (ignoring the logs a restore wrote), `catalog` may be None when it isn't
+    known. `name` is the name of the logs without the sequence.
+    """
+
+    def __init__(self, catalog=None, name='mysql-bin'):
+        self.name = name
+        self.entries = {}
+        if catalog is not None:
+            for entry in catalog.entries:
+                self.entries[entry['sequence']] = entry
+
+    def normalize(self, sequence, position):
+        """the coordinate as the start of the next log when it is at the end of its log"""
+        while True:
+            entry = self.entries.get(sequence)
+            if entry is None:
+                return (sequence, position)
+            if entry.get('ignored') and position <= 4:
+                # written by a restore, never backed up
+                sequence, position = sequence + 1, 4
+            elif entry['closed'] and position >= entry['end_position'] - _closing_event(entry['name']):
+                sequence, position = sequence + 1, 4
+            else:
+                return (sequence, position)
+
+    def span(self, entry):
+        """((start), (end)) of the incremental `entry`, start None when it isn't known"""
+        binlog = entry.get('binlog') or {}
+        if 'start' in binlog:
+            # a stream segment, part of one log
+            sequence = _sequence(binlog['file'])
+            return (self.normalize(sequence, binlog['start']),
+                    self.normalize(sequence, binlog['position']))
+        # a whole number of closed logs
+        end = self.normalize(_sequence(binlog['file']) + 1, 4)
+        if not binlog.get('logs'):
+            return None, end
+        return self.normalize(_sequence(binlog['logs'][0]), 4), end
+
+    def format(self, coordinate):
+        return '%s.%06d:%d' % (self.name, coordinate[0], coordinate[1])
+
+def check_chain(chain, coordinates):
+    """problems with the binary log coordinates of the incrementals of `chain`"""
+    full = chain['full']
+    if not full.get('binlog'):
+        if chain['incrementals']:
+            return ['%s does not record where in the binary logs it was taken, its incrementals can not be checked' %
+                    (full['file'])]
+        return []
+
+    problems = []
+    start = full['binlog']
+    expected = coordinates.normalize(_sequence(start['file']), start['position'])
+    previous = full['file']
+    for inc in chain['incrementals']:
+        if not inc.get('binlog'):
+            problems.append('%s does not record its binary log coordinates' % (inc['file']))
+            expected = None
+            continue
+        begins, ends = coordinates.span(inc)
+        if expected is not None and begins is not None and begins != expected:
+            if previous == full['file'] and begins == (expected[0], 4):
+                # only the header of the log the full backup started in
+                pass
+            elif begins > expected:
+                problems.append('binary log events from %s are missing between %s and %s (it starts at %s)' %
+                        (coordinates.format(expected), previous, inc['file'], coordinates.format(begins)))
+            else:
+                problems.append('%s starts at %s, before %s ends (%s), events are replayed twice' %
+                        (inc['file'], coordinates.format(begins), previous, coordinates.format(expected)))
+        expected = ends
+        previous = inc['file']
+    return problems
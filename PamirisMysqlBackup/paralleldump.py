@@ -0,0 +1,398 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Parallel full dumps. The tables of the databases being backed up are split
+# into primary key ranges and dumped by a pool of workers. Every worker holds
+# its own mysql session and all of the sessions start their transaction while
+# a global read lock is held, so they all see the same consistent snapshot.
+#
+# A chunked backup is a directory holding the schema, one file per chunk, the
+# triggers and a manifest.json describing the order the files have to be
+# loaded in. The triggers come last so they don't fire on the rows restored.
+# The routines stay in the schema, the views created there may call them.
+
+import os
+import json
+import time
+import uuid
+import Queue
+import tempfile
+import threading
+import subprocess
+import logging
+
+import pipeline
+
+MANIFEST = 'manifest.json'
+FORMAT = 'pmb-chunked'
+
+# schemas that are never part of an --all-databases parallel dump
+SYSTEM_DATABASES = ('information_schema', 'performance_schema', 'sys', 'mysql')
+
+# primary key types that can be split into ranges
+INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint')
+
+# rows are grouped into extended inserts of about this many bytes
+INSERT_SIZE = 1024 * 1024
+
+logger = logging.getLogger("PMB LOG")
+
+class ParallelDumpError(Exception):
+    """raised when a parallel dump can not be completed"""
+
+def quote_name(name):
+    """quote a mysql identifier"""
+    return '`%s`' % (name.replace('`', '``'))
+
+def quote_string(value):
+    """quote a value as a mysql string literal"""
+    return "'%s'" % (value.replace('\\', '\\\\').replace("'", "\\'"))
+
+class MysqlSession(object):
+    """a persistent mysql client session driven through its stdin
+
+    every statement is followed by a select of a random marker, the output of
+    the statement is everything up to the line holding the marker. this lets
+    one session run many queries inside a single transaction.
+    """
+
+    def __init__(self, client_args):
+        self.marker = 'pmb-end-%s' % (uuid.uuid4().hex)
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(client_args +
+                ['--batch', '--raw', '--skip-column-names', '--unbuffered'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=self.stderr,
+                close_fds=True)
+
+    def _send(self, sql):
+        try:
+            self.process.stdin.write("%s;\nSELECT '%s';\n" % (sql.rstrip().rstrip(';'), self.marker))
+            self.process.stdin.flush()
+        except IOError:
+            self._fail(sql)
+
+    def _fail(self, sql):
+        self.process.wait()
+        self.stderr.seek(0)
+        raise ParallelDumpError('mysql session failed running "%s": %s' %
+                (sql[:200], self.stderr.read().strip()))
+
+    def stream(self, sql, callback):
+        """run `sql` and call `callback` with every line of output"""
+        self._send(sql)
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                self._fail(sql)
+            line = line.rstrip('\n')
+            if line == self.marker:
+                break
+            callback(line)
+
+    def query(self, sql):
+        """run `sql` and return its rows as lists of columns"""
+        rows = []
+        self.stream(sql, lambda line: rows.append(line.split('\t')))
+        return rows
+
+    def execute(self, sql):
+        """run `sql`, ignoring any output"""
+        self.stream(sql, lambda line: None)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+        self.stderr.close()
+
+class Chunk(object):
+    """a primary key range of a table"""
+
+    def __init__(self, database, table, columns, where, index, estimated_rows):
+        self.database = database
+        self.table = table
+        self.columns = columns
+        self.where = where
+        self.index = index
+        self.estimated_rows = estimated_rows
+        self.file = None
+        self.rows = 0
+
+    def select(self):
+        """the statement producing one row tuple, ready to be inserted, per line"""
+        # QUOTE() leaves new lines alone, escaping them keeps one row per line
+        values = ", ',', ".join(
+                ["REPLACE(REPLACE(QUOTE(%s), '\\n', '\\\\n'), '\\r', '\\\\r')" % (quote_name(c))
+                 for c in self.columns])
+        sql = "SELECT CONCAT('(', %s, ')') FROM %s.%s" % \
+                (values, quote_name(self.database), quote_name(self.table))
+        if self.where:
+            sql += ' WHERE %s' % (self.where)
+        return sql
+
+class ParallelDump(object):
+    """dump `databases` into the chunked backup directory `output_dir`
+
+    `client_args` is the mysql command line (user, host and password) used
+    for the sessions and `dump_args` the mysqldump one used for the schema.
+    `add_stages` is called with every pipeline the dump writes so the caller
+    can add compression and encryption, it returns the file extension.
+    `metadata` describes those stages and is kept in the manifest.
+    """
+
+    def __init__(self, client_args, dump_args, databases, output_dir,
+            add_stages, workers=4, chunk_rows=500000, metadata=None):
+        self.client_args = client_args
+        self.dump_args = dump_args
+        self.databases = databases
+        self.output_dir = output_dir
+        self.add_stages = add_stages
+        self.workers = max(1, workers)
+        self.chunk_rows = max(1, chunk_rows)
+        self.metadata = metadata
+        self.error = None
+
+    def run(self):
+        """run the dump and return the manifest"""
+        os.mkdir(self.output_dir)
+        os.mkdir(os.path.join(self.output_dir, 'data'))
+
+        control = MysqlSession(self.client_args)
+        sessions = []
+        try:
+            # hold a global read lock while every worker opens its transaction
+            # so they all share one snapshot, then release it straight away.
+            control.execute('FLUSH TABLES WITH READ LOCK')
+            if self.databases is None:
+                self.databases = [r[0] for r in control.query('SHOW DATABASES')
+                        if r[0] not in SYSTEM_DATABASES]
+
+            control.execute('FLUSH LOGS')
+            status = control.query('SHOW MASTER STATUS')
+
+            for i in range(self.workers):
+                session = MysqlSession(self.client_args)
+                sessions.append(session)
+                session.execute('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                session.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+                session.execute('SET NAMES binary')
+
+            # the schema is dumped under the lock too so it matches the data
+            schema = self._dump_ddl('schema', ['--routines', '--skip-triggers', '--add-drop-database'])
+            post = self._dump_ddl('post', ['--skip-routines', '--triggers', '--no-create-info', '--no-create-db'])
+            control.execute('UNLOCK TABLES')
+            logger.info('Snapshot taken, global read lock released')
+
+            chunks = self._plan(sessions[0])
+            logger.info('Dumping %d chunks with %d workers' % (len(chunks), len(sessions)))
+            self._dump_chunks(sessions, chunks)
+        finally:
+            control.close()
+            for session in sessions:
+                session.close()
+
+        manifest = {
+            'format': FORMAT,
+            'version': 1,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'databases': self.databases,
+            'binlog': None,
+            'schema': schema,
+            'post': post,
+            'compression': self.metadata,
+            'tables': [],
+        }
+        if status:
+            manifest['binlog'] = {'file': status[0][0], 'position': int(status[0][1])}
+
+        tables = {}
+        for chunk in sorted(chunks, key=lambda c: (c.database, c.table, c.index)):
+            key = (chunk.database, chunk.table)
+            if key not in tables:
+                tables[key] = {'database': chunk.database, 'table': chunk.table, 'chunks': []}
+                manifest['tables'].append(tables[key])
+            tables[key]['chunks'].append({'file': chunk.file, 'where': chunk.where, 'rows': chunk.rows})
+
+        write_manifest(self.output_dir, manifest)
+        return manifest
+
+    def _dump_ddl(self, name, options):
+        """dump the definitions mysqldump `options` select into the file `name`"""
+        p = pipeline.Pipeline()
+        p.add_command(self.dump_args + ['--no-data', '--single-transaction'] + options +
+            ['--databases'] + self.databases, 'mysqldump')
+        name += self.add_stages(p)
+        try:
+            p.run(output=os.path.join(self.output_dir, name))
+        except pipeline.PipelineError, e:
+            raise ParallelDumpError('%s dump failed: %s' % (name, e))
+        return name
+
+    def _plan(self, session):
+        """split every table into chunks of about `chunk_rows` rows"""
+        databases = ', '.join([quote_string(d) for d in self.databases])
+
+        columns = {}
+        for schema, table, column, extra in session.query(
+                "SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, EXTRA FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA IN (%s) ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION" % (databases)):
+            # generated columns can't be inserted into
+            if 'GENERATED' in extra.upper():
+                continue
+            columns.setdefault((schema, table), []).append(column)
+
+        keys = {}
+        for schema, table, column, data_type in session.query(
+                "SELECT k.TABLE_SCHEMA, k.TABLE_NAME, k.COLUMN_NAME, c.DATA_TYPE "
+                "FROM information_schema.KEY_COLUMN_USAGE k JOIN information_schema.COLUMNS c "
+                "ON c.TABLE_SCHEMA = k.TABLE_SCHEMA AND c.TABLE_NAME = k.TABLE_NAME AND c.COLUMN_NAME = k.COLUMN_NAME "
+                "WHERE k.CONSTRAINT_NAME = 'PRIMARY' AND k.TABLE_SCHEMA IN (%s)" % (databases)):
+            keys.setdefault((schema, table), []).append((column, data_type.lower()))
+
+        chunks = []
+        for schema, table, rows in session.query(
+                "SELECT TABLE_SCHEMA, TABLE_NAME, IFNULL(TABLE_ROWS, 0) FROM information_schema.TABLES "
+                "WHERE TABLE_TYPE = 'BASE TABLE' AND TABLE_SCHEMA IN (%s)" % (databases)):
+            rows = int(rows)
+            table_columns = columns.get((schema, table))
+            if not table_columns:
+                continue
+
+            key = keys.get((schema, table), [])
+            ranges = [None]
+            if len(key) == 1 and key[0][1] in INTEGER_TYPES and rows > self.chunk_rows:
+                ranges = self._split(session, schema, table, key[0][0], rows)
+
+            for i, where in enumerate(ranges):
+                chunks.append(Chunk(schema, table, table_columns, where, i, rows / len(ranges)))
+
+        # largest chunks first keeps the workers busy until the very end
+        chunks.sort(key=lambda c: -c.estimated_rows)
+        return chunks
+
+    def _split(self, session, schema, table, column, rows):
+        result = session.query('SELECT MIN(%s), MAX(%s) FROM %s.%s' %
+                (quote_name(column), quote_name(column), quote_name(schema), quote_name(table)))
+        if not result or result[0][0] == 'NULL':
+            return [None]
+
+        low, high = int(result[0][0]), int(result[0][1])
+        count = min((rows + self.chunk_rows - 1) / self.chunk_rows, high - low + 1)
+        step = (high - low + count) / count
+
+        ranges = []
+        column = quote_name(column)
+        for i in range(count):
+            start = low + i * step
+            if i == 0:
+                ranges.append('%s < %d' % (column, start + step))
+            elif i == count - 1:
+                ranges.append('%s >= %d' % (column, start))
+            else:
+                ranges.append('%s >= %d AND %s < %d' % (column, start, column, start + step))
+        return ranges
+
+    def _dump_chunks(self, sessions, chunks):
+        jobs = Queue.Queue()
+        for chunk in chunks:
+            jobs.put(chunk)
+
+        threads = []
+        for session in sessions:
+            t = threading.Thread(target=self._worker, args=(session, jobs))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        if self.error is not None:
+            raise ParallelDumpError(self.error)
+
+    def _worker(self, session, jobs):
+        while self.error is None:
+            try:
+                chunk = jobs.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                self._dump_chunk(session, chunk)
+            except Exception, e:
+                # the first failure stops every worker
+                if self.error is None:
+                    self.error = 'dumping %s.%s failed: %s' % (chunk.database, chunk.table, e)
+                return
+
+    def _dump_chunk(self, session, chunk):
+        name = '%s.%s.%05d' % (chunk.database, chunk.table, chunk.index)
+
+        def produce(reader, writer):
+            writer.write('/*!40101 SET NAMES binary */;\n')
+            writer.write('/*!40014 SET FOREIGN_KEY_CHECKS=0, UNIQUE_CHECKS=0 */;\n')
+            writer.write('USE %s;\n' % (quote_name(chunk.database)))
+
+            # generated columns aren't dumped, the others are named
+            prefix = 'INSERT INTO %s (%s) VALUES ' % (quote_name(chunk.table),
+                    ','.join([quote_name(c) for c in chunk.columns]))
+            batch = []
+            state = {'size': 0}
+
+            def flush():
+                if batch:
+                    writer.write(prefix + ','.join(batch) + ';\n')
+                    del batch[:]
+                    state['size'] = 0
+
+            def row(line):
+                batch.append(line)
+                chunk.rows += 1
+                state['size'] += len(line)
+                if state['size'] >= INSERT_SIZE:
+                    flush()
+
+            session.stream(chunk.select(), row)
+            flush()
+
+        p = pipeline.Pipeline()
+        p.add_filter(produce, 'select')
+        name += self.add_stages(p)
+        p.run(output=os.path.join(self.output_dir, 'data', name))
+        chunk.file = 'data/' + name
+
+def write_manifest(path, manifest):
+    """atomically write the manifest of the chunked backup in `path`"""
+    tmp = os.path.join(path, MANIFEST + '.partial')
+    f = open(tmp, 'w')
+    json.dump(manifest, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp, os.path.join(path, MANIFEST))
+
+def read_manifest(path):
+    """returns the manifest of the chunked backup in `path`, or None if it isn't one"""
+    try:
+        f = open(os.path.join(path, MANIFEST))
+    except IOError:
+        return None
+    try:
+        manifest = json.load(f)
+    finally:
+        f.close()
+    if manifest.get('format') != FORMAT:
+        return None
+    return manifest
+
+def manifest_files(manifest):
+    """the files of a chunked backup in the order they have to be loaded"""
+    files = [manifest['schema']]
+    for table in manifest['tables']:
+        for chunk in table['chunks']:
+            files.append(chunk['file'])
+    # backups from before the triggers had a file of their own have them in the schema
+    if manifest.get('post'):
+        files.append(manifest['post'])
+    return files
@@ -0,0 +1,524 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Parallel restores. The schema is created first with the secondary indexes
+# taken out of the CREATE TABLE statements, then the table data is loaded by
+# a pool of mysql connections, the indexes are built again in one ALTER TABLE
+# per table and finally the triggers are created (they must not fire while
+# the data goes in).
+#
+# Chunked backups are already split per table. A single stream mysqldump file
+# is split as it is decoded: the schema runs in pieces on a session of its own,
+# each piece before the data following it, and the statements of the data go
+# to the pool of connections one by one, so the tables load concurrently
+# without the dump being written anywhere. The connections commit every
+# `commit_every` statements rather than once per table or chunk.
+
+import os
+import re
+import tempfile
+import threading
+import subprocess
+import Queue
+import logging
+
+from paralleldump import MysqlSession, ParallelDumpError
+
+logger = logging.getLogger("PMB LOG")
+
+# sent to every loading connection before any data
+BULK_SETTINGS = [
+    'SET SESSION foreign_key_checks = 0;\n',
+    'SET SESSION unique_checks = 0;\n',
+    'SET SESSION autocommit = 0;\n',
+]
+
+# statements of a single stream dump go to the connections in batches of about this size
+BATCH_SIZE = 1024 * 1024
+
+_DATA_MARKER = '-- Dumping data for table '
+# lines of a data section that aren't loaded: the connections load a table
+# together, and commit on their own
+_SKIPPED = ('LOCK TABLES ', 'UNLOCK TABLES', '/*!40000 ALTER TABLE ', 'set autocommit=', 'commit;')
+_SECTION_MARKERS = ('-- Table structure for table ', '-- Current Database: ',
+        '-- Temporary view structure for view ', '-- Temporary table structure for view ',
+        '-- Final view structure for view ',
+        '-- Dumping routines for database ', '-- Dumping events for database ')
+
+_CREATE_TABLE = re.compile(r'^CREATE TABLE `((?:[^`]|``)+)` \($')
+_SECONDARY_KEY = re.compile(r'^\s*(UNIQUE |FULLTEXT |SPATIAL )?KEY `(?:[^`]|``)+` \(`((?:[^`]|``)+)`')
+_COLUMN = re.compile(r'^\s*`((?:[^`]|``)+)` ')
+_USE = re.compile(r'^USE `((?:[^`]|``)+)`;')
+_TRIGGER = re.compile(r'/\*!50003 TRIGGER |^\s*CREATE\b.*\bTRIGGER\b', re.M)
+
+class ParallelLoadError(Exception):
+    """raised when a parallel restore fails"""
+
+def _quote_name(name):
+    return '`%s`' % (name.replace('`', '``'))
+
+def defer_indexes(schema, database=None):
+    """take the secondary indexes out of the CREATE TABLE statements in `schema`
+
+    returns the new schema and the ALTER TABLE statements adding the indexes
+    back, one per table. tables with foreign keys are left alone since the
+    constraints need their indexes, and so are keys on AUTO_INCREMENT columns.
+    `database` is the one selected where `schema` starts.
+    """
+    out = []
+    alters = []
+    table = None
+    body = []
+
+    for line in schema.splitlines(True):
+        if table is None:
+            m = _USE.match(line)
+            if m:
+                database = m.group(1).replace('``', '`')
+            m = _CREATE_TABLE.match(line)
+            if m:
+                table = m.group(1).replace('``', '`')
+                body = []
+            out.append(line)
+            continue
+
+        if not line.startswith(')'):
+            body.append(line.rstrip('\n').rstrip(','))
+            continue
+
+        # the end of the CREATE TABLE statement
+        auto_increment = [_COLUMN.match(l).group(1) for l in body
+                if _COLUMN.match(l) and 'AUTO_INCREMENT' in l]
+        has_foreign_keys = [l for l in body if 'FOREIGN KEY' in l]
+
+        keep = []
+        deferred = []
+        for l in body:
+            m = _SECONDARY_KEY.match(l)
+            if m and not has_foreign_keys and m.group(2) not in auto_increment:
+                deferred.append('ADD ' + l.strip())
+            else:
+                keep.append(l)
+
+        out.append(',\n'.join(keep) + '\n')
+        out.append(line)
+
+        if deferred:
+            name = _quote_name(table)
+            if database is not None:
+                name = '%s.%s' % (_quote_name(database), name)
+            alters.append('ALTER TABLE %s %s;\n' % (name, ', '.join(deferred)))
+        table = None
+
+    return ''.join(out), alters
+
+class DumpSplitter(object):
+    """split a mysqldump stream into schema, data statements and post-data
+
+    the schema goes to `schema(sql)`, which returns once it ran, in pieces:
+    everything up to a data section is run before its statements, without
+    the secondary indexes (see defer_indexes, the ALTER TABLE statements
+    adding them are kept in `alters`). the statements of the data sections
+    go to `statement(use, sql)`, `use` is the USE statement of their
+    database. triggers are kept in `post`, the session settings of the dump
+    in `preamble`.
+    """
+
+    def __init__(self, schema, statement=None):
+        self.schema = schema
+        self.statement = statement
+        self.alters = []
+        self.post = []
+        self.preamble = []
+        self.database = None
+        self.piece = []
+        self.piece_database = None
+
+    def _run_piece(self):
+        if self.piece:
+            schema, alters = defer_indexes(''.join(self.piece), self.piece_database)
+            self.alters.extend(alters)
+            self.schema(schema)
+            self.piece = []
+        self.piece_database = self.database and _USE.match(self.database).group(1).replace('``', '`')
+
+    def split(self, reader):
+        schema = self.piece
+        post = self.post
+        in_data = False
+        data_started = False
+        block = None
+        pending = []
+        after = None
+        in_header = True
+
+        for line in iter(reader.readline, ''):
+            if in_data:
+                # dumps written with --skip-add-locks have no UNLOCK TABLES,
+                # the next section comment ends the data then.
+                if data_started and line.startswith('--'):
+                    in_data = False
+                else:
+                    if line.startswith('--') or not line.strip():
+                        continue
+                    data_started = True
+                    if line.startswith('UNLOCK TABLES;'):
+                        in_data = False
+                    elif not line.startswith(_SKIPPED):
+                        self.statement(self.database, line)
+                    continue
+
+            if block is not None:
+                block.append(line)
+                if line.startswith('DELIMITER ;') and not line.startswith('DELIMITER ;;'):
+                    after = schema
+                    if _TRIGGER.search(''.join(block)):
+                        after = post
+                    after.extend(block)
+                    block = None
+                continue
+
+            # the session settings around a trigger or routine travel with it
+            if line.startswith('/*!50003 SET'):
+                pending.append(line)
+                continue
+            if line.startswith('DELIMITER ;;'):
+                block = pending + [line]
+                pending = []
+                continue
+            if pending:
+                (after is not None and after or schema).extend(pending)
+                pending = []
+            after = None
+
+            if line.startswith(_DATA_MARKER):
+                in_header = False
+                self._run_piece()
+                schema = self.piece
+                logger.info('Loading %s' % (line[len(_DATA_MARKER):].strip()))
+                in_data = True
+                data_started = False
+                continue
+
+            if line.startswith(_SECTION_MARKERS):
+                in_header = False
+            elif in_header and line.startswith('/*!') and ' SET ' in line:
+                self.preamble.append(line)
+
+            m = _USE.match(line)
+            if m:
+                self.database = line
+                post.append(line)
+
+            schema.append(line)
+
+        if block is not None:
+            schema.extend(block)
+        (after is not None and after or schema).extend(pending)
+        self._run_piece()
+
+class _CommittingWriter(object):
+    """writes sql to `output` with a COMMIT after every `every` statements
+
+    a statement of a dump ends with a ';' at the end of a line, mysqldump
+    escapes the line breaks in strings. with `every` None the sql is only
+    committed by commit(), for the schema and triggers whose bodies hold
+    statements of their own.
+    """
+
+    def __init__(self, output, every):
+        self.output = output
+        self.every = every
+        self.count = 0
+        self.last = ''
+
+    def _ended(self):
+        self.count += 1
+        if self.count >= self.every:
+            self.commit()
+
+    def commit(self):
+        self.output.write('COMMIT;\n')
+        self.count = 0
+
+    def write(self, data):
+        if self.every is None or not data:
+            self.output.write(data)
+            return
+        # a statement end split between two writes
+        if self.last == ';' and data.startswith('\n'):
+            self.output.write('\n')
+            data = data[1:]
+            self._ended()
+        start = 0
+        while True:
+            end = data.find(';\n', start) + 2
+            if end == 1:
+                break
+            self.output.write(data[start:end])
+            start = end
+            self._ended()
+        self.output.write(data[start:])
+        if data:
+            self.last = data[-1]
+
+class _Loader(threading.Thread):
+    """one mysql connection working through the job queue until it gets None
+
+    a job is (name, use, sql or job), a job is called with the output to
+    write its sql to. `use` selects the database of the sql first. without
+    `commit_every` every job is committed on its own.
+    """
+
+    def __init__(self, client_args, jobs, errors, commit_every, preamble):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client_args = client_args
+        self.jobs = jobs
+        self.errors = errors
+        self.commit_every = commit_every
+        self.preamble = preamble
+
+    def _next(self):
+        while not self.errors:
+            try:
+                return self.jobs.get(True, 1)
+            except Queue.Empty:
+                pass
+        return None
+
+    def run(self):
+        stderr = tempfile.TemporaryFile()
+        process = subprocess.Popen(self.client_args,
+                stdin=subprocess.PIPE,
+                stderr=stderr,
+                close_fds=True)
+        error = None
+        name = 'session settings'
+        try:
+            process.stdin.writelines(BULK_SETTINGS)
+            process.stdin.writelines(self.preamble)
+            output = _CommittingWriter(process.stdin, self.commit_every)
+            current = None
+            while True:
+                job = self._next()
+                if job is None:
+                    break
+                name, use, sql = job
+                if use is not None and use != current:
+                    output.write(use)
+                    current = use
+                if isinstance(sql, basestring):
+                    output.write(sql)
+                    continue
+                logger.info('Loading %s' % (name))
+                sql(output)
+                output.write('\n')
+                if self.commit_every is None:
+                    output.commit()
+                # the job may have selected another database
+                current = None
+            output.commit()
+            process.stdin.close()
+        except Exception, e:
+            error = '%s: %s' % (name, e)
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+
+        returncode = process.wait()
+        stderr.seek(0)
+        output = stderr.read().strip()
+        stderr.close()
+        # mysql's own message is the interesting one, the loader only sees
+        # the broken pipe it leaves behind
+        if returncode != 0:
+            self.errors.append('mysql exited with %d: %s' % (returncode, output))
+        elif error is not None:
+            self.errors.append(error)
+
+class _LoaderPool(object):
+    """`workers` loaders taking jobs from a short queue, so what is queued stays small"""
+
+    def __init__(self, client_args, workers, commit_every=None, preamble=()):
+        self.jobs = Queue.Queue(workers * 4)
+        self.errors = []
+        self.loaders = [_Loader(client_args, self.jobs, self.errors, commit_every, list(preamble))
+                for i in range(workers)]
+        for loader in self.loaders:
+            loader.start()
+
+    def put(self, job):
+        while not self.errors:
+            try:
+                self.jobs.put(job, True, 1)
+                return
+            except Queue.Full:
+                pass
+        raise ParallelLoadError('; '.join(self.errors))
+
+    def close(self):
+        try:
+            for loader in self.loaders:
+                self.put(None)
+        finally:
+            for loader in self.loaders:
+                loader.join()
+        if self.errors:
+            raise ParallelLoadError('; '.join(self.errors))
+
+class _SchemaSession(MysqlSession):
+    """a session running pieces of a schema, each one is done when run() returns"""
+
+    def _send(self, sql):
+        # the piece ends with complete statements (or a comment), it is sent as it is
+        try:
+            self.process.stdin.write("%s\nSELECT '%s';\n" % (sql, self.marker))
+            self.process.stdin.flush()
+        except IOError:
+            self._fail(sql)
+
+    def run(self, sql):
+        try:
+            self.execute(sql)
+        except ParallelDumpError, e:
+            raise ParallelLoadError(str(e))
+
+class ParallelLoad(object):
+    """load a full backup with `workers` connections
+
+    `client_args` is the mysql command line every connection is opened with.
+    `decode` is called as decode(artifact, output, metadata) to write the
+    plain sql of a backup file to the open file `output`. the connections
+    commit every `commit_every` statements.
+    """
+
+    def __init__(self, client_args, decode, workers=4, commit_every=100):
+        self.client_args = client_args
+        self.decode = decode
+        self.workers = max(1, workers)
+        self.commit_every = max(1, commit_every)
+
+    def load_chunked(self, path, manifest):
+        """load the chunked backup directory `path` described by `manifest`"""
+        metadata = manifest.get('compression')
+        session = _SchemaSession(self.client_args)
+        try:
+            logger.info('Creating schema')
+            splitter = DumpSplitter(session.run)
+            self._split(os.path.join(path, manifest['schema']), metadata, splitter)
+        finally:
+            session.close()
+
+        jobs = []
+        for table in manifest['tables']:
+            for chunk in table['chunks']:
+                jobs.append((chunk['file'], self._decode_job(os.path.join(path, chunk['file']), metadata)))
+        post = []
+        if manifest.get('post'):
+            post.append((manifest['post'], self._decode_job(os.path.join(path, manifest['post']), metadata)))
+
+        logger.info('Loading %d data files with %d connections' % (len(jobs), self.workers))
+        self._run(jobs, self.workers, self.commit_every)
+        self._finish(splitter, post)
+
+    def load_dump(self, artifact):
+        """load the single stream dump `artifact`, its tables over the pool of connections"""
+        pool = []
+        batch = {'use': None, 'sql': [], 'size': 0}
+
+        def flush():
+            if batch['sql']:
+                pool[0].put((None, batch['use'], ''.join(batch['sql'])))
+                batch['sql'] = []
+                batch['size'] = 0
+
+        def statement(use, sql):
+            # the connections start with the settings of the dump's header
+            if not pool:
+                logger.info('Loading the data with %d connections' % (self.workers))
+                pool.append(_LoaderPool(self.client_args, self.workers, self.commit_every, splitter.preamble))
+            if use != batch['use']:
+                flush()
+                batch['use'] = use
+            batch['sql'].append(sql)
+            batch['size'] += len(sql)
+            if batch['size'] >= BATCH_SIZE:
+                flush()
+
+        session = _SchemaSession(self.client_args)
+        try:
+            logger.info('Creating schema')
+            splitter = DumpSplitter(session.run, statement)
+            self._split(artifact, None, splitter)
+            if pool:
+                flush()
+        finally:
+            session.close()
+            if pool:
+                pool[0].close()
+        self._finish(splitter)
+
+    def _split(self, artifact, metadata, splitter):
+        self._read(artifact, metadata, splitter.split)
+
+    def _read(self, artifact, metadata, consume):
+        """decode `artifact` in a thread of its own into a pipe `consume(reader)` reads"""
+        read_end, write_end = os.pipe()
+        reader = os.fdopen(read_end, 'rb')
+        writer = os.fdopen(write_end, 'wb')
+        errors = []
+
+        def decode():
+            try:
+                try:
+                    self.decode(artifact, writer, metadata)
+                except Exception, e:
+                    errors.append(str(e))
+            finally:
+                writer.close()
+
+        t = threading.Thread(target=decode)
+        t.daemon = True
+        t.start()
+        try:
+            consume(reader)
+        finally:
+            reader.close()
+            t.join()
+        if errors:
+            raise ParallelLoadError('decoding %s failed: %s' % (os.path.basename(artifact), errors[0]))
+
+    def _finish(self, splitter, post_jobs=()):
+        """build the deferred indexes and create the triggers once the data is in"""
+        if splitter.alters:
+            logger.info('Building secondary indexes of %d tables' % (len(splitter.alters)))
+            self._run([('indexes %d' % (i), self._sql_job(a)) for i, a in enumerate(splitter.alters)], self.workers)
+
+        logger.info('Creating triggers')
+        self._run([('post', self._sql_job(''.join(splitter.post)))] + list(post_jobs), 1)
+
+    def _run(self, jobs, workers, commit_every=None):
+        if not jobs:
+            return
+        pool = _LoaderPool(self.client_args, min(workers, len(jobs)), commit_every)
+        try:
+            for name, job in jobs:
+                pool.put((name, None, job))
+        finally:
+            pool.close()
+
+    def _decode_job(self, artifact, metadata):
+        def job(output):
+            if output.every is None:
+                self.decode(artifact, output.output, metadata)
+                return
+            # the decoders write to files, the statements are counted on their way from one
+            def copy(reader):
+                for block in iter(lambda: reader.read(BATCH_SIZE), ''):
+                    output.write(block)
+            self._read(artifact, metadata, copy)
+        return job
+
+    def _sql_job(self, sql):
+        return lambda output: output.write(sql)
@@ -0,0 +1,545 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Streaming process pipelines. A pipeline is a chain of stages connected
+# with OS pipes, so data flows from the first stage to the final artifact
+# without ever landing on disk in between. Stages are either external
+# commands (mysqldump, gzip, gpg...) or python filters running in a thread.
+#
+# Every stage records its wall time, cpu time and the bytes it read and wrote.
+# A command's cpu time comes from wait4() and its bytes from /proc/<pid>/io,
+# read after it exited but before it is reaped. A filter counts the bytes
+# passing through its reader and writer and adds up the cpu time of its thread
+# and of the pool threads working for it (see charge_cpu).
+#
+# A pipeline writing a file hashes the bytes on their way into it, the sha256
+# of every file written is remembered (written_digest) so the backup index
+# doesn't read the file again to checksum it.
+#
+# A throttle (see throttle.py) caps the bytes a stage writes per second and the
+# cpu its command uses, stages are looked up in it by name.
+
+import os
+import time
+import errno
+import hashlib
+import signal
+import resource
+import subprocess
+import tempfile
+import threading
+import ctypes
+import ctypes.util
+import logging
+
+# size of the blocks python stages read and write. together with the
+# kernel pipe buffers this keeps the memory used by a pipeline bounded
+# no matter how big the dump is.
+BLOCK_SIZE = 1024 * 1024
+
+logger = logging.getLogger("PMB LOG")
+
+# RUSAGE_THREAD is linux only, python 2 doesn't define it
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+# waitid() idtype and options
+P_PID = 1
+WEXITED = 4
+WNOWAIT = 0x01000000
+
+def _load_waitid():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).waitid
+    except (OSError, AttributeError):
+        return None
+
+_waitid = _load_waitid()
+
+_local = threading.local()
+_observers = []
+_throttle = None
+
+def observe(func):
+    """have func(pipeline) called after every pipeline that ran, for the run report"""
+    _observers.append(func)
+
+# sha256 of the files pipelines wrote, by path
+_written = {}
+_written_lock = threading.Lock()
+
+def _remember_digest(path, digest):
+    st = os.stat(path)
+    _written_lock.acquire()
+    try:
+        _written[os.path.abspath(path)] = (st.st_size, st.st_mtime, digest)
+    finally:
+        _written_lock.release()
+
+def written_digest(path):
+    """sha256 of `path` computed while a pipeline wrote it, None if it didn't or the file changed since"""
+    _written_lock.acquire()
+    try:
+        known = _written.get(os.path.abspath(path))
+    finally:
+        _written_lock.release()
+    if known is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if (st.st_size, st.st_mtime) != known[:2]:
+        return None
+    return known[2]
+
+def set_throttle(throttle):
+    """cap the stages of every pipeline from now on with `throttle`, a throttle.Throttle"""
+    global _throttle
+    _throttle = throttle
+
+def thread_cpu():
+    """(user, system) cpu seconds used by the calling thread"""
+    try:
+        usage = resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        return (0.0, 0.0)
+    return (usage.ru_utime, usage.ru_stime)
+
+def current_stage():
+    """the filter stage running in the calling thread, None outside of one"""
+    return getattr(_local, 'stage', None)
+
+def charge_cpu(stage, func):
+    """wrap `func` so the cpu time of the thread calling it is added to `stage`
+
+    for thread pools working for a filter, whose threads aren't the filter's.
+    """
+    if stage is None:
+        return func
+    def charged(*args):
+        before = thread_cpu()
+        try:
+            return func(*args)
+        finally:
+            after = thread_cpu()
+            stage.add_cpu(after[0] - before[0], after[1] - before[1])
+    return charged
+
+class PipelineError(Exception):
+    """raised when one or more stages of a pipeline fail"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        Exception.__init__(self, '; '.join(failures))
+
+def _restore_sigpipe():
+    # python ignores SIGPIPE and children inherit that. put it back so an
+    # upstream command dies quietly when a downstream stage goes away.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+def copy_stream(reader, writer, block_size=BLOCK_SIZE):
+    """copy reader to writer in bounded blocks, returns the number of bytes copied"""
+    total = 0
+    while True:
+        block = reader.read(block_size)
+        if not block:
+            break
+        writer.write(block)
+        total += len(block)
+    return total
+
+def file_digest(path, algorithm='sha256'):
+    """hex digest of the file `path`, read in bounded blocks"""
+    h = hashlib.new(algorithm)
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def _limited_copy(bucket):
+    def copy(reader, writer):
+        while True:
+            block = reader.read(BLOCK_SIZE)
+            if not block:
+                break
+            bucket.consume(len(block))
+            writer.write(block)
+    return copy
+
+class _Limited(object):
+    """a writer that writes no faster than its bucket allows"""
+
+    def __init__(self, f, bucket):
+        self.f = f
+        self.bucket = bucket
+
+    def write(self, data):
+        self.bucket.consume(len(data))
+        self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+def _hashing_copy(digest):
+    def copy(reader, writer):
+        while True:
+            block = reader.read(BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            writer.write(block)
+    return copy
+
+class _Counted(object):
+    """a file counting the bytes read from or written to it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self.count += len(data)
+        return data
+
+    def readline(self, *args):
+        line = self.f.readline(*args)
+        self.count += len(line)
+        return line
+
+    def write(self, data):
+        self.f.write(data)
+        self.count += len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+def _read_io(pid):
+    """bytes read and written by the process `pid` (which may have exited), None if unknown"""
+    try:
+        f = open('/proc/%d/io' % (pid))
+    except IOError:
+        return None
+    try:
+        counters = dict([line.split(':', 1) for line in f.read().splitlines() if ':' in line])
+    finally:
+        f.close()
+    return int(counters['rchar']), int(counters['wchar'])
+
+def _wait_exited(pid):
+    """block until the child `pid` exited without reaping it, False when that can't be done here"""
+    if _waitid is None:
+        return False
+    # a siginfo_t is 128 bytes
+    info = ctypes.create_string_buffer(128)
+    while _waitid(P_PID, pid, info, WEXITED | WNOWAIT) != 0:
+        if ctypes.get_errno() != errno.EINTR:
+            return False
+    return True
+
+class _Stage(object):
+    def __init__(self, name):
+        self.name = name
+        self.error = None
+        # set when the stage only failed because a later stage went away
+        self.broken_pipe = False
+        self.started = None
+        self.finished = None
+        self.user = 0.0
+        self.system = 0.0
+        self.bytes_in = None
+        self.bytes_out = None
+        self.max_rss = None
+        self.lock = threading.Lock()
+
+    def add_cpu(self, user, system):
+        self.lock.acquire()
+        try:
+            self.user += user
+            self.system += system
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """what the stage used: wall and cpu seconds, bytes in and out and peak rss in KB"""
+        wall = None
+        if self.started is not None and self.finished is not None:
+            wall = self.finished - self.started
+        return {
+            'name': self.name,
+            'wall': wall,
+            'user': self.user,
+            'system': self.system,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'max_rss': self.max_rss,
+            'failed': self.error is not None,
+        }
+
+class _CommandStage(_Stage):
+    def __init__(self, name, args):
+        _Stage.__init__(self, name)
+        self.args = args
+        self.process = None
+        self.stderr = None
+
+    def start(self, stdin, stdout):
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(self.args,
+                stdin=stdin,
+                stdout=stdout,
+                stderr=self.stderr,
+                close_fds=True,
+                preexec_fn=_restore_sigpipe)
+        # without waitid() the pid could be reused before the throttle lets go of it
+        if _throttle is not None and _waitid is not None:
+            _throttle.watch(self.name, self.process.pid)
+
+    def _reap(self):
+        """wait for the command, taking its resource usage and the bytes it moved"""
+        pid = self.process.pid
+        exited = _wait_exited(pid)
+        if _throttle is not None:
+            # before the pid can be reused
+            _throttle.unwatch(pid)
+        if exited:
+            io = _read_io(pid)
+            if io is not None:
+                self.bytes_in, self.bytes_out = io
+
+        while True:
+            try:
+                pid, status, usage = os.wait4(pid, 0)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        self.finished = time.time()
+        self.user, self.system, self.max_rss = usage.ru_utime, usage.ru_stime, usage.ru_maxrss
+
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        return self.process.returncode
+
+    def wait(self):
+        returncode = self._reap()
+        self.stderr.seek(0)
+        output = self.stderr.read().strip()
+        self.stderr.close()
+
+        if returncode != 0:
+            # shells report a signal as 128 + the signal number
+            if returncode in (-signal.SIGPIPE, 128 + signal.SIGPIPE):
+                self.error = '%s: terminated by SIGPIPE' % (self.name)
+                self.broken_pipe = True
+            else:
+                self.error = ('%s: exited with %d %s' % (self.name, returncode, output)).strip()
+        elif output:
+            logger.warn('%s: %s' % (self.name, output))
+
+class _FilterStage(_Stage):
+    def __init__(self, name, func):
+        _Stage.__init__(self, name)
+        self.func = func
+        self.thread = None
+        # the bucket its writes go through, when it is throttled
+        self.bucket = None
+
+    def start(self, stdin, stdout):
+        # the filter owns the pipe ends it is handed, they are closed when it
+        # is done so the stages on either side see EOF or EPIPE.
+        owned = []
+        if stdin is not None and not hasattr(stdin, 'read'):
+            stdin = os.fdopen(stdin, 'rb', 0)
+            owned.append(stdin)
+        if not hasattr(stdout, 'write'):
+            stdout = os.fdopen(stdout, 'wb', 0)
+            owned.append(stdout)
+
+        self.thread = threading.Thread(target=self._run, args=(stdin, stdout, owned))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, reader, writer, owned):
+        _local.stage = self
+        before = thread_cpu()
+        if reader is not None:
+            reader = _Counted(reader)
+        writer = _Counted(writer)
+        try:
+            try:
+                if self.bucket is not None:
+                    self.func(reader, _Limited(writer, self.bucket))
+                else:
+                    self.func(reader, writer)
+                writer.flush()
+            except Exception, e:
+                self.error = '%s: %s' % (self.name, e)
+                if isinstance(e, (IOError, OSError)) and e.errno == errno.EPIPE:
+                    self.broken_pipe = True
+        finally:
+            for f in owned:
+                try:
+                    f.close()
+                except Exception:
+                    pass
+            after = thread_cpu()
+            self.add_cpu(after[0] - before[0], after[1] - before[1])
+            if reader is not None:
+                self.bytes_in = reader.count
+            self.bytes_out = writer.count
+            self.finished = time.time()
+            _local.stage = None
+
+    def wait(self):
+        self.thread.join()
+
+class Pipeline(object):
+    """a chain of commands and python filters connected with pipes
+
+    >>> p = Pipeline()
+    >>> p.add_command(['mysqldump', 'my_database'])
+    >>> p.add_command(['gzip', '-c'])
+    >>> p.run(output='my_database.sql.gz')
+    """
+
+    def __init__(self):
+        self.stages = []
+        # what each stage used, once the pipeline ran
+        self.stats = []
+        # sha256 of the file written, when the output was a path
+        self.sha256 = None
+
+    def add_command(self, args, name=None):
+        """append an external command, it reads stdin and writes stdout"""
+        if name is None:
+            name = os.path.basename(args[0])
+        self.stages.append(_CommandStage(name, args))
+
+    def add_filter(self, func, name=None):
+        """append a python filter called as func(reader, writer) in its own thread
+
+        the first stage of a pipeline with no source gets None as its reader.
+        """
+        if name is None:
+            name = getattr(func, '__name__', 'filter')
+        self.stages.append(_FilterStage(name, func))
+
+    def run(self, source=None, output=None):
+        """run the pipeline to completion
+
+        `source` is a path or file object fed to the first stage. `output` is
+        either a path, which is written atomically (the file only appears
+        under its real name once every stage succeeded), or a writable file
+        object. raises PipelineError if any of the stages fail.
+        """
+        if not self.stages:
+            raise PipelineError(['pipeline has no stages'])
+        stages = []
+        for stage in self.stages:
+            stages.append(stage)
+            bucket = _throttle is not None and _throttle.bucket(stage.name) or None
+            if bucket is None:
+                continue
+            if isinstance(stage, _FilterStage):
+                stage.bucket = bucket
+            else:
+                # the pipe backpressure slows the command down
+                stages.append(_FilterStage('%s limit' % (stage.name), _limited_copy(bucket)))
+
+        source_file = None
+        if isinstance(source, basestring):
+            source_file = open(source, 'rb')
+            stdin = source_file
+        else:
+            stdin = source
+
+        partial = None
+        digest = None
+        if isinstance(output, basestring):
+            partial = '%s.partial' % (output)
+            sink = open(partial, 'wb')
+            # a file is checksummed on its way to the disk
+            digest = hashlib.sha256()
+            stages.append(_FilterStage('write', _hashing_copy(digest)))
+            if _throttle is not None:
+                stages[-1].bucket = _throttle.bucket('write')
+        elif output is None:
+            sink = open(os.devnull, 'wb')
+        else:
+            sink = output
+
+        started = []
+        read_end = stage_out = None
+        try:
+            for i, stage in enumerate(stages):
+                last = (i == len(stages) - 1)
+                read_end = stage_out = None
+                if last:
+                    stage_out = sink
+                else:
+                    read_end, stage_out = os.pipe()
+
+                stage.started = time.time()
+                if isinstance(stage, _CommandStage):
+                    stage.start(stdin, stage_out)
+                    # the child has its own copies of the descriptors now
+                    if not last:
+                        os.close(stage_out)
+                    if isinstance(stdin, (int, long)):
+                        os.close(stdin)
+                else:
+                    stage.start(stdin, stage_out)
+                started.append(stage)
+
+                stdin = read_end
+        except Exception, e:
+            # a stage could not even be started. closing our end of the pipes
+            # lets the stages already running drain out with an error.
+            for fd in (stdin, read_end, stage_out):
+                if isinstance(fd, (int, long)):
+                    os.close(fd)
+            for started_stage in started:
+                started_stage.wait()
+            self._cleanup(source_file, sink, output, partial, True)
+            raise PipelineError(['could not start %s: %s' % (stage.name, e)])
+
+        for stage in stages:
+            stage.wait()
+
+        # a stage killed by a broken pipe is only a symptom, report the real
+        # cause first
+        failed = [s for s in stages if s.error is not None]
+        failed.sort(key=lambda s: s.broken_pipe)
+        failures = [s.error for s in failed]
+
+        self._cleanup(source_file, sink, output, partial, bool(failures))
+        if digest is not None and not failures:
+            self.sha256 = digest.hexdigest()
+            _remember_digest(output, self.sha256)
+
+        self.stats = [s.stats() for s in stages]
+        for func in _observers:
+            func(self)
+
+        if failures:
+            raise PipelineError(failures)
+
+    def _cleanup(self, source_file, sink, output, partial, failed):
+        if source_file is not None:
+            source_file.close()
+        if partial is not None or output is None:
+            sink.close()
+        if partial is not None:
+            if failed:
+                if os.path.exists(partial):
+                    os.remove(partial)
+            else:
+                os.rename(partial, output)
@@ -0,0 +1,170 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Point-in-time restores. Incrementals are the text mysqlbinlog printed for
+# the binary logs, where every event starts with a `# at <position>` line
+# followed by a `#yymmdd hh:mm:ss ... end_log_pos <position>` header. The stop
+# filter passes events through until the first one at or past the stop datetime
+# or starting at or past the stop position, the same rule as mysqlbinlog
+# --stop-datetime and --stop-position, and then ends the stream the way
+# mysqlbinlog does: restoring the delimiter and rolling back a transaction the
+# stop point cut in half.
+#
+# The end positions are those of the server's binary logs. The `# at` lines
+# are counted by mysqlbinlog in what it read, which isn't the server's log when
+# the log was split (binlogdemux.py) or compacted (compaction.py) on its way to
+# mysqlbinlog, so they aren't taken for the start of an event. An event starts
+# at or after the end of the one before it: one ending past the stop position
+# while the one before it ended before is held until the next `# at` line,
+# whose distance to its own is its length, and the event starts at its end
+# minus that. Split logs keep their events as they were, the events a
+# compaction wrote are only as long as their changes; an event held at the end
+# of the input is taken to start past the stop position.
+
+import re
+import time
+from datetime import datetime
+
+_AT = re.compile(r'^# at (\d+)\s*$')
+_HEADER = re.compile(r'^#(\d{6})\s+(\d{1,2}):(\d\d):(\d\d)\s')
+_START = re.compile(r'\sStart: binlog v \d+')
+_END_POSITION = re.compile(r'\send_log_pos (\d+)\s')
+
+_END = 'DELIMITER ;\n# stopped by pmb\nROLLBACK /* added by pmb */;\n'
+
+class StopPointError(Exception):
+    """raised for a stop datetime or position that can't be used"""
+
+def parse_stop_datetime(value):
+    """unix time of a stop datetime given as `YYYY-mm-dd HH:MM[:SS]`"""
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'):
+        try:
+            return time.mktime(datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            pass
+    raise StopPointError('stop datetime "%s" must look like 2010-02-22 18:30:00' % (value))
+
+def parse_stop_position(value):
+    """(log name, position) of a stop position given as `mysql-bin.000012:4711`"""
+    name, sep, position = value.rpartition(':')
+    try:
+        position = int(position)
+        log_sequence(name)
+    except (ValueError, IndexError):
+        raise StopPointError('stop position "%s" must look like mysql-bin.000012:4711' % (value))
+    return (name, position)
+
+def log_sequence(name):
+    """the sequence number of the binary log `name`"""
+    return int(name.rsplit('.', 1)[1])
+
+def _event_time(line):
+    m = _HEADER.match(line)
+    if m is None:
+        return None
+    when = datetime.strptime(m.group(1), '%y%m%d').replace(
+            hour=int(m.group(2)), minute=int(m.group(3)), second=int(m.group(4)))
+    return time.mktime(when.timetuple())
+
+class StopFilter(object):
+    """pipeline filter cutting mysqlbinlog output at a stop datetime or position
+
+    `stop_time` is a unix time, `stop_log` and `stop_position` a binary log
+    coordinate. the filter is used on every incremental of a restore in turn,
+    `start_logs` tells it which logs the next one was converted from; every
+    log starts with a format description event, which is how the filter
+    knows it got to the next one. once `reached` is set the rest of the
+    input is only drained.
+    """
+
+    def __init__(self, stop_time=None, stop_log=None, stop_position=None):
+        self.stop_time = stop_time
+        self.stop_log = stop_log
+        self.stop_position = stop_position
+        self.logs = []
+        self.current_log = None
+        self.reached = False
+        self.last_event = None
+        self.previous_end = None
+
+    def start_logs(self, names):
+        self.logs = list(names)
+        self.current_log = None
+
+    def _past_position(self, end_position):
+        """whether the event ending at `end_position` starts at or past the stop position
+
+        None when that depends on its length.
+        """
+        if self.stop_log is None or self.current_log is None:
+            return False
+        current = log_sequence(self.current_log)
+        stop = log_sequence(self.stop_log)
+        if current != stop:
+            return current > stop
+        if end_position <= self.stop_position:
+            return False
+        if self.previous_end is not None and self.previous_end >= self.stop_position:
+            return True
+        return None
+
+    def __call__(self, reader, writer):
+        pending = None
+        # (offset, end position, lines) of an event whose start is known at the next `# at`
+        held = None
+        for line in iter(reader.readline, ''):
+            if self.reached:
+                continue
+
+            if held is not None:
+                at = _AT.match(line)
+                if at is None:
+                    held[2].append(line)
+                    continue
+                offset, end_position, lines = held
+                held = None
+                length = int(at.group(1)) - offset
+                if length <= 0 or end_position - length >= self.stop_position:
+                    self._stop(writer)
+                    continue
+                writer.write(''.join(lines))
+
+            if pending is not None:
+                when = _event_time(line)
+                if when is not None and _START.search(line):
+                    if self.logs:
+                        self.current_log = self.logs.pop(0)
+                    self.previous_end = None
+                end = _END_POSITION.search(line)
+                past = False
+                if when is not None and self.stop_time is not None and when >= self.stop_time:
+                    past = True
+                elif when is not None and end is not None:
+                    past = self._past_position(int(end.group(1)))
+                if past:
+                    self._stop(writer)
+                    continue
+                if when is not None:
+                    self.last_event = when
+                    if end is not None:
+                        self.previous_end = int(end.group(1))
+                if past is None:
+                    held = (int(_AT.match(pending).group(1)), int(end.group(1)), [pending, line])
+                    pending = None
+                    continue
+                writer.write(pending)
+                pending = None
+
+            if _AT.match(line) is not None:
+                pending = line
+                continue
+
+            writer.write(line)
+
+        if held is not None:
+            self._stop(writer)
+        elif pending is not None and not self.reached:
+            writer.write(pending)
+
+    def _stop(self, writer):
+        self.reached = True
+        writer.write(_END)
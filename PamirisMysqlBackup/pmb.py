@@ -7,25 +7,53 @@ import os, sys, time, commands
 import getopt, ConfigParser
 import logging
 import logging.config
-import glob
 import subprocess
 import shlex
+import posixpath
+import tempfile
+import signal
+import threading
 
 from datetime import datetime
 
+import pipeline
+import paralleldump
+import parallelrestore
+import binlog
+import compression
+import backupindex
+import pitr
+import transfer
+import remote
+import dedup
+import binlogstream
+import binlogdemux
+import compaction
+import encryption
+import seekable
+import scheduler
+import instrument
+import integrity
+import throttle
+import retention
+
 def main():
     """main method for parsing the command line options and what happens after that"""
 
     # options, args and config all need to be global so they can be used in other methods
-    global options, args, config, logger, quiet
+    global options, args, config, logger, quiet, report, throttler
 
     # quiet tells the application to not print it's current status to stdout. It just
     # logs instead.
     quiet = False
 
-    # open the config file and parse it
+    # open the config file and parse it, --config= reads another one. it is
+    # needed before the options are parsed, the logger is set up from it
     config = ConfigParser.RawConfigParser()
     config_file = '%s/config.cfg' % (os.path.abspath(os.path.dirname(__file__)))
+    for arg in sys.argv[1:]:
+        if arg.startswith('--config='):
+            config_file = arg[len('--config='):]
     config.read(config_file)
 
     # configure the logger
@@ -37,7 +65,7 @@ def main():
     logger.addHandler(fileHandler)
 
     # list of available options
-    available = ['backup', 'restore', 'fetch']
+    available = ['backup', 'restore', 'fetch', 'stream', 'schedule', 'verify', 'prune', 'consolidate', 'inspect']
 
     # attemped to parse the command line arguments. getopt will detect and throw an exception if an argument
     # exists that wasn't meant to be there.
@@ -51,6 +79,13 @@ def main():
                  'database=',
                  'time=',
                  'date=',
+                 'stop-datetime=',
+                 'stop-position=',
+                 'target=',
+                 'table=',
+                 'profile',
+                 'dry-run',
+                 'config=',
                  'quiet']
         )
     except getopt.GetoptError, err:
@@ -63,6 +98,21 @@ def main():
             quiet = True
             break
 
+    # a single target's options take the place of the ones in [Backup],
+    # the scheduler runs each of its targets as a process of its own
+    targets = [a for o, a in options if '--target' == o]
+    # the incrementals of several targets sharing their binary logs are
+    # taken together, see _backup_incrementals()
+    kinds = [o for o, a in options if o in ('-f', '--full', '-i', '--incremental')]
+    demux = args and args[0] == 'backup' and len(targets) > 1 and kinds and \
+            not [k for k in kinds if k in ('-f', '--full')]
+    if targets and (not args or args[0] != 'schedule') and not demux:
+        if len(targets) > 1:
+            logAndPrint('FATAL: Only the schedule action and incremental backups take more than one --target', 'error', True, True)
+        _select_target(targets[0])
+        fileHandler.setFormatter(logging.Formatter(
+            "%(asctime)s - %(name)s - " + targets[0] + " - %(levelname)s - %(message)s"))
+
     message = '### Starting Pamiris MySQL Backup Application ###'
     logAndPrint(message, 'info')
 
@@ -74,22 +124,183 @@ def main():
         message = 'FATAL: Cannot pass in more than one action (argument)'
         logAndPrint(message, 'error', True, True)
 
-    # detect which action is needed and call it's method
-    if 'backup' == args[0]:
-        logger.info('Database backup wanted...')
-        backup()
-    elif 'restore' == args[0]:
-        logger.info('Database restore wanted...')
-        restore()
-    elif 'fetch' == args[0]:
-        logger.info('Database fetch wanted...')
-        fetch()
-    else:
-        message = "FATAL: Argument '%s' not recognized" % (args[0])
-        logAndPrint(message, 'error', True, True)
+    # every pipeline of the run reports what its stages used
+    labels = {}
+    for o, a in options:
+        if o in ('-f', '--full'):
+            labels['kind'] = 'full'
+        elif o in ('-i', '--incremental'):
+            labels['kind'] = 'incremental'
+    if targets and args[0] != 'schedule':
+        labels['target'] = '+'.join(targets)
+    report = instrument.RunReport(args[0], labels)
+    pipeline.observe(report.add_pipeline)
+
+    # backups are throttled, restores and fetches run at full speed
+    throttler = None
+    if args[0] in ('backup', 'stream'):
+        throttler = _start_throttle()
+
+    status = 1
+    try:
+        # detect which action is needed and call it's method
+        if 'backup' == args[0]:
+            logger.info('Database backup wanted...')
+            backup()
+        elif 'restore' == args[0]:
+            logger.info('Database restore wanted...')
+            restore()
+        elif 'fetch' == args[0]:
+            logger.info('Database fetch wanted...')
+            fetch()
+        elif 'stream' == args[0]:
+            logger.info('Binary log stream wanted...')
+            stream()
+        elif 'schedule' == args[0]:
+            logger.info('Scheduled backups wanted...')
+            schedule()
+        elif 'verify' == args[0]:
+            logger.info('Backup verification wanted...')
+            verify()
+        elif 'prune' == args[0]:
+            logger.info('Backup pruning wanted...')
+            prune()
+        elif 'consolidate' == args[0]:
+            logger.info('Backup consolidation wanted...')
+            consolidate()
+        elif 'inspect' == args[0]:
+            logger.info('Backup inspection wanted...')
+            inspect()
+        else:
+            message = "FATAL: Argument '%s' not recognized" % (args[0])
+            logAndPrint(message, 'error', True, True)
+        status = 0
+    except SystemExit, e:
+        status = e.code or 0
+        raise
+    finally:
+        if throttler is not None:
+            throttler.close()
+        _finish_report(status)
+
+def _start_throttle():
+    """lower the priority of the run and cap its stages as [Throttle] says
+
+    returns the throttle.Throttle (with its load monitor running in adaptive
+    mode), None when no stage is capped.
+    """
+    if not config.has_section('Throttle'):
+        return None
+
+    nice = int(_get_option('Throttle', 'nice', 0))
+    if nice:
+        os.nice(nice)
+    # commands inherit the io priority of pmb.py
+    ionice = _get_option('Throttle', 'ionice', 'none')
+    if ionice != 'none':
+        classes = {'idle': '3', 'best-effort': '2'}
+        if ionice not in classes:
+            logAndPrint('FATAL: [Throttle] ionice must be idle, best-effort or none', 'error', True, True)
+        try:
+            if subprocess.call(['ionice', '-c', classes[ionice], '-p', str(os.getpid())]) != 0:
+                logAndPrint('Could not lower the io priority, ionice failed', 'warn')
+        except OSError, e:
+            logAndPrint('Could not lower the io priority: %s' % (e), 'warn')
+
+    # rate_<stage> in MB/s, cpu_<stage> in percent of a cpu
+    rates = {}
+    shares = {}
+    for option, value in config.items('Throttle'):
+        if option.startswith('rate_') and value and float(value) > 0:
+            rates[option[len('rate_'):]] = float(value) * 1024 * 1024
+        elif option.startswith('cpu_') and value and float(value) > 0:
+            shares[option[len('cpu_'):]] = float(value) / 100
+
+    adaptive = _get_option('Throttle', 'adaptive', 'false') == 'true'
+    if adaptive and not rates and not shares:
+        # the dump is what loads the server
+        rates['mysqldump'] = float(_get_option('Throttle', 'adaptive_rate', 50)) * 1024 * 1024
+    if not rates and not shares:
+        return None
+
+    throttler = throttle.Throttle(rates, shares)
+    pipeline.set_throttle(throttler)
+    logger.info('Throttling %s' % (', '.join(['%s to %.1f MB/s' % (n, r / 1048576) for n, r in sorted(rates.items())] +
+            ['%s to %d%% cpu' % (n, c * 100) for n, c in sorted(shares.items())])))
+
+    if adaptive:
+        disks = scheduler.DiskMonitor()
+        disk_path = _get_option('Throttle', 'disk_path', config.get('Backup', 'bin_log_path'))
+
+        def threads_running():
+            rows = _server_status("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+            return rows and int(rows[0]['Value']) or None
+
+        def replication_lag():
+            rows = _server_status('SHOW SLAVE STATUS')
+            if not rows or rows[0].get('Seconds_Behind_Master') in (None, 'NULL'):
+                return None
+            return int(rows[0]['Seconds_Behind_Master'])
+
+        def disk_util():
+            disks.sample()
+            return disks.utilization(disk_path)
+
+        probes = [(name, func, float(_get_option('Throttle', name, default)))
+                for name, func, default in (
+                    ('threads_running', threads_running, 32),
+                    ('replication_lag', replication_lag, 30),
+                    ('disk_util', disk_util, 90))]
+        monitor = throttle.LoadMonitor(throttler, probes,
+                float(_get_option('Throttle', 'interval', 5)),
+                float(_get_option('Throttle', 'min_percent', 5)) / 100)
+        monitor.start()
+    return throttler
+
+def _server_status(sql):
+    """the rows `sql` returns as dicts by column name"""
+    process = subprocess.Popen(_client_args('mysql') + ['--batch', '-e', sql],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(err.strip())
+    lines = out.splitlines()
+    if not lines:
+        return []
+    header = lines[0].split('\t')
+    return [dict(zip(header, line.split('\t'))) for line in lines[1:]]
+
+def _finish_report(status):
+    """write the run report where [Metrics] says and print it for --profile"""
+    report.finish(status)
+    try:
+        if _get_option('Metrics', 'report_path'):
+            path = report.write_json(config.get('Metrics', 'report_path'))
+            logger.info('Run report written to %s' % (path))
+        if _get_option('Metrics', 'textfile_path'):
+            report.write_prometheus(config.get('Metrics', 'textfile_path'))
+    except (IOError, OSError), e:
+        logAndPrint('Could not write the run report: %s' % (e), 'warn')
+
+    for o, a in options:
+        if '--profile' == o:
+            for line in report.profile():
+                logAndPrint(line, 'info')
+            break
 
 def backup():
     """backup method for running full and incremental mysql backups"""
+    targets = [a for o, a in options if '--target' == o]
+    if len(targets) > 1:
+        _backup_incrementals(targets)
+        return
+
+    # a full and an incremental of the same database never run at the same
+    # time, not even when they were started by different cron lines
+    lock = None
+    if os.path.isdir(_get_option('Backup', 'full_path', '')):
+        lock = scheduler.target_lock(config.get('Backup', 'full_path'))
+
     backup_option_found = False
     for o, a in options:
         if o in ('-f', '--full'):
@@ -140,32 +351,33 @@ def _backup_full():
         message = 'FATAL: No backup file prefix was set in the config.cfg. Backup terminating...'
         logAndPrint(message, 'error', True, True)
 
-    test_file = '%sfull_%s*' % (file_prefix, date)
-    
     # check if a full backup has been run for today
-    if glob.glob(test_file):
-        message = 'Full backup for today already exists. Backup terminating...'
-        logAndPrint(message, 'error', True, True)
+    index = _backup_index()
+    # a synthetic full backup (see consolidate) doesn't stand in for the real
+    # one, which can be any of the fulls of today
+    for chain in reversed(index.chains):
+        if chain['full']['time'] < date:
+            break
+        if chain['full']['time'].startswith(date) and not chain['full'].get('synthetic'):
+            message = 'Full backup for today already exists. Backup terminating...'
+            logAndPrint(message, 'error', True, True)
     
     # prepare to run the full back up
     file_name = '%sfull_%s' % (file_prefix, dateandtime)
+    metadata = _artifact_metadata('full')
 
     logAndPrint('Preparing binary logs...', 'info')
 
-    # this checks the bin-log directory and puts the output into a file.
-    # we do this because we need to keep track of the last bin-log
-    # available before we flush them with --flush-logs.
-    # this will let us easily grab the bin-logs created after a full backup
-    # to be used with incremental backups.
-    ls_command = "ls -l --time-style=long-iso %s |grep %s.0 | awk '{print $8}' > bin_logs" \
-            % (config.get('Backup', 'bin_log_path'),
-               config.get('Backup', 'bin_log_name'))
-    os.system(ls_command)
-    last_line = file('bin_logs', "r").readlines()[-1]
-    os.system('rm -f bin_log_info')
-    os.system('touch bin_log_info')
-
-    file('bin_log_info', 'w').write('before:' + last_line)
+    # remember the last binary log before we flush them with --flush-logs.
+    # the incrementals start with the log after it. a running binary log
+    # stream captures the logs itself, up to the end of that one.
+    catalog = _binlog_catalog()
+    latest_log = catalog.latest()['sequence']
+    if not binlogstream.running(full_path):
+        catalog.captured_through = latest_log
+        catalog.save()
+    binlog_start = {'file': '%s.%06d' % (config.get('Backup', 'bin_log_name'), latest_log + 1),
+            'position': 4}
 
     message = 'Running mysqldump and creating File: %s' % (file_name)
     logAndPrint(message, 'info')
@@ -185,18 +397,69 @@ def _backup_full():
             database = a
             break
 
-    backup_command = 'mysqldump %s --add-drop-database --flush-logs -u%s %s --password=%s --result-file=%s.sql' % \
+    backup_command = 'mysqldump %s --add-drop-database --flush-logs -u%s %s --password=%s' % \
         (database, #config.get('Backup', 'database'),
         config.get('Backup', 'username'),
         db_host,
-        config.get('Backup', 'password'),
-        file_name)
+        config.get('Backup', 'password'))
+
+    # a deduplicated backup only stores the chunks of the dump that aren't
+    # in the repository yet
+    if _get_option('Dedup', 'enabled', 'false') == 'true':
+        repository = _dedup_repository()
+        # garbage collection keeps the chunks of the backups in the index, the
+        # repository stays locked until this one is in it
+        repository.lock()
+        try:
+            artifact = _dedup_backup(repository, shlex.split(backup_command), file_name, metadata)
+            _index_backup('full', artifact, now, metadata, binlog_start)
+        finally:
+            repository.unlock()
+        message = 'Full backup created successfully!'
+        logAndPrint(message, 'info')
+        return
+
+    # a parallel dump splits the tables into chunks and dumps them with
+    # several connections sharing one snapshot
+    if int(_get_option('Parallel', 'dump_workers', 1)) > 1:
+        databases = [database]
+        if database == '--all-databases':
+            databases = None
+        manifest = _parallel_backup(databases, file_name, metadata)
+        _index_backup('full', file_name, now, metadata, manifest['binlog'])
+        message = 'Full backup created successfully!'
+        logAndPrint(message, 'info')
+        return
+
+    # a seekable backup is written as blocks with an index of its tables,
+    # one table can be restored without decoding the rest
+    if _get_option('Backup', 'seekable', 'false') == 'true':
+        artifact = _seekable_backup(shlex.split(backup_command), file_name, metadata,
+                database != '--all-databases' and database or None)
+        _index_backup('full', artifact, now, metadata, binlog_start)
+        message = 'Full backup created successfully!'
+        logAndPrint(message, 'info')
+        return
+
+    # in streaming mode the dump never touches the disk as plain sql, it is
+    # piped through compression and encryption straight into the artifact
+    if _get_option('Backup', 'streaming', 'false') == 'true':
+        artifact = _stream_backup(shlex.split(backup_command), file_name, metadata)
+        _index_backup('full', artifact, now, metadata, binlog_start)
+        message = 'Full backup created successfully!'
+        logAndPrint(message, 'info')
+        return
+
+    backup_command = '%s --result-file=%s.sql' % (backup_command, file_name)
     #os.system(backup_command)
     backup_command = shlex.split(backup_command)
+    step = report.start('mysqldump')
     process = subprocess.Popen(backup_command, stderr=subprocess.PIPE)
     
     # Set the stderr (if any) in p_out
     p_out = process.communicate()
+    if os.path.exists('%s.sql' % (file_name)):
+        report.stop(step, None, os.path.getsize('%s.sql' % (file_name)))
 
     # Check for erorrs in the output. Error will not be None and 
     # will be longer than ''
@@ -213,46 +476,404 @@ def _backup_full():
     message = 'Full backup created successfully!'
     logAndPrint(message, 'info')
 
-    if config.get('Encryption', 'enabled')is not None and \
-    config.get('Encryption', 'enabled') == 'true':
-
+    if metadata['encrypted']:
         logAndPrint('Encryption enabled...', 'info')
         logAndPrint('Encrypting and compressing backup...', 'info')
+    else:
+        logAndPrint('Compressing backup...', 'info')
+
+    try:
+        artifact = _encode_file('%s.sql' % (file_name), file_name, metadata)
+    except pipeline.PipelineError, e:
+        os.system('rm -f %s.sql' % (file_name))
+        logAndPrint('Backup encountered a fatal error when compressing and encrypting. Exiting...', 'error')
+        logAndPrint(e, 'error', exit=True)
+
+    _index_backup('full', artifact, now, metadata, binlog_start)
+
+    logAndPrint('File compression completed...', 'info')
+
+def _stream_backup(dump_command, file_name, metadata):
+    """run `dump_command` through compression (and gpg) into a single artifact
+
+    all stages run at the same time connected by pipes, so the only file
+    written is the final `file_name`.sql.zst (or .sql.zst.gpg, ...). if any
+    stage fails the partial artifact is removed and the backup exits.
+    """
+    p = pipeline.Pipeline()
+    p.add_command(dump_command, 'mysqldump')
+    output = file_name + _add_artifact_stages(p, metadata)
+
+    logAndPrint('Streaming backup into %s...' % (output), 'info')
+
+    try:
+        p.run(output=output)
+    except pipeline.PipelineError, e:
+        message = 'Backup encountered a fatal error in the backup pipeline. Exiting...'
+        logAndPrint(message, 'error')
+        logAndPrint(e, 'error', exit=True)
+
+    compression.write_metadata(output, metadata)
+    return output
+
+def _seekable_backup(dump_command, file_name, metadata, database):
+    """run `dump_command` into the seekable backup `file_name`.sql.blocks
+
+    the blocks are gzip, whatever codec [Compression] asks for, and the
+    index of the tables is written next to them as .sql.blocks.idx.
+    """
+    encrypt, decrypt = _gpg_commands()
+    metadata.update({'codec': 'gzip', 'format': 'blocks'})
+    index = seekable.new_index(metadata, database)
+    # chunked encryption encrypts the file of blocks as a whole, gpg every
+    # block on its own
+    chunked = metadata['encrypted'] and metadata.get('encryption') == 'chunked'
+
+    p = pipeline.Pipeline()
+    p.add_command(dump_command, 'mysqldump')
+    p.add_filter(seekable.writer(index,
+            metadata['level'],
+            int(_get_option('Compression', 'workers', 4)),
+            int(_get_option('Compression', 'block_size', pipeline.BLOCK_SIZE)),
+            not chunked and encrypt or None), 'blocks')
+    if chunked:
+        p.add_filter(encryption.encryptor(encrypt,
+                int(_get_option('Encryption', 'chunk_size', encryption.CHUNK_SIZE)),
+                int(_get_option('Compression', 'workers', 4))), 'encrypt')
+
+    output = file_name + '.sql' + seekable.EXTENSION
+    logAndPrint('Streaming backup into %s...' % (output), 'info')
+
+    try:
+        p.run(output=output)
+    except (pipeline.PipelineError, seekable.SeekableError, encryption.EncryptionError, OSError), e:
+        message = 'Backup encountered a fatal error in the backup pipeline. Exiting...'
+        logAndPrint(message, 'error')
+        logAndPrint(e, 'error', exit=True)
+
+    seekable.write_index(output, index)
+    logAndPrint('Backup is %d tables in %d blocks (%d bytes)' %
+            (len(seekable.tables(index)), len(index['blocks']), index['size']), 'info')
+    compression.write_metadata(output, metadata)
+    return output
+
+def _gpg_commands():
+    """the gpg command lines encrypting and decrypting a block or chunk on its own
+
+    encryption is None when [Encryption] isn't enabled.
+    """
+    encrypt = None
+    if _get_option('Encryption', 'enabled') == 'true':
+        encrypt = ['gpg', '--always-trust', '--compress-algo', 'none',
+            '-r', config.get('Encryption', 'key_name'), '--encrypt']
+    decrypt = ['gpg', '--quiet', '--passphrase-file',
+        _get_option('Encryption', 'passphrase_file', ''), '--decrypt']
+    return encrypt, decrypt
+
+def _dedup_repository(path=None):
+    """the chunk repository of deduplicated backups, [Dedup] repository or `path`"""
+    encrypt, decrypt = _gpg_commands()
+
+    if path is None:
+        path = _get_option('Dedup', 'repository',
+                os.path.join(config.get('Backup', 'full_path'), 'dedup'))
+    return dedup.Repository(path,
+            int(_get_option('Dedup', 'level', 6)),
+            encrypt,
+            decrypt,
+            int(_get_option('Compression', 'workers', 4)),
+            _get_option('Dedup', 'key_file', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dedup.key')))
+
+def _dedup_backup(repository, dump_command, file_name, metadata):
+    """store the output of `dump_command` in the chunk `repository`, which the caller has locked
+
+    the artifact is the chunk index `file_name`.sql.dedup listing the
+    chunks of the dump in order.
+    """
+    metadata.update({'codec': 'dedup', 'level': repository.level})
+    chunker = dedup.Chunker(int(_get_option('Dedup', 'min_chunk', 512)) * 1024,
+            int(_get_option('Dedup', 'mask_bits', 13)),
+            int(_get_option('Dedup', 'max_chunk', 8192)) * 1024)
+    index = dedup.new_index(repository.path, metadata)
+
+    p = pipeline.Pipeline()
+    p.add_command(dump_command, 'mysqldump')
+    p.add_filter(repository.writer(index, chunker), 'dedup')
+
+    output = file_name + '.sql' + dedup.EXTENSION
+    logAndPrint('Storing backup in the chunk repository %s...' % (repository.path), 'info')
+
+    try:
+        repository.register(os.path.join(config.get('Backup', 'full_path'), backupindex.INDEX_NAME))
+        p.run()
+    except (pipeline.PipelineError, dedup.DedupError, OSError, IOError), e:
+        message = 'Backup encountered a fatal error in the backup pipeline. Exiting...'
+        logAndPrint(message, 'error')
+        logAndPrint(e, 'error', exit=True)
+    dedup.write_index(output, index)
+
+    logAndPrint('Backup is %d chunks (%d bytes), %d of them new' %
+            (len(index['chunks']), index['size'], index['new_chunks']), 'info')
+    compression.write_metadata(output, metadata)
+    return output
+
+def _dedup_collect_garbage():
+    """remove the chunks no deduplicated backup of any user of the repository refers to any more"""
+    full_path = config.get('Backup', 'full_path')
+    repository = _dedup_repository()
+    repository.lock(exclusive=True)
+    try:
+        users = repository.users()
+        if users is None:
+            # a repository from before the list of its users is only known
+            # to be ours when it is the default one in full_path
+            if os.path.abspath(repository.path) != os.path.abspath(os.path.join(full_path, 'dedup')):
+                logAndPrint('The chunk repository %s has no list of the backups using it, its garbage is not collected' %
+                        (repository.path), 'warn')
+                return
+            users = ([os.path.join(full_path, backupindex.INDEX_NAME)], True)
+        paths, complete = users
+        if not complete:
+            logAndPrint('The list of the backups using the chunk repository %s may be incomplete (see %s), its garbage is not collected' %
+                    (repository.path, os.path.join(repository.path, dedup.USERS_NAME)), 'warn')
+            return
+
+        # read under the exclusive lock, no backup adds chunks meanwhile
+        indexes = []
+        for path in paths:
+            if not os.path.exists(path):
+                logAndPrint('%s uses the chunk repository %s and is missing, its garbage is not collected' %
+                        (path, repository.path), 'warn')
+                return
+            for chain in backupindex.BackupIndex(path).chains:
+                artifact = os.path.join(os.path.dirname(path), chain['full']['file'])
+                if artifact.endswith(dedup.EXTENSION) and os.path.exists(artifact):
+                    indexes.append(dedup.read_index(artifact))
+        removed = repository.collect_garbage(indexes)
+    finally:
+        repository.unlock()
+    if removed:
+        logAndPrint('Removed %d chunks no backup refers to' % (removed), 'info')
+
+def _parallel_backup(databases, file_name, metadata):
+    """dump `databases` (None for all of them) into the chunked backup directory `file_name`"""
+    workers = int(_get_option('Parallel', 'dump_workers', 4))
+    chunk_rows = int(_get_option('Parallel', 'chunk_rows', 500000))
+    logAndPrint('Running parallel dump with %d workers into %s...' % (workers, file_name), 'info')
+
+    # the files of the backup are encrypted with one data key
+    data_key = encryption.DataKey(_gpg_commands()[0])
+    dump = paralleldump.ParallelDump(
+            _client_args('mysql'),
+            _client_args('mysqldump'),
+            databases,
+            file_name,
+            lambda p: _add_artifact_stages(p, metadata, data_key=data_key),
+            workers,
+            chunk_rows,
+            metadata)
+    try:
+        manifest = dump.run()
+    except (paralleldump.ParallelDumpError, pipeline.PipelineError, OSError), e:
+        os.system('rm -rf %s' % (file_name))
+        message = 'Backup encountered a fatal error in the parallel dump. Exiting...'
+        logAndPrint(message, 'error')
+        logAndPrint(e, 'error', exit=True)
+
+    chunks = sum([len(t['chunks']) for t in manifest['tables']])
+    logAndPrint('Dumped %d tables in %d chunks' % (len(manifest['tables']), chunks), 'info')
+    return manifest
+
+def _artifact_metadata(kind):
+    """the codec settings and encryption `kind` ('full' or 'inc') backups are written with
 
-        encryption_command = 'gpg --always-trust -r %s --output %s.gpg --encrypt %s.sql' \
-                % (config.get('Encryption', 'key_name'), file_name, file_name)
-        logAndPrint('running: %s' % encryption_command, 'info')
-
-        encryption_command = shlex.split(encryption_command)
-        process = subprocess.Popen(encryption_command, stderr=subprocess.PIPE)
-        p_out = process.communicate()
-
-        # Check for erorrs in the output. Error will not be None and 
-        # will be longer than ''
-        # 
-        # we completely ignore stdout since it's being piped into
-        # a file using the mysqldump --result-file flag.
-        for v in p_out:
-            if v is not None and v != '':
-                os.system('rm -f %s.sql' % (file_name))
-                message = 'Backup encountered a fatal error when encrypting with GPG. Exiting...'
-                logAndPrint(message, 'error')
-                logAndPrint(v, 'error', exit=True)
-
-        #os.system(encryption_command)
-        logAndPrint('removing unencrypted sql file...(%s.sql)' \
-                % (file_name), 'info')
-        os.system('rm -rf %s.sql' % file_name)
+    the codec and level can be set separately for full and incremental
+    backups in [Compression]. exits if the codec is not known.
+    """
+    name = _get_option('Compression', '%s_codec' % (kind), 'gzip')
+    try:
+        compression.get_codec(name)
+    except compression.CompressionError, e:
+        logAndPrint(e, 'error', True, True)
+
+    metadata = {
+        'codec': name,
+        'level': int(_get_option('Compression', '%s_level' % (kind),
+            _get_option('Compression', 'level', 6))),
+        'long_window': int(_get_option('Compression', 'long_window', 0)),
+        'encrypted': _get_option('Encryption', 'enabled') == 'true',
+    }
+    if metadata['encrypted']:
+        # chunked encryption runs in-process on a thread pool, gpg encrypts
+        # the whole artifact on one thread
+        metadata['encryption'] = _get_option('Encryption', 'mode', 'chunked')
+        if metadata['encryption'] not in ('chunked', 'gpg'):
+            logAndPrint('FATAL: [Encryption] mode must be chunked or gpg, not %s' % (metadata['encryption']), 'error', True, True)
+        if metadata['encryption'] == 'chunked':
+            try:
+                encryption.load()
+            except (encryption.EncryptionError, EnvironmentError), e:
+                logAndPrint('FATAL: %s' % (e), 'error', True, True)
+    return metadata
+
+def _add_artifact_stages(p, metadata, workers=None, data_key=None):
+    """add compression, and encryption if enabled, to pipeline `p` and return the file extension
+
+    the compressor uses `workers` threads, [Compression] workers by default.
+    chunked encryption uses the encryption.DataKey `data_key`, a new key by
+    default.
+    """
+    codec = compression.get_codec(metadata['codec'])
+    codec.add_compress(p,
+            metadata['level'],
+            workers or int(_get_option('Compression', 'workers', 4)),
+            metadata['long_window'],
+            int(_get_option('Compression', 'block_size', pipeline.BLOCK_SIZE)))
+    extension = '.sql' + codec.extension
+
+    if metadata['encrypted'] and metadata.get('encryption') == 'chunked':
+        p.add_filter(encryption.encryptor(_gpg_commands()[0],
+                int(_get_option('Encryption', 'chunk_size', encryption.CHUNK_SIZE)),
+                workers or int(_get_option('Compression', 'workers', 4)),
+                data_key), 'encrypt')
+        extension += encryption.EXTENSION
+    elif metadata['encrypted']:
+        # the data is already compressed, don't let gpg spend time on it again
+        p.add_command(['gpg', '--always-trust', '--compress-algo', 'none',
+            '-r', config.get('Encryption', 'key_name'), '--encrypt'])
+        extension += '.gpg'
+
+    return extension
+
+def _compactor():
+    """a compaction.Compactor for an incremental, None unless [Compaction] is enabled"""
+    if _get_option('Compaction', 'enabled', 'false') != 'true':
+        return None
+    # folding reorders row changes, the tables it is safe for are named
+    tables = [t.strip() for t in _get_option('Compaction', 'tables', '').split(',') if t.strip()]
+    if not tables:
+        logAndPrint('[Compaction] is enabled but names no tables, nothing is compacted', 'warn')
+        return None
+    return compaction.Compactor(int(_get_option('Compaction', 'window', 1000)),
+            int(_get_option('Compaction', 'window_seconds', 60)), tables)
+
+def _encode_file(path, file_name, metadata):
+    """compress (and encrypt) the sql file `path` into the artifact `file_name` and remove `path`
+
+    returns the name of the artifact.
+    """
+    p = pipeline.Pipeline()
+    output = file_name + _add_artifact_stages(p, metadata)
+    p.run(source=path, output=output)
+    compression.write_metadata(output, metadata)
+    os.remove(path)
+    return output
+
+def _client_args(program):
+    """command line for the mysql client `program` with the credentials from config.cfg"""
+    return [program,
+            '-u%s' % (config.get('Backup', 'username')),
+            '-h', _get_option('Backup', 'db_host', 'localhost'),
+            '--password=%s' % (config.get('Backup', 'password'))]
+
+def _decode_artifact(artifact, output, metadata=None, stop=None, tables=None):
+    """decrypt and/or decompress a backup artifact into the plain sql file `output`
+
+    `output` is a path or an open file. the codec comes from the metadata
+    written with the artifact, or its extension for older backups. a chunked
+    backup directory is decoded file by file in the order of its manifest.
+    `stop` is a pitr.StopFilter cutting an incremental at the restore point,
+    `tables` the tables ("db.table" or "table") a seekable backup is cut to.
+    """
+    if artifact.endswith(seekable.EXTENSION):
+        f = output
+        if isinstance(output, basestring):
+            f = open(output, 'wb')
+        step = report.start('blocks read')
+        try:
+            index = seekable.read_index(artifact)
+            parts = None
+            if tables:
+                parts = seekable.select(index, tables)
+            source = None
+            if index.get('encryption') == 'chunked':
+                source = encryption.Reader(artifact, _gpg_commands()[1])
+            read = seekable.read(artifact, index, f, parts, _gpg_commands()[1],
+                    int(_get_option('Compression', 'workers', 4)), source)
+            report.stop(step, None, read)
+        except (seekable.SeekableError, encryption.EncryptionError), e:
+            raise pipeline.PipelineError([str(e)])
+        finally:
+            if f is not output:
+                f.close()
+        return
+
+    if artifact.endswith(dedup.EXTENSION):
+        index = dedup.read_index(artifact)
+        # fetch copies the chunks into a repository next to the index
+        repository = os.path.join(os.path.dirname(artifact), 'dedup')
+        if not os.path.isdir(repository):
+            repository = index['repository']
+
+        f = output
+        if isinstance(output, basestring):
+            f = open(output, 'wb')
+        step = report.start('dedup read')
+        try:
+            _dedup_repository(repository).read(index, f)
+            report.stop(step, None, index['size'])
+        except dedup.DedupError, e:
+            raise pipeline.PipelineError([str(e)])
+        finally:
+            if f is not output:
+                f.close()
+        return
+
+    if os.path.isdir(artifact):
+        manifest = paralleldump.read_manifest(artifact)
+        if manifest is None:
+            raise pipeline.PipelineError(['%s is not a chunked backup' % (artifact)])
+
+        f = output
+        if isinstance(output, basestring):
+            f = open(output, 'wb')
+        try:
+            for name in paralleldump.manifest_files(manifest):
+                _decode_artifact(os.path.join(artifact, name), f, manifest.get('compression'))
+        finally:
+            if f is not output:
+                f.close()
+        return
+
+    p = pipeline.Pipeline()
+    source = None
+    if artifact.endswith(encryption.EXTENSION):
+        p.add_filter(encryption.decryptor(_gpg_commands()[1],
+                int(_get_option('Compression', 'workers', 4))), 'decrypt')
+        source = artifact
+    elif artifact.endswith('.gpg'):
+        p.add_command(['gpg', '--quiet', '--passphrase-file',
+            config.get('Encryption', 'passphrase_file'), '--decrypt', artifact])
+    else:
+        p.add_command(['cat', artifact])
+
+    if metadata is None:
+        metadata = compression.read_metadata(artifact)
 
+    # backups are compressed before they are encrypted. older encrypted
+    # backups were compressed by gpg itself and have no codec.
+    if metadata is not None:
+        codec = compression.get_codec(metadata['codec'])
     else:
-        logAndPrint('Compressing backup...', 'info')
+        codec = compression.codec_for_file(artifact)
+    if codec is not None:
+        codec.add_decompress(p, int(_get_option('Compression', 'workers', 4)))
 
-        compress_command = 'gzip %s' % (file_name)
-        os.system(compress_command)
+    if stop is not None:
+        p.add_filter(stop, 'stop')
 
-        logAndPrint('File compression completed...', 'info')
+    p.run(source=source, output=output)
 
-    
 def _backup_incremental():
     """incremental backup"""
     logAndPrint('Incremental backup in progress...', 'info')
@@ -267,6 +888,8 @@ def _backup_incremental():
         message = 'FATAL: No backup file prefix was set in the config.cfg. Backup terminating...'
         logAndPrint(message, 'error', True, True)
 
+    metadata = _artifact_metadata('inc')
+
     # check last binary log before the last full flush. +1 from that is the start of the bin log range
     full_path = config.get('Backup', 'full_path')
     if not full_path:
@@ -281,42 +904,35 @@ def _backup_incremental():
         logAndPrint(message, 'error', True, True)
 
     # check for the existence of a full backup for today
-    full_backup_test = '%sfull_%s*' % (file_prefix, date)
-    if not glob.glob(full_backup_test):
+    index = _backup_index()
+    latest = index.latest_full()
+    if latest is None or not latest['time'].startswith(date):
         message = 'There was no full backup run for today. Run the application with --full, then run incrementals after that'
         logAndPrint(message, 'error', True, True)
 
-    # relist binary logs
-    os.system('rm -rf bin_logs')
-    ls_command = "ls -l --time-style=long-iso %s |grep %s.0 | awk '{print $8}' > bin_logs" % (config.get('Backup', 'bin_log_path'),
-        config.get('Backup', 'bin_log_name'))
-    os.system(ls_command)
-    last_line = file('bin_logs', "r").readlines()[-1]
-    
-    # add end to bin_log_info
-    file('bin_log_info', 'a').write('last:' + last_line)
-
-    bin_log_info = file('bin_log_info', 'r').readlines()
+    if binlogstream.running(full_path):
+        message = 'The binary log stream is running and writes the incrementals. Backup terminating...'
+        logAndPrint(message, 'info', True, True)
 
-    bin_log_hash = {}
-    for line in bin_log_info:
-        t_line = line.split(':')
-        bin_log_hash[t_line[0]] = t_line[1]
-
-    log_tracker = {"first": int(bin_log_hash['before'].split('.')[1]) + 1, "last": int(bin_log_hash['last'].split('.')[1])}
-    log_tracker['first'] = int(bin_log_hash['before'].split('.')[1]) + 1
-    log_tracker['last'] = int(bin_log_hash['last'].split('.')[1])
+    # the logs written since the last backup, from the one after the last
+    # captured log to the one being written now
+    catalog = _binlog_catalog()
+    if catalog.captured_through is None:
+        logAndPrint('The binary log catalog does not know the last captured log. Run a full backup first.', 'error', True, True)
+    first = catalog.captured_through + 1
+    last = catalog.latest()['sequence']
 
     logAndPrint('Found beginning and end of the binary logs...', 'info')
-    logAndPrint(log_tracker, 'info')
+    logAndPrint({'first': first, 'last': last}, 'info')
 
-    #flush the logs, update bin_log_info and copy the binary log files over
+    # flush the logs so the last one is closed, then bring the catalog up to date
     logAndPrint('Flushing binary logs...', 'info')
-    os.system('mysql %s -u%s --password=%s -e "flush logs;"' %
-        (config.get('Backup', 'database'),config.get('Backup', 'username'),config.get('Backup', 'password')))
-
-    os.system('rm -rf bin_log_info')
-    file('bin_log_info', 'w').write('before:%s' % (last_line))
+    process = subprocess.Popen(_client_args('mysql') + ['-e', 'FLUSH LOGS;'], stderr=subprocess.PIPE)
+    p_out = process.communicate()
+    if process.returncode != 0:
+        logAndPrint('Backup encountered an error when flushing the binary logs. Exiting...', 'error')
+        logAndPrint(p_out[1], 'error', exit=True)
+    _refresh_catalog(catalog)
 
     # change directories
     if config.get('Backup', 'inc_path'):
@@ -329,33 +945,30 @@ def _backup_incremental():
         logger.info('No inc path found in config.cfg. Staying in current directory (%s)...' % (config.get('Backup', 'full_path')))
 
 
-    # start copying
-    logger.info('Copying binary logs...')
-    if not quiet:
-        print 'Copying binary logs...'
-
-    import pickle
+    # stage the binary logs. they are hard linked (or read in place) rather
+    # than copied, see binlog.stage()
+    logAndPrint('Staging binary logs...', 'info')
 
-    ignore_file = '%signore_logs' % (config.get('Backup', 'full_path'))
+    # logs written by a restore are left out
+    bin_logs = []
+    for entry in catalog.between(first, last):
+        bin_logs.append(os.path.join(config.get('Backup', 'bin_log_path'), entry['name']))
+        logAndPrint(entry['name'], 'info')
 
-    ignore_list = None
+    staging_path = _get_option('Backup', 'binlog_staging_path',
+            os.path.join(config.get('Main', 'tmp'), 'pmb_binlogs'))
+    # targets backed up at the same time each stage into a directory of their own
+    staging_path = os.path.join(staging_path, file_prefix)
+    step = report.start('stage binlogs')
     try:
-        f = open(ignore_file, 'rb')
-        ignore_list = pickle.load(f)
-        f.close()
-    except:
-        pass
-
-    os.system('rm -rf %s' % (ignore_file))
-
-    for i in range(int(log_tracker['first']), int(log_tracker['last']) + 1):
-        log_file = '%s.%06d' % (config.get('Backup', 'bin_log_name'), i)
-        test_file = '%s%s' % (config.get('Backup', 'bin_log_path'), log_file)
-        if ignore_list is not None and test_file in ignore_list:
-            continue
-        os.system('cp %s%s .' % 
-            (config.get('Backup', 'bin_log_path'), log_file))
-        logAndPrint(log_file, 'info')
+        staged = binlog.stage(bin_logs, staging_path,
+                _get_option('Backup', 'binlog_staging', 'link'),
+                throttler is not None and throttler.bucket('copy') or None)
+    except (binlog.BinlogError, OSError), e:
+        logAndPrint('Backup encountered a fatal error staging the binary logs. Exiting...', 'error')
+        logAndPrint(e, 'error', exit=True)
+    binlog_bytes = sum([os.path.getsize(l) for l in staged])
+    report.stop(step, binlog_bytes, binlog_bytes)
 
     # check for the existence of --database or --all-databases options
     # and parse which database will be pulled out of the bin log
@@ -369,54 +982,473 @@ def _backup_incremental():
             break
 
     # convert to sql and compress
-    bam_a_list = []
     logAndPrint('Converting binary logs to SQL...', 'info')
-    for i in range(int(log_tracker['first']), int(log_tracker['last']) + 1):
-        bam_a_list.append('%s.%06d' % (config.get('Backup', 'bin_log_name'), i))
     file_name = '%sinc_%s' % (file_prefix, dateandtime)
 
     convert_to_sql = 'mysqlbinlog %s %s > %s.sql' % \
             (database, 
-             ' '.join(bam_a_list),
+             ' '.join(staged),
              file_name)
-    os.system(convert_to_sql)
+    compactor = _compactor()
+    step = report.start('mysqlbinlog')
+    if compactor is None:
+        os.system(convert_to_sql)
+    else:
+        # the row changes are compacted on their way to mysqlbinlog
+        p = pipeline.Pipeline()
+        p.add_filter(compaction.read_logs(staged), 'binlogs')
+        p.add_filter(compactor, 'compact')
+        p.add_command(['mysqlbinlog'] + database.split() + ['-'], 'mysqlbinlog')
+        try:
+            p.run(output='%s.sql' % (file_name))
+        except pipeline.PipelineError, e:
+            binlog.unstage(staged, bin_logs)
+            logAndPrint('Backup encountered a fatal error compacting the binary logs. Exiting...', 'error')
+            logAndPrint(e, 'error', exit=True)
+        metadata['compaction'] = compactor.stats
+    report.stop(step, binlog_bytes, os.path.getsize('%s.sql' % (file_name)))
 
-    logAndPrint('Removing converted bin logs', 'info')
-    for log in bam_a_list:
-        os.system('rm -rf %s' % (log))
+    logAndPrint('Removing staged bin logs', 'info')
+    binlog.unstage(staged, bin_logs)
 
     logAndPrint('Converted successfully!', 'info')
 
-    if config.get('Encryption', 'enabled') == 'true':
-        # encrypt
+    if metadata['encrypted']:
         logAndPrint('Encryption enabled...', 'info')
         logAndPrint('Encrypting and compressing backup...', 'info')
-
-        encryption_command = 'gpg --always-trust -r %s --output %s.gpg --encrypt %s.sql' % \
-                (config.get('Encryption', 'key_name'), file_name, file_name)
-        logAndPrint('running: %s' % encryption_command, 'info')
-        encryption_command = shlex.split(encryption_command)
-        process = subprocess.Popen(encryption_command, stderr=subprocess.PIPE)
-        p_out = process.communicate()
-        #os.system(encryption_command)
-        for v in p_out:
-            if v is not None and v != '':
-                os.system('rm -f %s.sql' % (file_name))
-                message = 'Backup encountered a fatal error when encrypting with GPG. Exiting...'
-                logAndPrint(message, 'error')
-                logAndPrint(v, 'error', exit=True)
-
-        logAndPrint('removing unencrypted sql file...(%s.sql)' % (file_name), 'info')
-        os.system('rm -rf %s.sql' % file_name)
     else:
-        # start compressing...
         logAndPrint('Compressing incremental backup...', 'info')
 
-        compress_command = 'gzip %s' % (file_name)
-        os.system(compress_command)
+    try:
+        artifact = _encode_file('%s.sql' % (file_name), file_name, metadata)
+    except pipeline.PipelineError, e:
+        os.system('rm -f %s.sql' % (file_name))
+        logAndPrint('Backup encountered a fatal error when compressing and encrypting. Exiting...', 'error')
+        logAndPrint(e, 'error', exit=True)
+
+    # the binary log coordinates the incremental ends at
+    last_log = catalog.find('%s.%06d' % (config.get('Backup', 'bin_log_name'), last))
+    _index_backup('inc', artifact, now, metadata, {
+            'file': last_log['name'],
+            'position': last_log['end_position'],
+            'last_event': last_log['last_event'],
+            'logs': [os.path.basename(l) for l in bin_logs]})
+
+    catalog.captured_through = last
+    catalog.save()
+
+    logAndPrint('Compressing backup completed successfully!', 'info')
+
+def _backup_incrementals(names):
+    """incremental backups of the targets `names`, which share a database host and its binary logs
+
+    the binary logs are read once and split by database (see binlogdemux.py)
+    instead of being decoded by mysqlbinlog --database once per target.
+    """
+    now = datetime.today()
+    date = now.strftime('%Y%m%d')
+    dateandtime = now.strftime('%Y%m%d_%H%M')
+    logAndPrint('Incremental backups of %s in progress...' % (', '.join(names)), 'info')
+
+    targets = []
+    failed = []
+    shared = None
+    lead = None
+    locks = []
+    try:
+        for name in names:
+            _use_target(name)
+            logs = (_get_option('Backup', 'db_host', 'localhost'),
+                    config.get('Backup', 'bin_log_path'),
+                    config.get('Backup', 'bin_log_name'))
+            if shared is None:
+                shared = logs
+            elif logs != shared:
+                logAndPrint('FATAL: --target=%s does not share the database host and binary logs of --target=%s. '
+                        'Backup terminating...' % (name, names[0]), 'error', True, True)
+            if not config.get('Backup', 'file_prefix'):
+                logAndPrint('FATAL: No backup file prefix was set for %s. Backup terminating...' % (name), 'error', True, True)
+            full_path = config.get('Backup', 'full_path')
+            inc_path = _get_option('Backup', 'inc_path', full_path)
+            for path in (full_path, inc_path):
+                if not os.path.isdir(path):
+                    logAndPrint('FATAL: %s of %s does not exist. Backup terminating...' % (path, name), 'error', True, True)
+            locks.append(scheduler.target_lock(full_path))
+
+            latest = _backup_index().latest_full()
+            if latest is None or not latest['time'].startswith(date):
+                logAndPrint('%s: there was no full backup run for today, run it with --full first' % (name), 'error')
+                failed.append(name)
+                continue
+            if binlogstream.running(full_path):
+                logAndPrint('%s: the binary log stream is running and writes the incrementals' % (name), 'info')
+                continue
+
+            # the logs are scanned and checksummed for the first target only
+            if lead is None:
+                catalog = _binlog_catalog()
+                lead = catalog
+            else:
+                catalog = binlog.BinlogCatalog(os.path.join(full_path, 'binlog_catalog.json'),
+                        config.get('Backup', 'bin_log_path'),
+                        config.get('Backup', 'bin_log_name'))
+                catalog.adopt(lead)
+            if catalog.captured_through is None:
+                logAndPrint('%s: the binary log catalog does not know the last captured log, run a full backup first' % (name), 'error')
+                failed.append(name)
+                continue
+            targets.append({
+                'name': name,
+                'database': config.get('Backup', 'database'),
+                'file_name': os.path.join(inc_path, '%sinc_%s' % (config.get('Backup', 'file_prefix'), dateandtime)),
+                'metadata': _artifact_metadata('inc'),
+                'catalog': catalog,
+                'first': catalog.captured_through + 1,
+            })
+
+        if targets:
+            _demux_incrementals(targets, lead, now)
+    finally:
+        for lock in locks:
+            lock.close()
+
+    failed += [t['name'] for t in targets if t.get('error')]
+    if failed:
+        logAndPrint('FATAL: The incrementals of %s failed. Backup terminating...' % (', '.join(failed)), 'error', True, True)
+    logAndPrint('Compressing backup completed successfully!', 'info')
+
+def _demux_incrementals(targets, lead, now):
+    """write the incrementals of `targets` from one pass over the binary logs of the `lead` catalog"""
+    last = lead.latest()['sequence']
+    _use_target(targets[0]['name'])
+    logAndPrint('Flushing binary logs...', 'info')
+    process = subprocess.Popen(_client_args('mysql') + ['-e', 'FLUSH LOGS;'], stderr=subprocess.PIPE)
+    p_out = process.communicate()
+    if process.returncode != 0:
+        logAndPrint('Backup encountered an error when flushing the binary logs. Exiting...', 'error')
+        logAndPrint(p_out[1], 'error', exit=True)
+    _refresh_catalog(lead)
+    for target in targets:
+        if target['catalog'] is not lead:
+            target['catalog'].adopt(lead)
+
+    # every log a target needs is staged once. logs written by a restore are
+    # left out of the target that ignores them
+    names = []
+    for target in targets:
+        target['logs'] = [e['name'] for e in target['catalog'].between(target['first'], last)]
+        names += [n for n in target['logs'] if n not in names]
+    names.sort(key=lead.sequence)
+    bin_logs = [os.path.join(config.get('Backup', 'bin_log_path'), name) for name in names]
+    logAndPrint('Staging binary logs %s...' % (', '.join(names)), 'info')
+
+    staging_path = os.path.join(_get_option('Backup', 'binlog_staging_path',
+            os.path.join(config.get('Main', 'tmp'), 'pmb_binlogs')), config.get('Backup', 'file_prefix'))
+    step = report.start('stage binlogs')
+    try:
+        staged = binlog.stage(bin_logs, staging_path,
+                _get_option('Backup', 'binlog_staging', 'link'),
+                throttler is not None and throttler.bucket('copy') or None)
+    except (binlog.BinlogError, OSError), e:
+        logAndPrint('Backup encountered a fatal error staging the binary logs. Exiting...', 'error')
+        logAndPrint(e, 'error', exit=True)
+    binlog_bytes = sum([os.path.getsize(l) for l in staged])
+    report.stop(step, binlog_bytes, binlog_bytes)
+
+    # one pipeline per target, mysqlbinlog reading the events of its
+    # database from a pipe
+    outputs = []
+    threads = []
+    workers = max(1, int(_get_option('Compression', 'workers', 4)) / len(targets))
+    for target in targets:
+        read_end, write_end = os.pipe()
+        target['output'] = binlogdemux.Output(target['database'], target['logs'],
+                os.fdopen(write_end, 'wb', pipeline.BLOCK_SIZE))
+        outputs.append(target['output'])
+        p = pipeline.Pipeline()
+        target['compactor'] = _compactor()
+        if target['compactor'] is not None:
+            p.add_filter(target['compactor'], 'compact')
+        p.add_command(['mysqlbinlog', '-'], 'mysqlbinlog')
+        target['artifact'] = target['file_name'] + _add_artifact_stages(p, target['metadata'], workers)
+
+        def run(p=p, target=target, read_end=read_end):
+            try:
+                p.run(source=read_end, output=target['artifact'])
+            except pipeline.PipelineError, e:
+                target['error'] = e
+        thread = threading.Thread(target=run)
+        thread.start()
+        threads.append(thread)
+
+    logAndPrint('Splitting the binary logs into the incrementals of %s...' %
+            (', '.join([t['database'] for t in targets])), 'info')
+    step = report.start('demux')
+    error = None
+    read = 0
+    try:
+        read = binlogdemux.demultiplex(zip(names, staged), outputs)
+    except (binlogdemux.DemuxError, IOError), e:
+        error = e
+    # the end of the input lets the pipelines finish
+    for output in outputs:
+        try:
+            output.f.close()
+        except (IOError, OSError):
+            pass
+    for thread in threads:
+        thread.join()
+    report.stop(step, read, sum([o.bytes for o in outputs]))
+    if error is not None:
+        # the incrementals were cut short
+        for target in targets:
+            if os.path.exists(target['artifact']):
+                os.remove(target['artifact'])
+        binlog.unstage(staged, bin_logs)
+        logAndPrint('Backup encountered a fatal error reading the binary logs. Exiting...', 'error')
+        logAndPrint(error, 'error', exit=True)
+
+    logAndPrint('Removing staged bin logs', 'info')
+    binlog.unstage(staged, bin_logs)
+
+    # the binary log coordinates the incrementals end at
+    last_log = lead.find('%s.%06d' % (config.get('Backup', 'bin_log_name'), last))
+    for target in targets:
+        if target.get('error') is None and target['output'].error is not None:
+            target['error'] = target['output'].error
+        if target.get('error') is not None:
+            logAndPrint('%s: %s' % (target['name'], target['error']), 'error')
+            if os.path.exists(target['artifact']):
+                os.remove(target['artifact'])
+            continue
+        _use_target(target['name'])
+        if target['compactor'] is not None:
+            target['metadata']['compaction'] = target['compactor'].stats
+        compression.write_metadata(target['artifact'], target['metadata'])
+        _index_backup('inc', target['artifact'], now, target['metadata'], {
+                'file': last_log['name'],
+                'position': last_log['end_position'],
+                'last_event': last_log['last_event'],
+                'logs': target['logs']})
+        target['catalog'].captured_through = last
+        target['catalog'].save()
+        logAndPrint('%s: %s written' % (target['name'], os.path.basename(target['artifact'])), 'info')
+
+def schedule():
+    """run the backups of the [Target:<name>] sections, several at a time"""
+    kinds = []
+    for o, a in options:
+        if o in ('-f', '--full') and 'full' not in kinds:
+            kinds.append('full')
+        elif o in ('-i', '--incremental') and 'incremental' not in kinds:
+            kinds.append('incremental')
+    if not kinds:
+        message = 'FATAL: No backup option was passed in. Full or incremental flag is required. Schedule terminating...'
+        logAndPrint(message, 'error', True, True)
+    # a target's full backup comes before its incremental
+    kinds.sort()
+
+    names = [a for o, a in options if '--target' == o]
+    if not names:
+        names = [section[len(scheduler.TARGET_PREFIX):] for section in config.sections()
+                if section.startswith(scheduler.TARGET_PREFIX)]
+    if not names:
+        logAndPrint('FATAL: There are no [Target:<name>] sections in config.cfg. Schedule terminating...', 'error', True, True)
+
+    jobs = []
+    for kind in kinds:
+        kind_jobs = [_target_job(name, kind) for name in names]
+        if kind == 'incremental' and _get_option('Scheduler', 'demux', 'true') == 'true':
+            kind_jobs = _demux_jobs(kind_jobs)
+        jobs += kind_jobs
+
+    max_io_util = _get_option('Scheduler', 'max_io_util')
+    max_wait = _get_option('Scheduler', 'max_wait')
+    s = scheduler.Scheduler(int(_get_option('Scheduler', 'jobs', 4)),
+            int(_get_option('Scheduler', 'host_jobs', 2)),
+            max_io_util is not None and float(max_io_util) or None,
+            float(_get_option('Scheduler', 'poll', 5)),
+            max_wait is not None and float(max_wait) or None)
+
+    logAndPrint('Running %d backups of %d targets...' % (len(jobs), len(names)), 'info')
+    s.run(jobs)
+
+    failed = 0
+    for job in jobs:
+        if job.error is not None:
+            failed += 1
+            logAndPrint('%s did not run: %s' % (job, job.error), 'error')
+        elif job.process.returncode != 0:
+            failed += 1
+            logAndPrint('%s failed after %d seconds, see the log' % (job, job.finished - job.started), 'error')
+        else:
+            logAndPrint('%s done in %d seconds' % (job, job.finished - job.started), 'info')
+    if failed:
+        logAndPrint('%d of %d backups failed' % (failed, len(jobs)), 'error', exit=True)
+
+def _target_job(name, kind):
+    """the scheduler job running the `kind` ('full' or 'incremental') backup of the target `name`"""
+    section = scheduler.TARGET_PREFIX + name
+    if not config.has_section(section):
+        logAndPrint('FATAL: There is no [%s] section in config.cfg. Schedule terminating...' % (section), 'error', True, True)
+
+    def option(key, default=None):
+        return _get_option(section, key, _get_option('Backup', key, default))
+
+    paths = []
+    for path in (option('full_path'), option('inc_path')):
+        if path is not None and path not in paths:
+            if not os.path.isdir(path):
+                logAndPrint('FATAL: %s of [%s] does not exist. Schedule terminating...' % (path, section), 'error', True, True)
+            paths.append(path)
+
+    command = [sys.executable, os.path.abspath(__file__), 'backup', '--%s' % (kind),
+            '--target=%s' % (name), '--quiet']
+    command += ['--config=%s' % (a) for o, a in options if '--config' == o]
+    return scheduler.Job(name, kind,
+            option('db_host', 'localhost'),
+            command,
+            paths,
+            int(option('priority', 0)),
+            int(_get_option(section, 'min_free_space', _get_option('Scheduler', 'min_free_space', 0))) * 1024 * 1024)
+
+def _demux_jobs(jobs):
+    """merge the incremental `jobs` of targets sharing a database host and its binary logs, one job per host
+
+    the merged job reads the binary logs once for all of its targets, see
+    _backup_incrementals().
+    """
+    groups = []
+    by_logs = {}
+    for job in jobs:
+        section = scheduler.TARGET_PREFIX + job.target
+        key = (job.host,) + tuple([_get_option(section, option, _get_option('Backup', option))
+                for option in ('bin_log_path', 'bin_log_name')])
+        if key not in by_logs:
+            by_logs[key] = []
+            groups.append(by_logs[key])
+        by_logs[key].append(job)
+
+    merged = []
+    for group in groups:
+        if len(group) == 1:
+            merged.append(group[0])
+            continue
+        paths = []
+        for job in group:
+            paths += [path for path in job.paths if path not in paths]
+        merged.append(scheduler.Job('+'.join([job.target for job in group]),
+                group[0].kind,
+                group[0].host,
+                group[0].command + ['--target=%s' % (job.target) for job in group[1:]],
+                paths,
+                max([job.priority for job in group]),
+                max([job.min_free_space for job in group])))
+    return merged
+
+def _select_target(name):
+    """use the options of [Target:`name`] in place of the ones in [Backup]"""
+    section = scheduler.TARGET_PREFIX + name
+    if not config.has_section(section):
+        logAndPrint('FATAL: There is no [%s] section in config.cfg' % (section), 'error', True, True)
+    for option, value in config.items(section):
+        config.set('Backup', option, value)
+
+# the options of [Backup] as config.cfg has them, once _use_target() changed them
+_backup_options = None
+
+def _use_target(name):
+    """switch [Backup] to the options of the target `name`, for runs backing up several targets"""
+    global _backup_options
+    if _backup_options is None:
+        _backup_options = config.items('Backup')
+    config.remove_section('Backup')
+    config.add_section('Backup')
+    for option, value in _backup_options:
+        config.set('Backup', option, value)
+    _select_target(name)
+
+def stream():
+    """follow the binary logs and write what is added to them as incrementals until stopped"""
+    full_path = config.get('Backup', 'full_path')
+    try:
+        os.chdir(full_path)
+        logger.info('Changing directories... (%s)' % (full_path))
+    except Exception, e:
+        logAndPrint('Directory does not exist. Stream terminating...', 'error', True, True)
+
+    try:
+        lock = binlogstream.lock(full_path)
+    except binlogstream.StreamError, e:
+        logAndPrint(e, 'error', True, True)
+
+    catalog = _binlog_catalog()
+    relay = None
+    if _get_option('Stream', 'source', 'directory') == 'server':
+        # mysqlbinlog keeps copies of the server's logs in the spool directory
+        spool_path = _get_option('Stream', 'spool_path',
+                os.path.join(config.get('Main', 'tmp'), 'pmb_stream'))
+        if not os.path.isdir(spool_path):
+            os.makedirs(spool_path)
+        catalog.bin_log_path = spool_path
+        relay = _client_args('mysqlbinlog') + ['--read-from-remote-server', '--raw',
+                '--stop-never', '--result-file=%s' % (os.path.join(spool_path, ''))]
+
+    metadata = _artifact_metadata('inc')
+    database = ['--database=%s' % (config.get('Backup', 'database'))]
+    for o,a in options:
+        if '--all-databases' == o:
+            database = []
+            break
+        elif '--database' == o:
+            database = ['--database=%s' % (a)]
+            break
+
+    def write_segment(name, path, start, end, last_event):
+        _stream_segment(name, path, start, end, last_event, metadata, database)
+
+    s = binlogstream.BinlogStream(catalog,
+            catalog.refresh,
+            write_segment,
+            float(_get_option('Stream', 'interval', 5)),
+            relay)
+    signal.signal(signal.SIGTERM, lambda signum, frame: s.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: s.stop())
+
+    logAndPrint('Streaming the binary logs from %s.%06d...' %
+            (catalog.name, (catalog.captured_through or 0) + 1), 'info')
+    try:
+        s.run()
+    except (binlogstream.StreamError, binlog.BinlogError, OSError, IOError), e:
+        logAndPrint('The binary log stream stopped on an error. Exiting...', 'error')
+        logAndPrint(e, 'error', exit=True)
+    finally:
+        lock.close()
+    logAndPrint('Binary log stream stopped', 'info')
+
+def _stream_segment(name, path, start, end, last_event, metadata, database):
+    """write the events of the binary log `name` from `start` to `end` as an incremental"""
+    now = datetime.today()
+    inc_path = config.get('Backup', 'inc_path') or config.get('Backup', 'full_path')
+    # segments of one minute are told apart by where they start
+    file_name = os.path.join(inc_path, '%sinc_%s_%s_%d' %
+            (config.get('Backup', 'file_prefix'), now.strftime('%Y%m%d_%H%M'), name, start))
+
+    p = pipeline.Pipeline()
+    p.add_command(['mysqlbinlog'] + database +
+            ['--start-position=%d' % (start), '--stop-position=%d' % (end), path], 'mysqlbinlog')
+    output = file_name + _add_artifact_stages(p, metadata)
+    p.run(output=output)
+    compression.write_metadata(output, metadata)
+
+    _index_backup('inc', output, now, metadata, {
+            'file': name,
+            'start': start,
+            'position': end,
+            'last_event': last_event,
+            'logs': [name]})
+    logAndPrint('Streamed %s from %d to %d into %s' % (name, start, end, os.path.basename(output)), 'info')
 
-        logAndPrint('Compressing backup completed successfully!', 'info')
-    
 def restore():
     """restore method"""
     logAndPrint('Restore needs confirmation...', 'info')
@@ -436,17 +1468,19 @@ def restore():
         sys.exit(2)
     logger.info('Restoring database...')"""
 
-    extension = '.sql.gz'
-    if config.get('Encryption', 'enabled') == 'true':
-        extension = '.gpg'
-
+    _time = _date = stop_datetime = stop_position = None
+    tables = []
     for o,a in options:
-        if '--time' in o:
+        if '--table' == o:
+            tables.append(a)
+        elif '--time' == o:
             _time = a
-
-    for o,a in options:
-        if '--date' in o:
+        elif '--date' == o:
             _date = a
+        elif '--stop-datetime' == o:
+            stop_datetime = a
+        elif '--stop-position' == o:
+            stop_position = a
 
     #_time = options['time']
     #_date = options['date']
@@ -459,76 +1493,76 @@ def restore():
     except Exception, e:
         logAndPrint('FATAL: Directory does not exist. Backup terminating...', 'error', True, True)
 
-    full_backup = glob.glob('%sfull_%s*' % (config.get('Backup', 'file_prefix'), str(_date)))
+    # the stream would back up everything the restore writes
+    if binlogstream.running(config.get('Backup', 'full_path')):
+        logAndPrint('FATAL: Stop the binary log stream before restoring. Restore terminating...', 'error', True, True)
 
-    if len(full_backup) < 1:
-        message = 'FATAL: Looks like there was no full backup run for this date. Restore terminating...'
-        logAndPrint(message, 'error', True, True)
-
-    if len(full_backup) > 1:
-        message = 'FATAL: Looks like there is more than one full backup for this date in %s.' % \
-            (config.get('Backup', 'full_path'))
-        logAndPrint(message, 'error', True, True)
-
-    full_output = full_backup[0].split('.')[0] + '.sql'
-
-    decrypt = 'gpg --quiet --passphrase-file %s --output %s%s --decrypt %s' % \
-        (config.get('Encryption', 'passphrase_file'),
-         config.get('Main', 'tmp'),
-         full_output,
-         full_backup[0])
-
-    decrypt = shlex.split(decrypt)
-    
-    logAndPrint('Decrypting full and incremental backup files...','info')
-    #os.system(decrypt)
-    process = subprocess.Popen(decrypt, stderr=subprocess.PIPE)
-    p_out = process.communicate()
-
-    for v in p_out:
-        if v is not None and v != '':
-            logAndPrint('Backup encountered a fatal error when dencrypting with GPG. Exiting...', 'error')
-            logAndPrint(v, 'error', exit=True)
-
-    if config.get('Backup', 'inc_path'):
+    # the full backup taken last before the restore point and the
+    # incrementals holding the events up to it. the events of the last
+    # incremental are only replayed up to the restore point.
+    try:
+        if stop_position is not None:
+            stop_log, position = pitr.parse_stop_position(stop_position)
+            full, incs = _backup_index().resolve_until(coordinate=(stop_log, position))
+            stop = pitr.StopFilter(stop_log=stop_log, stop_position=position)
+            logAndPrint('Restoring up to binary log position %s:%d...' % (stop_log, position), 'info')
+        else:
+            if stop_datetime is not None:
+                target = pitr.parse_stop_datetime(stop_datetime)
+            elif _date is not None and _time is not None:
+                # --time is a minute, everything written during it is included
+                target = time.mktime(datetime.strptime(str(_date) + str(_time), '%Y%m%d%H%M').timetuple()) + 60
+            else:
+                logAndPrint('FATAL: The restore option needs --date and --time, --stop-datetime or --stop-position. Restore terminating...', 'error', True, True)
+            full, incs = _backup_index().resolve_until(timestamp=target)
+            stop = pitr.StopFilter(stop_time=target)
+            logAndPrint('Restoring up to %s...' % (datetime.fromtimestamp(target).strftime('%Y-%m-%d %H:%M:%S')), 'info')
+    except ValueError:
+        logAndPrint('FATAL: --date must look like 20100222 and --time like 1830. Restore terminating...', 'error', True, True)
+    except pitr.StopPointError, e:
+        logAndPrint('FATAL: %s. Restore terminating...' % (e), 'error', True, True)
+    except backupindex.BackupIndexError, e:
+        logAndPrint('FATAL: %s. Restore terminating...' % (e), 'error', True, True)
+
+    # the window of compacted transactions holding the restore point is
+    # replayed whole or not at all, the stop filter rolls it back
+    if incs and not tables and (incs[-1].get('compaction') or {}).get('transactions_in', 0) > \
+            (incs[-1].get('compaction') or {}).get('transactions_out', 0):
+        if stop_position is not None:
+            inside = incs[-1].get('binlog') and \
+                    (int(incs[-1]['binlog']['file'].rsplit('.', 1)[1]), incs[-1]['binlog']['position']) > \
+                    (int(stop_log.rsplit('.', 1)[1]), position)
+        else:
+            inside = incs[-1]['timestamp'] > target
+        if inside:
+            logAndPrint('The restore point falls within %s, whose row changes were compacted in windows of up to %d transactions '
+                    '(%d seconds): the restore stops before the window holding the restore point' %
+                    (incs[-1]['file'], incs[-1]['compaction'].get('window', 0),
+                     incs[-1]['compaction'].get('window_seconds', 0)), 'warn')
+
+    # a table is restored from the blocks of a seekable full backup alone,
+    # the incrementals replay the whole database and aren't used
+    if tables:
+        if not full['file'].endswith(seekable.EXTENSION):
+            logAndPrint('FATAL: %s is not a seekable backup, --table needs one (see [Backup] seekable). Restore terminating...' %
+                    (full['file']), 'error', True, True)
+        # the names are checked before anything is written to the server
         try:
-            os.chdir(config.get('Backup', 'inc_path'))
-            logAndPrint('Changing directories... (%s)' % (config.get('Backup', 'inc_path')), 'info')
-        except Exception, e:
-            logAndPrint('FATAL: Directory does not exist. Backup terminating...', 'error', True, True)
-
-    inc_back_name = '%sinc_%s_' % (config.get('Backup', 'file_prefix'), str(_date))
-
-    # glob for inc files
-    inc_backs = glob.glob(inc_back_name + '*')
-
-    decrypt_incs = []
-
-    # loop for a crap ton and check if the file exists in the list
-    # there is most likely a more efficient way of doing this...
-    for inc in inc_backs:
-        inc_time = inc.split('.')[0].split('_')[3]
-        if inc_time <= _time:
-            decrypt_incs.append(inc)
+            seekable.select(seekable.read_index(os.path.join(config.get('Backup', 'full_path'), full['file'])), tables)
+        except (seekable.SeekableError, ValueError), e:
+            logAndPrint('FATAL: %s. Restore terminating...' % (e), 'error', True, True)
+        if incs:
+            logAndPrint('Restoring %s as of the full backup %s, the %d incrementals after it are not replayed' %
+                    (', '.join(tables), full['file'], len(incs)), 'warn')
+        incs = []
 
-    decrypt_incs.sort()
-    
-    inc_outputs = []
-    for inc in decrypt_incs:
-        out = config.get('Main', 'tmp') + inc.split('.')[0] + '.sql'
-        decrypt = 'gpg --passphrase-file %s --output %s --decrypt %s' % \
-            (config.get('Encryption', 'passphrase_file'),
-             out,
-             inc)
-        os.system(decrypt)
-        inc_outputs.append(out)
-
-    build_me = 'cat %s%s %s > %stemp_restore.sql' % ( \
-            config.get('Main', 'tmp'),
-            full_output,
-            ' '.join(inc_outputs),
-            config.get('Main', 'tmp'))
-    os.system(build_me)
+    inc_path = _get_option('Backup', 'inc_path', config.get('Backup', 'full_path'))
+    artifacts = [os.path.join(config.get('Backup', 'full_path'), full['file'])]
+    incrementals = {}
+    for inc in incs:
+        artifacts.append(os.path.join(inc_path, inc['file']))
+        incrementals[artifacts[-1]] = (inc.get('binlog') or {}).get('logs', [])
+    logAndPrint('Restoring %s and %d incremental backups...' % (full['file'], len(incs)), 'info')
 
     database = config.get('Backup', 'database')
     for o,a in options:
@@ -554,11 +1588,10 @@ def restore():
 
     #os.system(start_flush)
 
-    ls_command = "ls -l --time-style=long-iso %s |grep %s.0 | awk '{print $8}' > ignore_bin_log" % \
-        (config.get('Backup', 'bin_log_path'),
-        config.get('Backup', 'bin_log_name'))
-    os.system(ls_command)
-    first_log = file('ignore_bin_log', "r").readlines()[-1]
+    # everything the restore writes to the binary logs from here on must not
+    # end up in an incremental
+    catalog = _binlog_catalog()
+    first_log = catalog.latest()['sequence']
     
     """
     logAndPrint('Dropping database...', 'info')
@@ -597,35 +1630,33 @@ def restore():
 
     logAndPrint('Restoring database from backup...', 'info')
 
-    cat_full_command = 'cat %stemp_restore.sql' % (config.get('Main', 'tmp'))
-    cat_full_command = shlex.split(cat_full_command)
-    
-    # The output of this process will be piped into the restore process below.
-    # This is done because subprocess separates the processes and how
-    # piping actually works.
-    cat_process = subprocess.Popen(cat_full_command, stdout=subprocess.PIPE)
-
     restore_command = 'mysql %s --password=%s' % \
             (database, #config.get('Backup', 'database'),
              config.get('Backup', 'password'))
     restore_command = shlex.split(restore_command)
 
-    process = subprocess.Popen(restore_command, stdin=cat_process.stdout, stderr=subprocess.PIPE)
-    p_out = process.communicate()
+    # the full backup can be loaded over several connections, the
+    # incrementals are always replayed in order on top of it
+    if int(_get_option('Parallel', 'load_workers', 1)) > 1 and not tables:
+        _parallel_restore(artifacts.pop(0), restore_command)
 
-    for v in p_out:
-        if v is not None and v != '':
-            message = 'Backup encountered an error when accessing MySQL. Backup Exiting...'
-            logAndPrint(message, 'error')
-            logAndPrint(v, 'error', exit=True)
+    if artifacts:
+        _stream_restore(artifacts, restore_command, incrementals, stop, tables)
 
-    #os.system(restore_command)
+    # a stop position can also lie past the last event of the incremental
+    # (or stream segment) holding it
+    reached = stop.reached
+    if not reached and incs and stop.stop_log is not None and incs[-1].get('binlog'):
+        end = incs[-1]['binlog']
+        reached = (pitr.log_sequence(end['file']), end['position']) >= \
+                (pitr.log_sequence(stop.stop_log), stop.stop_position)
 
-    ls_command = "ls -l --time-style=long-iso %s |grep %s.0 | awk '{print $8}' > ignore_bin_log" % \
-        (config.get('Backup', 'bin_log_path'),
-        config.get('Backup', 'bin_log_name'))
-    os.system(ls_command)
-    last_log = file('ignore_bin_log', "r").readlines()[-1]
+    if not reached and incs:
+        logAndPrint('The backups end before the restore point, restored up to the last incremental (%s)' %
+                (incs[-1]['file']), 'warn')
+
+    _refresh_catalog(catalog)
+    last_log = catalog.latest()['sequence']
 
     end_flush = 'mysql --password=%s -e "FLUSH LOGS;"' % \
             (config.get('Backup', 'password'))
@@ -642,52 +1673,431 @@ def restore():
 
     #os.system(end_flush)
 
-    first_log = first_log.split('.')[1]
-    last_log = last_log.split('.')[1]
+    _refresh_catalog(catalog)
+    catalog.ignore(first_log, last_log)
+    catalog.save()
+
+    logAndPrint('Restore completed!', 'info')
+
+def _parallel_restore(artifact, restore_command):
+    """load the full backup `artifact` over [Parallel] load_workers connections"""
+    workers = int(_get_option('Parallel', 'load_workers', 4))
+    logAndPrint('Loading %s with %d connections...' % (os.path.basename(artifact), workers), 'info')
+
+    load = parallelrestore.ParallelLoad(restore_command,
+            _decode_artifact,
+            workers,
+            int(_get_option('Parallel', 'commit_every', 100)))
 
-    logs = []
-    for i in range(int(first_log), int(last_log) + 1):
-        logs.append('%s%s.%06d' % \
-                (config.get('Backup', 'bin_log_path'),
-                config.get('Backup', 'bin_log_name'),
-                i))
+    manifest = None
+    if os.path.isdir(artifact):
+        manifest = paralleldump.read_manifest(artifact)
 
     try:
-        os.chdir(config.get('Backup', 'full_path'))
-    except:
-        logAndPrint('Director does not exist', 'error', True, True)
-    
-    import pickle
+        if manifest is not None:
+            load.load_chunked(artifact, manifest)
+        else:
+            load.load_dump(artifact)
+    except (parallelrestore.ParallelLoadError, pipeline.PipelineError, OSError, IOError), e:
+        message = 'Backup encountered an error when accessing MySQL. Backup Exiting...'
+        logAndPrint(message, 'error')
+        logAndPrint(e, 'error', exit=True)
+
+def _stream_restore(artifacts, restore_command, incrementals=None, stop=None, tables=None):
+    """decode `artifacts` one after the other straight into a single mysql process
+
+    nothing is written to disk, every artifact is decrypted and decompressed
+    through a pipeline whose output is the stdin of `restore_command`.
+    `incrementals` maps the artifacts that are incrementals to the binary
+    logs they were converted from, with a `stop` filter their events are
+    only replayed up to the restore point. `tables` restores only those
+    tables of a seekable backup.
+    """
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(restore_command,
+            stdin=subprocess.PIPE,
+            stderr=stderr,
+            close_fds=True)
+
+    error = None
+    for artifact in artifacts:
+        logAndPrint('Restoring %s...' % (os.path.basename(artifact)), 'info')
+        artifact_stop = None
+        if stop is not None and incrementals and artifact in incrementals:
+            stop.start_logs(incrementals[artifact])
+            artifact_stop = stop
+        try:
+            _decode_artifact(artifact, process.stdin, stop=artifact_stop, tables=tables)
+        except pipeline.PipelineError, e:
+            error = 'decoding %s failed: %s' % (os.path.basename(artifact), e)
+            break
+        if artifact_stop is not None and artifact_stop.reached:
+            logAndPrint('Reached the restore point in %s' % (os.path.basename(artifact)), 'info')
+            break
 
     try:
-        f = file('ignore_logs', 'rb')
-        f_logs = pickle.load(f)
-        os.remove('ignore_logs')
-        for log in f_logs:
-            logs.append(log)
-        f = file('ignore_logs', 'wb')
-        pickle.dump(logs, f)
-        f.close()
+        process.stdin.close()
     except IOError:
-        f = file('ignore_logs', 'wb')
-        pickle.dump(logs, f)
-        f.close()
+        pass
+    returncode = process.wait()
+    stderr.seek(0)
+    output = stderr.read().strip()
+    stderr.close()
+
+    # when mysql gives up the decoder only sees a broken pipe, so mysql's own
+    # error is the one worth reporting
+    if returncode != 0 or error is not None:
+        message = 'Backup encountered an error when accessing MySQL. Backup Exiting...'
+        logAndPrint(message, 'error')
+        if output:
+            logAndPrint(output, 'error')
+        logAndPrint(error or 'mysql exited with %d' % (returncode), 'error', exit=True)
 
+def verify():
+    """check the files and binary log coordinates of the backups in the index"""
+    full_path = config.get('Backup', 'full_path')
+    inc_path = _get_option('Backup', 'inc_path', full_path)
+    index = backupindex.BackupIndex(os.path.join(full_path, backupindex.INDEX_NAME))
+    if not index.exists:
+        logAndPrint('FATAL: There is no backup index in %s. Verify terminating...' % (full_path), 'error', True, True)
+
+    # every chain, or the one holding --date --time
+    chains = index.chains
+    _date = _time = None
+    for o, a in options:
+        if '--date' == o:
+            _date = a
+        elif '--time' == o:
+            _time = a
+    if _date is not None and _time is not None:
+        try:
+            chain = index.chain_at(time.mktime(datetime.strptime(str(_date) + str(_time), '%Y%m%d%H%M').timetuple()) + 59)
+        except ValueError:
+            logAndPrint('FATAL: --date must look like 20100222 and --time like 1830. Verify terminating...', 'error', True, True)
+        if chain is None:
+            logAndPrint('FATAL: There is no full backup taken before %s %s. Verify terminating...' % (_date, _time), 'error', True, True)
+        chains = [chain]
+
+    files = []
+    for chain in chains:
+        for entry in [chain['full']] + chain['incrementals']:
+            directory = entry['kind'] == 'full' and full_path or inc_path
+            for f in entry.get('files') or []:
+                files.append({'path': os.path.join(directory, f['path']),
+                        'size': f['size'],
+                        'sha256': f.get('sha256')})
+    unchecked = len([f for f in files if f['sha256'] is None])
+    logAndPrint('Verifying %d backups, %d files...' %
+            (sum([1 + len(c['incrementals']) for c in chains]), len(files)), 'info')
+    if unchecked:
+        logAndPrint('%d files were indexed without a checksum, only their size is checked' % (unchecked), 'warn')
+
+    step = report.start('verify')
+    problems, read = integrity.check_files(files, int(_get_option('Verify', 'workers', 4)))
+    report.stop(step, read, None)
+
+    for chain in chains:
+        if chain['full']['file'].endswith(dedup.EXTENSION):
+            problems += integrity.check_chunks(os.path.join(full_path, chain['full']['file']))
+
+    # the catalog knows where each binary log ended, it is read as it is
+    catalog = binlog.BinlogCatalog(os.path.join(full_path, 'binlog_catalog.json'),
+            config.get('Backup', 'bin_log_path'),
+            config.get('Backup', 'bin_log_name'))
+    coordinates = integrity.Coordinates(catalog, config.get('Backup', 'bin_log_name'))
+    for chain in chains:
+        problems += integrity.check_chain(chain, coordinates)
+
+    for problem in problems:
+        logAndPrint(problem, 'error')
+    if problems:
+        logAndPrint('FATAL: %d problems found. Verify failed!' % (len(problems)), 'error', True, True)
+    logAndPrint('Verified %d files (%d bytes read), the backups are intact!' % (len(files), read), 'info')
+
+def prune():
+    """remove the backups the retention policy in [Retention] no longer keeps"""
+    full_path = config.get('Backup', 'full_path')
+    inc_path = _get_option('Backup', 'inc_path', full_path)
+    if not os.path.isdir(full_path):
+        logAndPrint('FATAL: %s does not exist. Prune terminating...' % (full_path), 'error', True, True)
+
+    if not config.has_section('Retention'):
+        # without a policy everything but the last chain would go
+        logAndPrint('FATAL: There is no [Retention] policy in the config file. Prune terminating...', 'error', True, True)
+    periods = {}
+    for kind in retention.PERIODS:
+        count = int(_get_option('Retention', kind, 0))
+        if count > 0:
+            periods[kind] = count
+    last = int(_get_option('Retention', 'last', 1))
+    incremental_days = _get_option('Retention', 'incremental_days')
+    if incremental_days is not None:
+        incremental_days = float(incremental_days)
+    policy = retention.Policy(last, periods, incremental_days)
+
+    dry_run = False
+    for o, a in options:
+        if '--dry-run' == o:
+            dry_run = True
+
+    # no backup of the target runs while its backups are removed
+    lock = scheduler.target_lock(full_path)
     try:
-        os.chdir(config.get('Backup', 'inc_path'))
-    except:
-        logAndPrint('Directory does not exist', 'error', True, True)
+        index = _backup_index()
+        index.lock()
+        try:
+            plan = retention.plan(index.chains, policy, time.time())
+            for chain, reasons in plan.keep:
+                trimmed = ''
+                if chain in plan.trim:
+                    trimmed = ', removing its %d incrementals' % (len(chain['incrementals']))
+                logAndPrint('Keeping %s (%s)%s' % (chain['full']['file'], ', '.join(reasons), trimmed), 'info')
+
+            files = []
+            backups = 0
+            size = 0
+            for chain in plan.prune + plan.trim:
+                entries = chain['incrementals']
+                if chain in plan.prune:
+                    logAndPrint('Removing %s and its %d incrementals' %
+                            (chain['full']['file'], len(chain['incrementals'])), 'info')
+                    entries = [chain['full']] + entries
+                files += retention.chain_files(chain, full_path, inc_path, chain in plan.trim)
+                backups += len(entries)
+                size += sum([e['size'] for e in entries])
+
+            if dry_run:
+                logAndPrint('Dry run: %d backups, %d files (%d MB) would be removed' %
+                        (backups, len(files), size / 1048576), 'info')
+                return
+            if not backups:
+                logAndPrint('Nothing to prune', 'info')
+                return
+
+            # the index goes first, a prune that dies halfway leaves files no
+            # backup refers to rather than backups whose files are gone
+            index.chains = plan.kept_chains()
+            for chain in plan.trim:
+                chain['incrementals'] = []
+            index.save()
+        finally:
+            index.unlock()
+
+        step = report.start('prune')
+        removed, problems = retention.remove_files(files, int(_get_option('Retention', 'workers', 4)))
+        report.stop(step)
+        for problem in problems:
+            logAndPrint(problem, 'error')
+
+        if [c for c in plan.prune if c['full']['file'].endswith(dedup.EXTENSION)]:
+            _dedup_collect_garbage()
+
+        # the catalog forgets the logs older than every backup left, once the
+        # server purged them
+        oldest = [c['full']['binlog']['file'] for c in index.chains if c['full'].get('binlog')]
+        if oldest and _get_option('Backup', 'binlog_source', 'directory') == 'directory' and \
+                not binlogstream.running(full_path):
+            catalog = binlog.BinlogCatalog(os.path.join(full_path, 'binlog_catalog.json'),
+                    config.get('Backup', 'bin_log_path'),
+                    config.get('Backup', 'bin_log_name'))
+            forgotten = catalog.forget(catalog.sequence(oldest[0]))
+            if forgotten:
+                catalog.save()
+                logAndPrint('Forgot %d purged binary logs no backup needs any more' % (forgotten), 'info')
+    finally:
+        lock.close()
+
+    if problems:
+        logAndPrint('FATAL: %d files could not be removed. Prune failed!' % (len(problems)), 'error', True, True)
+    logAndPrint('Pruned %d backups, %d files (%d MB)' % (backups, removed, size / 1048576), 'info')
+
+def inspect():
+    """list the tables of a seekable full backup and their sizes from its index"""
+    full_path = config.get('Backup', 'full_path')
+    index = backupindex.BackupIndex(os.path.join(full_path, backupindex.INDEX_NAME))
+    if not index.exists:
+        logAndPrint('FATAL: There is no backup index in %s. Inspect terminating...' % (full_path), 'error', True, True)
 
-    logAndPrint('Cleaning up temp files...', 'info')
+    # the full backup of the chain holding --date --time, or the latest one
+    _date = _time = None
+    for o, a in options:
+        if '--date' == o:
+            _date = a
+        elif '--time' == o:
+            _time = a
+    if _date is not None and _time is not None:
+        try:
+            chain = index.chain_at(time.mktime(datetime.strptime(str(_date) + str(_time), '%Y%m%d%H%M').timetuple()) + 59)
+        except ValueError:
+            logAndPrint('FATAL: --date must look like 20100222 and --time like 1830. Inspect terminating...', 'error', True, True)
+        if chain is None:
+            logAndPrint('FATAL: There is no full backup taken before %s %s. Inspect terminating...' % (_date, _time), 'error', True, True)
+        full = chain['full']
+    else:
+        full = index.latest_full()
+        if full is None:
+            logAndPrint('FATAL: There is no full backup in the index. Inspect terminating...', 'error', True, True)
 
-    cleanup_command = 'rm -f %s%s %s' % \
-            (config.get('Main', 'tmp'),
-             full_output,
-             ' '.join(inc_outputs))
+    if not full['file'].endswith(seekable.EXTENSION):
+        logAndPrint('FATAL: %s is not a seekable backup, only those have an index of their tables. Inspect terminating...' %
+                (full['file']), 'error', True, True)
+    try:
+        blocks = seekable.read_index(os.path.join(full_path, full['file']))
+    except (seekable.SeekableError, ValueError), e:
+        logAndPrint('FATAL: %s. Inspect terminating...' % (e), 'error', True, True)
+
+    tables = seekable.tables(blocks)
+    logAndPrint('%s: %d tables, %d bytes of sql in %d blocks (%d bytes)%s' %
+            (full['file'], len(tables), blocks['size'], len(blocks['blocks']),
+            sum([b[1] for b in blocks['blocks']]), blocks.get('encrypted') and ', encrypted' or ''), 'info')
+    logAndPrint('%-40s %14s %14s %14s %7s' % ('table', 'schema', 'data', 'stored', 'blocks'), 'info')
+    for table in tables:
+        name = table['table']
+        if table['database']:
+            name = '%s.%s' % (table['database'], table['table'])
+        logAndPrint('%-40s %14d %14d %14d %7d' %
+                (name, table['schema'], table['data'], table['stored'], table['blocks']), 'info')
+
+def consolidate():
+    """merge a full backup and its incrementals into a synthetic full backup
+
+    they are loaded into the scratch server of [Consolidate] and dumped from
+    it again. the synthetic full backup starts a chain of its own where its
+    last incremental ended, so later restores start from it and replay only
+    the incrementals taken after it.
+    """
+    full_path = config.get('Backup', 'full_path')
+    inc_path = _get_option('Backup', 'inc_path', full_path)
+    file_prefix = config.get('Backup', 'file_prefix')
+    if not os.path.isdir(full_path):
+        logAndPrint('FATAL: %s does not exist. Consolidate terminating...' % (full_path), 'error', True, True)
 
-    os.system(cleanup_command)
+    if not _get_option('Consolidate', 'db_host'):
+        # the backups are loaded into it, it must never be the production server
+        logAndPrint('FATAL: There is no [Consolidate] db_host scratch server in the config file. Consolidate terminating...', 'error', True, True)
+    # host names, ports and sockets can all name the same server, ask both who they are
+    try:
+        production = _server_identity(_client_args('mysql'))
+        scratch = _server_identity(_scratch_args('mysql'))
+    except RuntimeError, e:
+        logAndPrint('FATAL: Could not tell the [Consolidate] scratch server from the server backed up (%s). Consolidate terminating...' %
+                (e), 'error', True, True)
+    if scratch['server_uuid'] == production['server_uuid'] or \
+            (scratch['hostname'], scratch['port']) == (production['hostname'], production['port']):
+        logAndPrint('FATAL: The [Consolidate] scratch server is the server backed up (%s:%s). Consolidate terminating...' %
+                (production['hostname'], production['port']), 'error', True, True)
+
+    # the chain of the full backup taken last before --date and --time, the latest by default
+    _time = _date = None
+    for o, a in options:
+        if '--time' == o:
+            _time = a
+        elif '--date' == o:
+            _date = a
+    index = _backup_index()
+    try:
+        if _date is not None and _time is not None:
+            chain = index.chain_at(time.mktime(datetime.strptime(_date + _time, '%Y%m%d%H%M').timetuple()) + 60)
+        else:
+            chain = index.chains and index.chains[-1] or None
+    except ValueError:
+        logAndPrint('FATAL: --date must look like 20100222 and --time like 1830. Consolidate terminating...', 'error', True, True)
+    if chain is None:
+        logAndPrint('FATAL: There is no full backup to consolidate. Consolidate terminating...', 'error', True, True)
+    full, incs = chain['full'], chain['incrementals']
+    if not incs:
+        logAndPrint('%s has no incrementals, nothing to consolidate' % (full['file']), 'info')
+        return
+    last = incs[-1]
+    for other in index.chains:
+        if (other['full'].get('synthetic') or {}).get('through') == last['file']:
+            logAndPrint('%s is consolidated up to %s already' % (other['full']['file'], last['file']), 'info')
+            return
 
-    logAndPrint('Restore completed!', 'info')
+    database = config.get('Backup', 'database')
+    for o, a in options:
+        if '--all-databases' == o:
+            database = None
+            break
+        elif '--database' == o:
+            database = a
+            break
+
+    # a synthetic full backup stands where its last incremental ended
+    when = datetime.fromtimestamp(last['timestamp'])
+    file_name = os.path.join(full_path, '%sfull_%s_synthetic' % (file_prefix, when.strftime('%Y%m%d_%H%M')))
+    if [n for n in os.listdir(full_path) if n.startswith(os.path.basename(file_name) + '.')]:
+        logAndPrint('FATAL: %s exists already. Consolidate terminating...' % (file_name), 'error', True, True)
+    metadata = _artifact_metadata('full')
+    metadata['synthetic'] = {
+        'full': full['file'],
+        'incrementals': len(incs),
+        'through': last['file'],
+    }
+    logAndPrint('Consolidating %s and %d incrementals up to %s...' % (full['file'], len(incs), last['file']), 'info')
+
+    lock = scheduler.target_lock(full_path)
+    try:
+        # a clean database to load into
+        if database is not None:
+            process = subprocess.Popen(_scratch_args('mysql') + ['-e',
+                    'DROP DATABASE IF EXISTS `%s`; CREATE DATABASE `%s`;' % (database, database)],
+                    stderr=subprocess.PIPE)
+            p_out = process.communicate()
+            if process.returncode != 0:
+                logAndPrint('Consolidate encountered an error preparing the scratch server. Exiting...', 'error')
+                logAndPrint(p_out[1], 'error', exit=True)
+
+        artifacts = [os.path.join(full_path, full['file'])] + [os.path.join(inc_path, inc['file']) for inc in incs]
+        restore_command = _scratch_args('mysql') + (database and [database] or [])
+        step = report.start('load')
+        if int(_get_option('Parallel', 'load_workers', 1)) > 1:
+            _parallel_restore(artifacts.pop(0), restore_command)
+        _stream_restore(artifacts, restore_command)
+        report.stop(step)
+
+        dump_command = _scratch_args('mysqldump') + [database or '--all-databases', '--add-drop-database']
+        artifact = _stream_backup(dump_command, file_name, metadata)
+
+        binlog_end = None
+        if last.get('binlog'):
+            binlog_end = {'file': last['binlog']['file'], 'position': last['binlog']['position']}
+        _index_backup('full', artifact, when, metadata, binlog_end)
+
+        if database is not None and _get_option('Consolidate', 'keep', 'false') != 'true':
+            process = subprocess.Popen(_scratch_args('mysql') + ['-e', 'DROP DATABASE `%s`;' % (database)],
+                    stderr=subprocess.PIPE)
+            process.communicate()
+    finally:
+        lock.close()
+
+    logAndPrint('Synthetic full backup %s written, restores after %s start from it' %
+            (os.path.basename(artifact), when.strftime('%Y-%m-%d %H:%M')), 'info')
+
+def _server_identity(args):
+    """@@hostname, @@port and @@server_uuid of the server the mysql command line `args` connects to"""
+    process = subprocess.Popen(args + ['--batch', '--skip-column-names', '-e',
+            'SELECT @@hostname, @@port, @@server_uuid;'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(err.strip() or '%s exited with %d' % (args[0], process.returncode))
+    fields = out.strip().split('\t')
+    if len(fields) != 3 or not fields[2] or fields[2] == 'NULL':
+        raise RuntimeError('%s did not tell its server_uuid' % (_get_option('Consolidate', 'db_host')))
+    return dict(zip(('hostname', 'port', 'server_uuid'), fields))
+
+def _scratch_args(program):
+    """command line for the mysql client `program` against the scratch server of [Consolidate]"""
+    args = [program,
+            '-u%s' % (_get_option('Consolidate', 'username', config.get('Backup', 'username'))),
+            '-h', _get_option('Consolidate', 'db_host', 'localhost'),
+            '--password=%s' % (_get_option('Consolidate', 'password', config.get('Backup', 'password')))]
+    if _get_option('Consolidate', 'port'):
+        args.append('--port=%s' % (_get_option('Consolidate', 'port')))
+    if _get_option('Consolidate', 'socket'):
+        args.append('--socket=%s' % (_get_option('Consolidate', 'socket')))
+    return args
 
 def fetch():
     """fetch method"""
@@ -708,95 +2118,205 @@ def fetch():
         message = '--date and --time flags are required when trying to fetch a database backup'
         logAndPrint(message, 'error', True, True)
 
-    full_file = '%sfull_%s_*' % (config.get('Backup', 'file_prefix'), _date)
-    inc_file = '%sinc_%s_*' % (config.get('Backup', 'file_prefix'), _date)
-
-    full_list_command = 'ssh %s "ls -l --time-style=long-iso %s | grep %s | awk \'{print $8}\'"' % \
-            (config.get('Fetch', 'connection_string'),
-             config.get('Fetch', 'remote_full_path'),
-             full_file)
-    f = os.popen(full_list_command)
-    full_backup = [l.strip('\n').split(' ')[7] for l in f]
-    print full_backup
+    # one connection to the remote host is shared by everything fetch does
+    transport = _fetch_transport()
+    try:
+        _fetch_backups(transport, _date, _time)
+    finally:
+        transport.close()
+
+def _fetch_backups(transport, _date, _time):
+    """copy the backups needed for `_date` `_time` and decode them into local_save_path"""
+    tmp = config.get('Main', 'tmp')
+    copier = transfer.Transfer(transport,
+            int(_get_option('Fetch', 'workers', 4)),
+            int(_get_option('Fetch', 'part_size', 64)) * 1024 * 1024)
+
+    # the remote index says which backups are needed, it is read in one
+    # round trip instead of listing the remote directories
+    remote_index = config.get('Fetch', 'remote_full_path') + backupindex.INDEX_NAME
+    try:
+        index_data = transport.read_file(remote_index)
+    except transfer.TransferError, e:
+        message = 'Could not read %s on the remote system, run a backup there to create it' % \
+                (backupindex.INDEX_NAME)
+        logAndPrint(message, 'error')
+        logAndPrint(e, 'error', exit=True)
 
-    if len(full_backup) < 1:
-        message = 'It doesn\'t look like the remote system has a full backup for the given date (%s)' % \
-                (_date)
+    try:
+        # --time is a minute, everything taken during it is included
+        target = time.mktime(datetime.strptime(str(_date) + str(_time), '%Y%m%d%H%M').timetuple()) + 59
+        full, incs = backupindex.BackupIndex(remote_index, index_data).resolve(target)
+    except ValueError:
+        logAndPrint('--date must look like 20100222 and --time like 1830', 'error', True, True)
+    except backupindex.BackupIndexError, e:
+        message = 'It doesn\'t look like the remote system has a backup for the given date (%s): %s' % \
+                (_date, e)
         logAndPrint(message, 'error', True, True)
 
-    if len(full_backup) > 1:
-        message = 'It looks like there is more than one backup for the given date (%s)' % (_date)
-        logAndPrint(message, 'error', True, True)
- 
-    full_backup = full_backup[0]
-
-    inc_list_command = 'ssh %s "ls -l --time-style=long-iso %s | grep %s | awk \'{print $8}\'"' % \
-            (config.get('Fetch', 'connection_string'),
-             config.get('Fetch', 'remote_inc_path'),
-             inc_file)
-    f = os.popen(inc_list_command)
-
-    inc_backups = []
-    later_backups = []
-    for l in f.readlines():
-        l = l.strip('\n').replace('  ', ' ').replace('  ', ' ')
-        l = l.split(' ')[7]
-        if int(l.split('.')[0].split('_')[3]) < int(_time):
-            inc_backups.append(config.get('Fetch', 'remote_inc_path') + l)
-            later_backups.append(l)
-
-    scp_command = 'scp %s:"%s%s %s" %s' % (\
-            config.get('Fetch', 'connection_string'),
-            config.get('Fetch', 'remote_full_path'),
-            full_backup,
-            ' '.join(inc_backups),
-            config.get('Main', 'tmp'))
-    os.system(scp_command)
-
-    # decompression or decryption
-    if config.get('Encryption', 'enabled') == 'true':
-        #decrypt
-        tmp = config.get('Main', 'tmp')
-        full_decrypt_command = 'gpg --passphrase-file %s --output %s --decrypt %s' % \
-            (config.get('Encryption', 'passphrase_file'),
-             tmp + full_backup.split('.')[0] + '.sql',
-             tmp + full_backup)
-        os.system(full_decrypt_command)
-
-        later_backups.sort()
-        for inc in later_backups:
-            inc_decrypt_command = 'gpg --passphrase-file %s --output %s --decrypt %s' % \
-                (config.get('Encryption', 'passphrase_file'),
-                 tmp + inc.split('.')[0] + '.sql',
-                 tmp + inc)
-            os.system(inc_decrypt_command)
-
-        cat_command = 'cat %s%s %s > %s%s_backup.sql' % \
-            (config.get('Main', 'tmp'),
-             full_backup.split('.')[0] + '.sql',
-             [tmp + inc.split('.')[0] + '.sql' for inc in inc_backups],
-             config.get('Fetch', 'local_save_path'),
-             config.get('Backup', 'file_prefix'))
-
-        os.system(cat_command)
-    else:
-        tmp = config.get('Main', 'tmp')
-        full_decompress = 'gzip -d %s%s' % (tmp, full_backup)
-        os.system(full_decompress)
-        incs = []
-        for inc in later_backups:
-            inc_decompress = 'gzip -d %s%s' & (tmp, inc)
-            incs = '%s%s' % (tmp, inc)
-            os.system(inc_decompress)
+    full_backup = full['file']
+    later_backups = [inc['file'] for inc in incs]
+
+    # the files of every backup with their sizes and checksums come from the
+    # index, backups indexed from their names only are listed remotely
+    files = []
+    for entry, remote_path in [(full, config.get('Fetch', 'remote_full_path'))] + \
+            [(inc, config.get('Fetch', 'remote_inc_path')) for inc in incs]:
+        try:
+            listing = entry.get('files') or [{'path': name, 'size': size, 'sha256': None}
+                    for name, size in transport.list_files(remote_path + entry['file'])]
+        except transfer.TransferError, e:
+            logAndPrint('Fetch could not list %s. Exiting...' % (entry['file']), 'error')
+            logAndPrint(e, 'error', exit=True)
+        for f in listing:
+            files.append({'source': remote_path + f['path'],
+                    'path': f['path'],
+                    'size': f['size'],
+                    'sha256': f['sha256']})
+
+    total = sum([f['size'] for f in files])
+    logAndPrint('Transferring %d files (%d bytes)...' % (len(files), total), 'info')
+    step = report.start('transfer')
+    try:
+        copier.fetch(files, tmp)
+    except (transfer.TransferError, OSError, IOError), e:
+        logAndPrint('Fetch encountered a fatal error transferring the backups. Run it again to resume. Exiting...', 'error')
+        logAndPrint(e, 'error', exit=True)
+    report.stop(step, total, total)
+
+    # a deduplicated full backup needs its chunks from the remote repository
+    if full_backup.endswith(dedup.EXTENSION):
+        _fetch_chunks(transport, copier, tmp + full_backup, tmp + 'dedup')
+
+    # decrypt and/or decompress the full backup and the incrementals, in
+    # order, into a single sql file
+    output = '%s%s_backup.sql' % (config.get('Fetch', 'local_save_path'),
+            config.get('Backup', 'file_prefix'))
+
+    f = open(output, 'wb')
+    try:
+        for artifact in [full_backup] + later_backups:
+            _decode_artifact(tmp + artifact, f)
+    except pipeline.PipelineError, e:
+        f.close()
+        logAndPrint('Fetch encountered a fatal error when decoding %s. Exiting...' % (artifact), 'error')
+        logAndPrint(e, 'error', exit=True)
+    f.close()
+
+def _fetch_chunks(transport, copier, index_file, repository):
+    """copy the chunks of the chunk index `index_file` into the local `repository`"""
+    index = dedup.read_index(index_file)
+    needed = set(dedup.chunk_files(index))
+    try:
+        # one listing of the remote repository instead of a round trip per chunk
+        listing = transport.list_files(index['repository'].rstrip('/') + '/chunks')
+    except transfer.TransferError, e:
+        logAndPrint('Fetch could not list the chunk repository %s. Exiting...' % (index['repository']), 'error')
+        logAndPrint(e, 'error', exit=True)
+
+    files = [{'source': posixpath.join(index['repository'], name), 'path': name, 'size': size, 'sha256': None}
+            for name, size in listing if name in needed]
+    if len(files) != len(needed):
+        logAndPrint('%d chunks of %s are missing from the remote repository. Exiting...' %
+                (len(needed) - len(files), os.path.basename(index_file)), 'error', True, True)
+
+    logAndPrint('Transferring %d chunks...' % (len(files)), 'info')
+    try:
+        copier.fetch(files, repository)
+    except (transfer.TransferError, OSError, IOError), e:
+        logAndPrint('Fetch encountered a fatal error transferring the chunks. Run it again to resume. Exiting...', 'error')
+        logAndPrint(e, 'error', exit=True)
+
+def _fetch_transport():
+    """the transport fetch copies the backups with, [Fetch] transport"""
+    name = _get_option('Fetch', 'transport', 'ssh')
+    if name == 'local':
+        return transfer.LocalTransport()
+    if name == 'ssh':
+        session = remote.RemoteSession(config.get('Fetch', 'connection_string'),
+                _get_option('Fetch', 'port', 22),
+                connections=int(_get_option('Fetch', 'connections', 1)))
+        session.open()
+        return transfer.SSHTransport(session)
+    logAndPrint('Unknown [Fetch] transport "%s" (use ssh or local). Exiting...' % (name), 'error', True, True)
+
+def _backup_index():
+    """returns the index of the backups in full_path
+
+    backups taken before there was an index are added to it the first time.
+    """
+    index = backupindex.BackupIndex(os.path.join(config.get('Backup', 'full_path'),
+            backupindex.INDEX_NAME))
+    if not index.exists:
+        logAndPrint('Building the backup index...', 'info')
+        backupindex.rebuild(index,
+                config.get('Backup', 'full_path'),
+                _get_option('Backup', 'inc_path'),
+                config.get('Backup', 'file_prefix'),
+                compression.read_metadata)
+        index.save()
+    return index
+
+def _index_backup(kind, artifact, when, metadata, binlog_coordinates):
+    """add the backup `artifact` to the index"""
+    index = _backup_index()
+    entry = backupindex.make_entry(kind, artifact, when, metadata, binlog_coordinates)
+    index.lock()
+    try:
+        try:
+            if kind == 'full':
+                index.add_full(entry)
+            else:
+                index.add_incremental(entry)
+        except backupindex.BackupIndexError, e:
+            logAndPrint('Backup encountered a fatal error updating the backup index. Exiting...', 'error')
+            logAndPrint(e, 'error', exit=True)
+        index.save()
+    finally:
+        index.unlock()
+
+def _binlog_catalog():
+    """returns the binary log catalog kept in full_path, brought up to date"""
+    catalog = binlog.BinlogCatalog(
+            os.path.join(config.get('Backup', 'full_path'), 'binlog_catalog.json'),
+            config.get('Backup', 'bin_log_path'),
+            config.get('Backup', 'bin_log_name'))
+    _refresh_catalog(catalog)
+    # older versions kept their state in these two files
+    catalog.migrate(os.path.join(config.get('Backup', 'full_path'), 'bin_log_info'),
+            os.path.join(config.get('Backup', 'full_path'), 'ignore_logs'))
+    return catalog
+
+def _refresh_catalog(catalog):
+    """rescan the binary logs, from the directory or with SHOW BINARY LOGS ([Backup] binlog_source)"""
+    logs = None
+    if _get_option('Backup', 'binlog_source', 'directory') == 'server':
+        process = subprocess.Popen(_client_args('mysql') +
+                ['--batch', '--skip-column-names', '-e', 'SHOW BINARY LOGS;'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        if process.returncode != 0:
+            logAndPrint('Could not list the binary logs. Exiting...', 'error')
+            logAndPrint(err, 'error', exit=True)
+        logs = [line.split('\t')[:2] for line in out.splitlines() if line.strip()]
 
-        cat_command = 'cat %s%s %s > %s%s_backup.sql' % \
-                (tmp,
-                 full_backup.split('.'),
-                 ' '.join([inc.strip('.gz') for inc in incs]),
-                 config.get('Fetch', 'local_save_path'),
-                 config.get('Backup', 'file_prefix'))
+    try:
+        catalog.refresh(logs)
+        catalog.latest()
+    except (binlog.BinlogError, OSError, IOError), e:
+        logAndPrint('Could not read the binary logs. Exiting...', 'error')
+        logAndPrint(e, 'error', exit=True)
+
+def _get_option(section, option, default=None):
+    """returns an option from config.cfg, or `default` when it is not set"""
+    try:
+        value = config.get(section, option)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
 
-        os.system(cat_command)
+    if value == '':
+        return default
+    return value
 
 def logAndPrint(message, type='info', print_message=True, exit=False):
     if type == 'info':
@@ -812,7 +2332,8 @@ def logAndPrint(message, type='info', print_message=True, exit=False):
         print message
 
     if exit:
-        sys.exit()
+        # errors exit with a status, so cron and the scheduler can tell
+        sys.exit(type == 'error' and 1 or 0)
 
 if __name__=='__main__':
     main()
@@ -0,0 +1,142 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Remote sessions. A fetch talks to the backup server many times: it reads the
+# backup index, lists directories and copies every range of every file. Each
+# of those used to be a new ssh process paying for its own handshake. A
+# RemoteSession opens a master connection and every command after that is
+# multiplexed over it (ssh ControlMaster), so a command costs a round trip.
+#
+# Commands multiplexed over one master share its TCP connection and so its
+# congestion window, on a slow or distant link parallel copies over it add no
+# bandwidth. A session can open `connections` masters, commands take turns
+# over them.
+
+import os
+import time
+import pipes
+import shutil
+import tempfile
+import threading
+import subprocess
+import logging
+
+logger = logging.getLogger("PMB LOG")
+
+class RemoteError(Exception):
+    """raised when a remote command fails"""
+
+class RemoteSession(object):
+    """a persistent ssh connection to `connection_string` shared by all commands
+
+    >>> session = RemoteSession('me@server.com', 22)
+    >>> session.open()
+    >>> session.read('/path/to/full/backups/backup_index.json')
+    >>> session.close()
+
+    if no master connection can be set up the commands fall back to ssh
+    connections of their own.
+    """
+
+    def __init__(self, connection_string, port=22, timeout=30, connections=1):
+        self.connection_string = connection_string
+        self.port = port
+        self.timeout = timeout
+        self.connections = max(1, connections)
+        # (process, control path) of the master connections that are up
+        self.masters = []
+        self.control_dir = None
+        self.turn = 0
+        self.lock = threading.Lock()
+
+    def _base(self, control_path=None):
+        args = ['ssh', '-p', str(self.port)]
+        if control_path is not None:
+            args.extend(['-S', control_path])
+        return args
+
+    def open(self):
+        # the socket paths have to stay short, so they go to the system tmp
+        self.control_dir = tempfile.mkdtemp(prefix='pmb_ssh_')
+        starting = []
+        for n in range(self.connections):
+            control_path = os.path.join(self.control_dir, 'master%d' % (n))
+            master = subprocess.Popen(self._base(control_path) + ['-M', '-N',
+                    '-o', 'ServerAliveInterval=30', self.connection_string],
+                    stdin=open(os.devnull),
+                    close_fds=True)
+            starting.append((master, control_path))
+
+        deadline = time.time() + self.timeout
+        while starting and time.time() < deadline:
+            for master, control_path in list(starting):
+                if master.poll() is not None:
+                    starting.remove((master, control_path))
+                    continue
+                check = subprocess.Popen(self._base(control_path) + ['-O', 'check', self.connection_string],
+                        stdout=open(os.devnull, 'w'),
+                        stderr=subprocess.STDOUT,
+                        close_fds=True)
+                if check.wait() == 0:
+                    starting.remove((master, control_path))
+                    self.masters.append((master, control_path))
+            if starting:
+                time.sleep(0.1)
+
+        for master, control_path in starting:
+            _stop(master)
+        if self.masters:
+            logger.info('Opened %d master connections to %s' % (len(self.masters), self.connection_string))
+            return
+
+        logger.warn('Could not open a master connection to %s, using a connection per command' %
+                (self.connection_string))
+        self._stop_masters()
+
+    def args(self, command):
+        """the ssh command line running `command` on the remote host, over the next master connection"""
+        control_path = None
+        self.lock.acquire()
+        try:
+            if self.masters:
+                control_path = self.masters[self.turn % len(self.masters)][1]
+                self.turn += 1
+        finally:
+            self.lock.release()
+        return self._base(control_path) + [self.connection_string, command]
+
+    def run(self, command):
+        """run `command` on the remote host and return its output"""
+        process = subprocess.Popen(self.args(command),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                close_fds=True)
+        out, err = process.communicate()
+        if process.returncode != 0:
+            raise RemoteError('ssh %s "%s" exited with %d: %s' %
+                    (self.connection_string, command, process.returncode, err.strip()))
+        return out
+
+    def read(self, path):
+        """the contents of the remote file `path`, in one round trip"""
+        return self.run('cat %s' % (pipes.quote(path)))
+
+    def close(self):
+        for master, control_path in self.masters:
+            subprocess.Popen(self._base(control_path) + ['-O', 'exit', self.connection_string],
+                    stdout=open(os.devnull, 'w'),
+                    stderr=subprocess.STDOUT,
+                    close_fds=True).wait()
+        self._stop_masters()
+
+    def _stop_masters(self):
+        for master, control_path in self.masters:
+            _stop(master)
+        self.masters = []
+        if self.control_dir is not None:
+            shutil.rmtree(self.control_dir, True)
+        self.control_dir = None
+
+def _stop(master):
+    if master.poll() is None:
+        master.terminate()
+    master.wait()
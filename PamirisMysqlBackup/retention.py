@@ -0,0 +1,189 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Retention. `pmb.py prune` removes the backups the retention policy doesn't
+# keep any more. The policy works on chains, a full backup and the
+# incrementals taken on top of it (see backupindex.py), so an incremental is
+# never removed while its full backup is kept, and a full backup never while
+# an incremental needs it:
+#
+#   * the `last` newest chains are kept
+#   * grandfather-father-son: the newest chain of each of the `daily` most
+#     recent days that have one is kept, and likewise for the `weekly` (ISO
+#     weeks), `monthly` and `yearly` periods
+#   * the incrementals of a kept chain are removed once the next full backup
+#     is older than `incremental_days` days, its full backup alone still
+#     restores that day. they go all at once, a chain is never cut in half.
+#   * a kept synthetic full backup keeps the chain it was consolidated from
+#
+# Everything to remove is known from the index, nothing is listed: removing a
+# chain costs an unlink per file it has, whatever the number of files in the
+# backup directories. The unlinks are done by `workers` threads, which helps on
+# network filesystems where every unlink is a round trip.
+
+import os
+import errno
+import Queue
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger("PMB LOG")
+
+PERIODS = ('daily', 'weekly', 'monthly', 'yearly')
+
+class RetentionError(Exception):
+    """raised when the policy can not be applied"""
+
+def _period(kind, timestamp):
+    day = datetime.fromtimestamp(timestamp)
+    if kind == 'daily':
+        return day.strftime('%Y%m%d')
+    if kind == 'weekly':
+        year, week = day.isocalendar()[:2]
+        return '%d-W%02d' % (year, week)
+    if kind == 'monthly':
+        return day.strftime('%Y%m')
+    return day.strftime('%Y')
+
+class Policy(object):
+    """how many chains to keep: the `last` ones and one for each of as many
+    periods as `periods` says ({'daily': 7, 'weekly': 4...})
+
+    `incremental_days` is how long the incrementals of a superseded chain are
+    kept, None to keep them as long as their chain.
+    """
+
+    def __init__(self, last=1, periods=None, incremental_days=None):
+        self.last = max(1, last)
+        self.periods = periods or {}
+        self.incremental_days = incremental_days
+        for kind in self.periods:
+            if kind not in PERIODS:
+                raise RetentionError('unknown retention period %s' % (kind))
+
+class Plan(object):
+    """what prune does to the chains of an index
+
+    `keep` are the chains kept with the reasons why (a list of strings each),
+    `prune` the chains removed with their incrementals and `trim` the kept
+    chains whose incrementals are removed.
+    """
+
+    def __init__(self):
+        self.keep = []
+        self.prune = []
+        self.trim = []
+
+    def kept_chains(self):
+        return [chain for chain, reasons in self.keep]
+
+def plan(chains, policy, now):
+    """apply `policy` at the unix time `now` to `chains`, the chains of the index oldest first"""
+    reasons = {}
+    newest_first = range(len(chains) - 1, -1, -1)
+
+    for n, i in enumerate(newest_first):
+        if n >= policy.last:
+            break
+        reasons.setdefault(i, []).append('last %d' % (policy.last))
+
+    for kind in PERIODS:
+        count = policy.periods.get(kind, 0)
+        seen = []
+        for i in newest_first:
+            if len(seen) >= count:
+                break
+            period = _period(kind, chains[i]['full']['timestamp'])
+            if period in seen:
+                continue
+            seen.append(period)
+            reasons.setdefault(i, []).append('%s %s' % (kind, period))
+
+    # a synthetic full backup (pmb.py consolidate) keeps the chain it was
+    # consolidated from, whose incrementals restore the times before it
+    fulls = dict([(c['full']['file'], i) for i, c in enumerate(chains)])
+    for i in newest_first:
+        synthetic = chains[i]['full'].get('synthetic')
+        if i in reasons and synthetic and synthetic.get('full') in fulls:
+            reasons.setdefault(fulls[synthetic['full']], []).append(
+                    'consolidated into %s' % (chains[i]['full']['file']))
+
+    result = Plan()
+    for i, chain in enumerate(chains):
+        if i not in reasons:
+            result.prune.append(chain)
+            continue
+        result.keep.append((chain, reasons[i]))
+        # the incrementals of the newest chain are still being added to
+        if policy.incremental_days is None or i == len(chains) - 1 or not chain['incrementals']:
+            continue
+        superseded = chains[i + 1]['full']['timestamp']
+        if now - superseded > policy.incremental_days * 86400:
+            result.trim.append(chain)
+    return result
+
+def chain_files(chain, full_path, inc_path, incrementals_only=False):
+    """the files of the backups in `chain`, as (backup directory, path relative to it)"""
+    entries = chain['incrementals']
+    if not incrementals_only:
+        entries = [chain['full']] + entries
+    files = []
+    for entry in entries:
+        directory = entry['kind'] == 'full' and full_path or inc_path
+        files.extend([(directory, f['path']) for f in entry.get('files') or []])
+    return files
+
+def remove_files(files, workers=4):
+    """unlink `files`, (directory, relative path) pairs, with `workers` threads
+
+    the directories of chunked backups they leave empty are removed too,
+    files that are already gone are fine. returns the number of files
+    removed and a list of problems.
+    """
+    jobs = Queue.Queue()
+    for directory, path in files:
+        jobs.put(os.path.join(directory, path))
+    removed = [0]
+    problems = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                path = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            problem = None
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    problem = '%s: %s' % (path, e.strerror)
+            lock.acquire()
+            if problem is None:
+                removed[0] += 1
+            else:
+                problems.append(problem)
+            lock.release()
+
+    threads = [threading.Thread(target=work) for i in range(min(max(1, workers), len(files)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # deepest first, never the backup directory itself
+    directories = set()
+    for directory, path in files:
+        parent = os.path.dirname(path)
+        while parent:
+            directories.add(os.path.join(directory, parent))
+            parent = os.path.dirname(parent)
+    for directory in sorted(directories, key=lambda d: -d.count('/')):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            # not empty or gone
+            pass
+    return removed[0], sorted(problems)
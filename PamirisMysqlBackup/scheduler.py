@@ -0,0 +1,206 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Backup scheduler. Many databases on many hosts used to mean a cron line per
+# database, staggered by hand and still running into each other. The scheduler
+# reads the targets from the [Target:<name>] sections of config.cfg and runs
+# their backups as separate pmb.py processes, as many at a time as the limits
+# allow:
+#
+#   * at most `jobs` backups at once, and `host_jobs` against one database host
+#   * targets with a higher `priority` start first
+#   * a backup doesn't start while the filesystem it writes to has less than
+#     `min_free_space` MB free or its disk is busier than `max_io_util` percent
+#   * two backups of the same target never run at the same time, a target
+#     lock in its full_path also keeps separate pmb.py runs apart
+#
+# Disk activity is the share of time the device had I/O in flight between two
+# polls, from the io_ticks of /proc/diskstats, the same number iostat shows as
+# %util.
+
+import os
+import time
+import fcntl
+import subprocess
+import logging
+
+logger = logging.getLogger("PMB LOG")
+
+TARGET_PREFIX = 'Target:'
+LOCK_NAME = 'backup.lock'
+
+def target_lock(full_path):
+    """wait for and take the lock of the target backed up into `full_path`, returns it to keep open"""
+    f = open(os.path.join(full_path, LOCK_NAME), 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logger.info('Another backup of %s is running, waiting for it...' % (full_path))
+        fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+class Job(object):
+    """one backup: the `command` backing up `target` on the database `host`
+
+    `paths` are the directories the backup writes to, `min_free_space` (in
+    bytes) is what has to stay free on them.
+    """
+
+    def __init__(self, target, kind, host, command, paths, priority=0, min_free_space=0):
+        self.target = target
+        self.kind = kind
+        self.host = host
+        self.command = command
+        self.paths = paths
+        self.priority = priority
+        self.min_free_space = min_free_space
+        self.process = None
+        self.started = None
+        self.finished = None
+        self.waiting = None
+        self.waiting_since = None
+        # why the job never ran
+        self.error = None
+
+    def __str__(self):
+        return '%s (%s)' % (self.target, self.kind)
+
+def free_space(path):
+    """bytes available to us on the filesystem holding `path`"""
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+class DiskMonitor(object):
+    """how busy the disks holding some paths are, measured between two samples"""
+
+    def __init__(self, diskstats='/proc/diskstats'):
+        self.diskstats = diskstats
+        self.last = None
+        self.busy = {}
+
+    def _read(self):
+        ticks = {}
+        try:
+            f = open(self.diskstats)
+        except IOError:
+            return ticks
+        try:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 12:
+                    ticks[(int(fields[0]), int(fields[1]))] = int(fields[12])
+        finally:
+            f.close()
+        return ticks
+
+    def sample(self):
+        """read the counters again, utilization() reports the time since the last sample"""
+        now = time.time()
+        if self.last is not None and now - self.last[0] < 1:
+            # too short to tell
+            return
+        ticks = self._read()
+        if self.last is not None:
+            then, last_ticks = self.last
+            elapsed = (now - then) * 1000
+            if elapsed > 0:
+                self.busy = dict([(dev, min(100.0, (ticks[dev] - last_ticks[dev]) * 100 / elapsed))
+                        for dev in ticks if dev in last_ticks])
+        self.last = (now, ticks)
+
+    def utilization(self, path):
+        """percent of the time the disk of `path` was busy, None when it is not known"""
+        dev = os.stat(path).st_dev
+        return self.busy.get((os.major(dev), os.minor(dev)))
+
+class Scheduler(object):
+    """run jobs within the limits, polling every `poll` seconds
+
+    `max_io_util` is the disk utilization in percent above which no new job
+    starts on that disk, None to not look at it. a job that waited for its
+    disks for `max_wait` seconds is given up.
+    """
+
+    def __init__(self, jobs=4, host_jobs=2, max_io_util=None, poll=5, max_wait=None, monitor=None):
+        self.jobs = max(1, jobs)
+        self.host_jobs = max(1, host_jobs)
+        self.max_io_util = max_io_util
+        self.poll = poll
+        self.max_wait = max_wait
+        self.monitor = monitor or DiskMonitor()
+
+    def _pressure(self, job):
+        """why `job` can't start yet because of its disks, None when it can"""
+        for path in job.paths:
+            free = free_space(path)
+            if free < job.min_free_space:
+                return '%s has %d MB free, %d MB needed' % (path, free / 1048576, job.min_free_space / 1048576)
+            if self.max_io_util is not None:
+                busy = self.monitor.utilization(path)
+                if busy is not None and busy > self.max_io_util:
+                    return 'the disk of %s is %d%% busy' % (path, busy)
+        return None
+
+    def run(self, jobs):
+        """run `jobs` and return them once all are done
+
+        a job that ran has its `process`, one that never did its `error`.
+        """
+        # sorted() is stable, jobs of one priority keep their order
+        pending = sorted(jobs, key=lambda j: -j.priority)
+        running = []
+        self.monitor.sample()
+
+        while pending or running:
+            for job in running[:]:
+                if job.process.poll() is not None:
+                    job.finished = time.time()
+                    running.remove(job)
+                    logger.info('%s finished with %d after %d seconds' %
+                            (job, job.process.returncode, job.finished - job.started))
+
+            busy_targets = set([j.target for j in running])
+            for job in pending[:]:
+                if len(running) >= self.jobs:
+                    break
+                if job.target in busy_targets:
+                    continue
+                if len([j for j in running if j.host == job.host]) >= self.host_jobs:
+                    continue
+                reason = self._pressure(job)
+                if reason is not None:
+                    if job.waiting_since is None:
+                        job.waiting_since = time.time()
+                    if self.max_wait is not None and time.time() - job.waiting_since > self.max_wait:
+                        logger.error('%s gave up waiting: %s' % (job, reason))
+                        job.error = reason
+                        pending.remove(job)
+                    elif reason != job.waiting:
+                        logger.warn('%s waits: %s' % (job, reason))
+                        job.waiting = reason
+                    continue
+
+                logger.info('Starting %s' % (job))
+                pending.remove(job)
+                job.started = time.time()
+                try:
+                    job.process = subprocess.Popen(job.command, close_fds=True)
+                except OSError, e:
+                    logger.error('%s could not be started: %s' % (job, e))
+                    job.error = str(e)
+                    continue
+                running.append(job)
+                busy_targets.add(job.target)
+
+            if pending or running:
+                self._wait(running)
+                self.monitor.sample()
+        return jobs
+
+    def _wait(self, running):
+        """sleep for a poll, or until one of the `running` jobs is done"""
+        deadline = time.time() + self.poll
+        while time.time() < deadline:
+            for job in running:
+                if job.process.poll() is not None:
+                    return
+            time.sleep(0.2)
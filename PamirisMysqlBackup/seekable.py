@@ -0,0 +1,338 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Seekable full backups. A `.sql.blocks` backup is the dump cut into blocks
+# that are compressed (and encrypted) each on their own, with a side index
+# `.sql.blocks.idx` mapping the sections of the dump to the blocks holding
+# them. A section is what follows one of the comments mysqldump writes in
+# front of everything it dumps:
+#
+#   -- Current Database: `db`                  database (CREATE DATABASE, USE)
+#   -- Table structure for table `t`           schema of t
+#   -- Temporary/Final view structure for view `v`   schema of v
+#   -- Temporary table structure for view `v`  schema of v (5.6)
+#   -- Dumping data for table `t`              data of t
+#   -- Dumping routines/events for database 'db'
+#
+# what comes before the first of them is the prelude (the SET statements of
+# the header) and the restoring of the session variables at the end is the
+# trailer. Every section starts a block of its own, so restoring a single table
+# only reads the blocks of the prelude, the table and the trailer, and listing
+# the tables only reads the index.
+#
+# Blocks are our gzip members (see compression.py): an unencrypted backup is
+# plain multi member gzip that zcat reads. With chunked encryption (see
+# encryption.py) the whole file is encrypted and a block is read by decrypting
+# the chunks holding it, the offsets of the index are those of the decrypted
+# file. With gpg every block is a gpg message of its own, like the chunks of a
+# deduplicated backup.
+#
+# Index layout:
+#
+#   {"format": "pmb-blocks", "version": 1, "database": "db" or null,
+#    "encrypted": false, "encryption": "gpg" or "chunked", "size": <dump bytes>,
+#    "blocks": [[offset, stored size, size], ...],
+#    "sections": [{"kind": "data", "database": "db", "table": "t",
+#                  "first": <block>, "last": <block>, "size": <bytes>}, ...]}
+
+import os
+import re
+import json
+import zlib
+import subprocess
+import logging
+
+from pipeline import BLOCK_SIZE
+from compression import ordered_map, compress_block, decompress_block, CompressionError
+
+logger = logging.getLogger("PMB LOG")
+
+BLOCKS_FORMAT = 'pmb-blocks'
+BLOCKS_VERSION = 1
+EXTENSION = '.blocks'
+INDEX_SUFFIX = '.idx'
+
+# the routines and events headers quote the database with single quotes
+_SECTION = re.compile(r'^-- (Current Database:|Table structure for table|Temporary view structure for view|'
+        r'Temporary table structure for view|Final view structure for view|Dumping data for table|'
+        r"Dumping routines for database|Dumping events for database) (?:`((?:[^`]|``)*)`|'(.*)')$|"
+        r'^/\*!40103 SET TIME_ZONE=@OLD_TIME_ZONE \*/;$', re.M)
+
+_KINDS = {
+    'Current Database:': 'database',
+    'Table structure for table': 'schema',
+    'Temporary view structure for view': 'schema',
+    'Temporary table structure for view': 'schema',
+    'Final view structure for view': 'schema',
+    'Dumping data for table': 'data',
+    'Dumping routines for database': 'routines',
+    'Dumping events for database': 'events',
+}
+
+class SeekableError(Exception):
+    """raised when a seekable backup can not be written or read"""
+
+def _run(args, data):
+    process = subprocess.Popen(args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True)
+    out, err = process.communicate(data)
+    if process.returncode != 0:
+        raise SeekableError('%s exited with %d: %s' % (args[0], process.returncode, err.strip()))
+    return out
+
+class _Splitter(object):
+    """cuts a dump into blocks of `block_size`, starting a block at every section"""
+
+    def __init__(self, index, block_size):
+        self.index = index
+        self.block_size = block_size
+        self.database = index['database']
+        self.count = 0
+        self.buffer = []
+        self.buffered = 0
+        self.ready = []
+        self.section = None
+        self._start('prelude', None, None)
+
+    def _emit(self, data):
+        self.ready.append(data)
+        self.count += 1
+
+    def _add(self, data):
+        if not data:
+            return
+        self.section['size'] += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        while self.buffered >= self.block_size:
+            data = ''.join(self.buffer)
+            self._emit(data[:self.block_size])
+            self.buffer = [data[self.block_size:]]
+            self.buffered -= self.block_size
+
+    def _cut(self):
+        if self.buffered:
+            self._emit(''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def _start(self, kind, database, table):
+        self._cut()
+        if self.section is not None and self.section['size']:
+            self.section['last'] = self.count - 1
+            self.index['sections'].append(self.section)
+        self.section = {'kind': kind, 'database': database, 'table': table,
+                'first': self.count, 'last': None, 'size': 0}
+
+    def _header(self, match):
+        if match.group(1) is None:
+            self._start('trailer', None, None)
+            return
+        kind = _KINDS[match.group(1)]
+        name = match.group(3)
+        if match.group(2) is not None:
+            name = match.group(2).replace('``', '`')
+        if kind == 'database':
+            self.database = name
+            self._start(kind, name, None)
+        elif kind in ('routines', 'events'):
+            self._start(kind, name, None)
+        else:
+            self._start(kind, self.database, name)
+
+    def blocks(self, reader):
+        # only complete lines are looked at, a partial one waits for the next read
+        carry = ''
+        while True:
+            data = reader.read(self.block_size)
+            if not data:
+                break
+            data = carry + data
+            end = data.rfind('\n') + 1
+            carry = data[end:]
+            position = 0
+            for match in _SECTION.finditer(data, 0, end):
+                self._add(data[position:match.start()])
+                self._header(match)
+                position = match.start()
+            self._add(data[position:end])
+            for block in self.ready:
+                yield block
+            self.ready = []
+        self._add(carry)
+        self._start(None, None, None)
+        for block in self.ready:
+            yield block
+        self.ready = []
+
+def _encode_block(args):
+    data, level, encrypt = args
+    block = compress_block((data, level))
+    if encrypt is not None:
+        block = _run(encrypt, block)
+    return len(data), block
+
+def new_index(metadata, database=None):
+    return {
+        'format': BLOCKS_FORMAT,
+        'version': BLOCKS_VERSION,
+        'database': database,
+        'encrypted': bool(metadata.get('encrypted')),
+        'encryption': metadata.get('encrypted') and metadata.get('encryption', 'gpg') or None,
+        'level': metadata.get('level'),
+        'blocks': [],
+        'sections': [],
+    }
+
+def writer(index, level=6, workers=4, block_size=BLOCK_SIZE, encrypt=None):
+    """returns a pipeline filter writing its input as blocks, described in `index`
+
+    `encrypt` is the command line of the encryption (gpg reading stdin and
+    writing stdout), the blocks are left in the clear when it is None.
+    """
+    def write(reader, writer):
+        splitter = _Splitter(index, block_size)
+        items = ((data, level, encrypt) for data in splitter.blocks(reader))
+        offset = 0
+        for size, block in ordered_map(_encode_block, items, workers):
+            index['blocks'].append([offset, len(block), size])
+            writer.write(block)
+            offset += len(block)
+        index['size'] = sum([b[2] for b in index['blocks']])
+        logger.info('Wrote %d blocks for %d sections' % (len(index['blocks']), len(index['sections'])))
+    return write
+
+def write_index(artifact, index):
+    """atomically write the side index of the backup `artifact`"""
+    path = artifact + INDEX_SUFFIX
+    f = open(path + '.partial', 'w')
+    json.dump(index, f, separators=(',', ':'))
+    f.close()
+    os.rename(path + '.partial', path)
+
+def read_index(artifact):
+    try:
+        f = open(artifact + INDEX_SUFFIX)
+    except IOError:
+        raise SeekableError('%s has no block index' % (artifact))
+    try:
+        index = json.load(f)
+    finally:
+        f.close()
+    if index.get('format') != BLOCKS_FORMAT:
+        raise SeekableError('%s%s is not a block index' % (artifact, INDEX_SUFFIX))
+    return index
+
+def tables(index):
+    """the tables and views of `index` in dump order, with the bytes and blocks of their sections"""
+    found = []
+    by_name = {}
+    for section in index['sections']:
+        if section['kind'] not in ('schema', 'data'):
+            continue
+        key = (section['database'], section['table'])
+        if key not in by_name:
+            by_name[key] = {'database': key[0], 'table': key[1],
+                    'schema': 0, 'data': 0, 'blocks': 0, 'stored': 0}
+            found.append(by_name[key])
+        table = by_name[key]
+        table[section['kind']] += section['size']
+        table['blocks'] += section['last'] - section['first'] + 1
+        table['stored'] += sum([b[1] for b in index['blocks'][section['first']:section['last'] + 1]])
+    return found
+
+def _quote(name):
+    return '`%s`' % (name.replace('`', '``'))
+
+def select(index, names):
+    """the parts restoring the tables `names` ("db.table" or "table"): block numbers and sql
+
+    the prelude and trailer are read with the sections of the tables, the
+    database of a table is created if it is missing and selected when the
+    backup holds more than one.
+    """
+    known = tables(index)
+    wanted = []
+    for name in names:
+        if '.' in name:
+            database, table = name.split('.', 1)
+            matches = [t for t in known if t['database'] == database and t['table'] == table]
+        else:
+            matches = [t for t in known if t['table'] == name]
+        if not matches:
+            raise SeekableError('there is no table %s in the backup' % (name))
+        if len(set([t['database'] for t in matches])) > 1:
+            raise SeekableError('%s is in several databases (%s), name it as database.table' %
+                    (name, ', '.join(sorted(set([t['database'] for t in matches])))))
+        for t in matches:
+            if (t['database'], t['table']) not in wanted:
+                wanted.append((t['database'], t['table']))
+
+    use = [s for s in index['sections'] if s['kind'] == 'database']
+    parts = []
+    for section in index['sections']:
+        if section['kind'] == 'prelude':
+            parts.extend(range(section['first'], section['last'] + 1))
+    current = None
+    for section in index['sections']:
+        if (section['database'], section['table']) not in wanted or section['kind'] not in ('schema', 'data'):
+            continue
+        if use and section['database'] != current:
+            current = section['database']
+            sql = '\nCREATE DATABASE IF NOT EXISTS %s;\nUSE %s;\n' % (_quote(current), _quote(current))
+            parts.append(sql.encode('utf-8'))
+        parts.extend(range(section['first'], section['last'] + 1))
+    for section in index['sections']:
+        if section['kind'] == 'trailer':
+            parts.extend(range(section['first'], section['last'] + 1))
+    return parts
+
+def _decode_part(args):
+    part, path, blocks, decrypt, source = args
+    if isinstance(part, basestring):
+        return part
+    offset, stored, size = blocks[part]
+    if source is not None:
+        block = source.read(offset, stored)
+    else:
+        f = open(path, 'rb')
+        try:
+            f.seek(offset)
+            block = f.read(stored)
+        finally:
+            f.close()
+    if len(block) != stored:
+        raise SeekableError('%s is truncated at block %d' % (path, part))
+    if decrypt is not None:
+        block = _run(decrypt, block)
+    try:
+        data = decompress_block(block)
+    except (zlib.error, CompressionError), e:
+        raise SeekableError('block %d of %s is corrupt: %s' % (part, path, e))
+    if len(data) != size:
+        raise SeekableError('block %d of %s is %d bytes instead of %d' % (part, path, len(data), size))
+    return data
+
+def read(artifact, index, writer, parts=None, decrypt=None, workers=4, source=None):
+    """write the blocks of `artifact` to `writer`, all of them or the `parts` from select()
+
+    `decrypt` is the command line of the decryption, needed when the blocks
+    are encrypted with gpg. `source` reads the bytes of the blocks,
+    source.read(offset, size), an encryption.Reader for a file encrypted in
+    chunks. returns the number of bytes written.
+    """
+    if parts is None:
+        parts = range(len(index['blocks']))
+    chunked = index.get('encryption') == 'chunked'
+    if index.get('encrypted') and (chunked and source is None or not chunked and decrypt is None):
+        raise SeekableError('%s is encrypted' % (artifact))
+    if not index.get('encrypted') or chunked:
+        decrypt = None
+    items = ((part, artifact, index['blocks'], decrypt, source) for part in parts)
+    written = 0
+    for data in ordered_map(_decode_part, items, max(1, workers)):
+        writer.write(data)
+        written += len(data)
+    return written
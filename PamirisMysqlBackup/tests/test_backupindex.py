@@ -0,0 +1,70 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Tests of the lookups of the backup index of backupindex.py.
+
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import backupindex
+
+def _entry(kind, timestamp, log=None, position=4, start=None):
+    binlog = None
+    if log is not None:
+        binlog = {'file': 'mysql-bin.%06d' % (log), 'position': position}
+        if start is not None:
+            binlog['start'] = start
+    return {'kind': kind, 'file': '%s_%d' % (kind, timestamp), 'time': str(timestamp),
+            'timestamp': timestamp, 'binlog': binlog}
+
+def _files(entries):
+    return [e['file'] for e in entries]
+
+class LookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = backupindex.BackupIndex('/nonexistent/backup_index.json')
+        self.index.add_full(_entry('full', 100, 1))
+        self.index.add_full(_entry('full', 300, 3))
+        for timestamp, log in ((150, 2), (200, 2), (350, 4), (400, 5)):
+            self.index.add_incremental(_entry('inc', timestamp, log))
+
+    def test_resolve(self):
+        full, incs = self.index.resolve(360)
+        self.assertEqual(full['file'], 'full_300')
+        self.assertEqual(_files(incs), ['inc_350'])
+        self.assertRaises(backupindex.BackupIndexError, self.index.resolve, 50)
+
+    def test_resolve_until(self):
+        full, incs = self.index.resolve_until(timestamp=160)
+        self.assertEqual(_files(incs), ['inc_150', 'inc_200'])
+        full, incs = self.index.resolve_until(coordinate=('mysql-bin.000004', 100))
+        self.assertEqual(full['file'], 'full_300')
+        self.assertEqual(_files(incs), ['inc_350', 'inc_400'])
+
+    def test_lookups_follow_changes(self):
+        # an older full backup goes in front, a stream segment to the full of its start
+        self.index.add_full(_entry('full', 250, 2, 900))
+        self.index.add_incremental(_entry('inc', 500, 2, 950, start=900))
+        full, incs = self.index.resolve(260)
+        self.assertEqual(full['file'], 'full_250')
+        full, incs = self.index.resolve_until(coordinate=('mysql-bin.000002', 960))
+        self.assertEqual(_files(incs), ['inc_500'])
+
+        # prune replaces the chains and trims the incrementals of some
+        self.index.chains = self.index.chains[1:]
+        self.index.chains[-1]['incrementals'] = []
+        self.assertRaises(backupindex.BackupIndexError, self.index.resolve, 120)
+        full, incs = self.index.resolve(500)
+        self.assertEqual((full['file'], incs), ('full_300', []))
+
+    def test_loaded_index(self):
+        data = json.dumps({'version': 1, 'chains': self.index.chains})
+        index = backupindex.BackupIndex('/nonexistent/backup_index.json', data)
+        full, incs = index.resolve(210)
+        self.assertEqual(_files(incs), ['inc_150', 'inc_200'])
+
+if __name__ == '__main__':
+    unittest.main()
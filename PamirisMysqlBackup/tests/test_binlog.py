@@ -0,0 +1,56 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Tests of the lookups of the binary log catalog of binlog.py.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import binlog
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.catalog = binlog.BinlogCatalog(os.path.join(self.directory, 'catalog.json'),
+                self.directory, 'mysql-bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _logs(self, *sequences):
+        return [('mysql-bin.%06d' % (n), 4) for n in sequences]
+
+    def test_find(self):
+        self.catalog.refresh(self._logs(3, 1, 2, 10))
+        self.assertEqual(self.catalog.find('mysql-bin.000002')['sequence'], 2)
+        self.assertEqual(self.catalog.find('/var/lib/mysql/mysql-bin.000010')['sequence'], 10)
+        self.assertEqual(self.catalog.find('mysql-bin.000004'), None)
+        self.assertEqual(self.catalog.find('mysql-bin.000011'), None)
+
+    def test_between(self):
+        self.catalog.refresh(self._logs(1, 2, 3, 5, 8))
+        self.catalog.ignore(3, 3)
+        self.assertEqual([e['sequence'] for e in self.catalog.between(2, 7)], [2, 5])
+        self.assertEqual(self.catalog.between(9, 12), [])
+
+    def test_lookups_follow_changes(self):
+        self.catalog.refresh(self._logs(1, 2))
+        self.assertEqual(self.catalog.find('mysql-bin.000003'), None)
+        self.catalog.refresh(self._logs(1, 2, 3))
+        self.assertEqual(self.catalog.find('mysql-bin.000003')['sequence'], 3)
+        # purged by the server, they aren't in bin_log_path
+        self.assertEqual(self.catalog.forget(3), 2)
+        self.assertEqual(self.catalog.find('mysql-bin.000001'), None)
+        self.assertEqual([e['sequence'] for e in self.catalog.between(1, 3)], [3])
+
+        other = binlog.BinlogCatalog(os.path.join(self.directory, 'other.json'), self.directory, 'mysql-bin')
+        other.refresh(self._logs(3, 4))
+        self.catalog.adopt(other)
+        self.assertEqual(self.catalog.find('mysql-bin.000004')['sequence'], 4)
+
+if __name__ == '__main__':
+    unittest.main()
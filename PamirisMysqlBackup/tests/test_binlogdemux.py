@@ -0,0 +1,112 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Tests of the splitting of binary logs by database in binlogdemux.py, on logs
+# built event by event.
+
+import os
+import sys
+import struct
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import binlogdemux
+from binlog import BINLOG_MAGIC, EVENT_HEADER
+
+GTID_LOG_EVENT = 33
+TRANSACTION_PAYLOAD_EVENT = 40
+WRITE_ROWS_EVENT = 30
+
+class Log(object):
+    """a binary log written event by event"""
+
+    def __init__(self):
+        self.data = BINLOG_MAGIC
+        self.events = []
+
+    def add(self, type_code, body, flags=0):
+        length = EVENT_HEADER.size + len(body)
+        event = EVENT_HEADER.pack(1, type_code, 1, length, len(self.data) + length, flags) + body
+        self.data += event
+        self.events.append(event)
+        return event
+
+    def query(self, database, sql):
+        return self.add(binlogdemux.QUERY_EVENT,
+                struct.pack('<IIBHH', 1, 0, len(database), 0, 0) + database + '\0' + sql)
+
+    def table_map(self, table_id, database, table):
+        return self.add(binlogdemux.TABLE_MAP_EVENT,
+                struct.pack('<Q', table_id)[:6] + '\0\0' + chr(len(database)) + database + '\0' +
+                chr(len(table)) + table + '\0' + '\x01\x03\0\0')
+
+    def rows(self, table_id):
+        return self.add(WRITE_ROWS_EVENT, struct.pack('<Q', table_id)[:6] + '\x01\0\x02\0\x01\x01\0\x01\0\0\0')
+
+    def split(self, databases):
+        f = tempfile.NamedTemporaryFile()
+        f.write(self.data)
+        f.flush()
+        outputs = [binlogdemux.Output(d, ['log'], StringIO.StringIO()) for d in databases]
+        try:
+            binlogdemux.split(f.name, 'log', outputs)
+        finally:
+            f.close()
+        return dict([(o.database, o.f.getvalue()) for o in outputs])
+
+class SplitTest(unittest.TestCase):
+
+    def test_events_go_to_their_database(self):
+        log = Log()
+        description = log.add(binlogdemux.FORMAT_DESCRIPTION_EVENT, '\0' * 20)
+        log.add(GTID_LOG_EVENT, '\0' * 25)
+        begin = log.query('a', 'BEGIN')
+        a_map = log.table_map(1, 'a', 't')
+        a_rows = log.rows(1)
+        b_map = log.table_map(2, 'b', 't')
+        b_rows = log.rows(2)
+        xid = log.add(binlogdemux.XID_EVENT, struct.pack('<Q', 1))
+        ddl = log.query('b', 'CREATE TABLE u (id int)')
+        log.add(binlogdemux.ROTATE_EVENT, struct.pack('<Q', 4) + 'log.000002')
+
+        split = log.split(['a', 'b', 'c'])
+        self.assertEqual(split['a'], BINLOG_MAGIC + description + begin + a_map + a_rows + xid)
+        self.assertEqual(split['b'], BINLOG_MAGIC + description + begin + b_map + b_rows + xid + ddl)
+        self.assertEqual(split['c'], BINLOG_MAGIC + description)
+
+    def test_statement_context_goes_with_its_statement(self):
+        log = Log()
+        log.add(binlogdemux.FORMAT_DESCRIPTION_EVENT, '\0' * 20)
+        begin = log.query('a', 'BEGIN')
+        intvar = log.add(binlogdemux.INTVAR_EVENT, '\x02' + struct.pack('<Q', 7))
+        insert = log.query('a', 'INSERT INTO t VALUES (NULL)')
+        commit = log.query('a', 'COMMIT')
+        split = log.split(['a', 'b'])
+        self.assertTrue(split['a'].endswith(begin + intvar + insert + commit))
+        self.assertFalse(intvar in split['b'])
+
+    def test_ignorable_events_are_skipped(self):
+        log = Log()
+        log.add(binlogdemux.FORMAT_DESCRIPTION_EVENT, '\0' * 20)
+        skipped = log.add(99, 'future', flags=binlogdemux.LOG_EVENT_IGNORABLE_F)
+        self.assertFalse(skipped in log.split(['a'])['a'])
+
+    def test_unknown_events_are_not_dropped(self):
+        for type_code in (TRANSACTION_PAYLOAD_EVENT, 17, 39):
+            log = Log()
+            log.add(binlogdemux.FORMAT_DESCRIPTION_EVENT, '\0' * 20)
+            log.query('a', 'BEGIN')
+            log.add(type_code, '\0' * 16)
+            log.add(binlogdemux.XID_EVENT, struct.pack('<Q', 1))
+            self.assertRaises(binlogdemux.DemuxError, log.split, ['a'])
+
+    def test_row_events_outside_a_transaction(self):
+        log = Log()
+        log.add(binlogdemux.FORMAT_DESCRIPTION_EVENT, '\0' * 20)
+        log.table_map(1, 'a', 't')
+        log.rows(1)
+        self.assertRaises(binlogdemux.DemuxError, log.split, ['a'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Tests of the row change compaction of compaction.py, on binary logs built
+# event by event. A log and its compacted log are replayed into a table of
+# row images and must leave it the same.
+
+import os
+import sys
+import struct
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import compaction
+import binlogdemux
+from binlog import BINLOG_MAGIC, EVENT_HEADER
+
+# id int, name varchar(20), note blob nullable
+TYPES = '\x03\x0f\xfc'
+METADATA = struct.pack('<H', 20) + '\x02'
+TABLE_ID = 7
+
+def _event(type_code, body, timestamp=1):
+    length = EVENT_HEADER.size + len(body)
+    return EVENT_HEADER.pack(timestamp, type_code, 1, length, 0, 0) + body
+
+def _query(sql):
+    return _event(binlogdemux.QUERY_EVENT, struct.pack('<IIBHH', 1, 0, 1, 0, 0) + 'd\0' + sql)
+
+def _table_map(database='d', table='t'):
+    return _event(binlogdemux.TABLE_MAP_EVENT,
+            struct.pack('<Q', TABLE_ID)[:6] + '\x01\0' + chr(len(database)) + database + '\0' +
+            chr(len(table)) + table + '\0' + '\x03' + TYPES + chr(len(METADATA)) + METADATA + '\x04')
+
+def _image(id, name, note=None):
+    if note is None:
+        return '\x04' + struct.pack('<I', id) + chr(len(name)) + name
+    return '\x00' + struct.pack('<I', id) + chr(len(name)) + name + struct.pack('<H', len(note)) + note
+
+def _rows(kind, rows):
+    type_code = {'write': 30, 'update': 31, 'delete': 32}[kind]
+    bitmap = kind == 'update' and '\x07\x07' or '\x07'
+    return _event(type_code, struct.pack('<Q', TABLE_ID)[:6] + struct.pack('<HH', compaction.STMT_END_F, 2) +
+            '\x03' + bitmap + ''.join([''.join(row) for row in rows]))
+
+def _log(transactions, end=None):
+    """a binary log of `transactions`, lists of (kind, rows) without checksums
+
+    the transactions end with an XID, or the query event `end`.
+    """
+    description = struct.pack('<H', 4) + '5.7.30'.ljust(50, '\0') + struct.pack('<IB', 1, 19) + '\0' * 5
+    data = BINLOG_MAGIC + _event(binlogdemux.FORMAT_DESCRIPTION_EVENT, description)
+    for n, changes in enumerate(transactions):
+        data += _query('BEGIN')
+        for kind, rows in changes:
+            data += _table_map() + _rows(kind, rows)
+        data += end and _query(end) or _event(binlogdemux.XID_EVENT, struct.pack('<Q', n + 1))
+    return data
+
+def _compact(data, window=1000, tables=('d.*',)):
+    out = StringIO.StringIO()
+    compactor = compaction.Compactor(window, 60, list(tables))
+    compactor(StringIO.StringIO(data), out)
+    return out.getvalue(), compactor.stats
+
+def _replay(data):
+    """the rows of the table after replaying the row events of `data`"""
+    table = set()
+    tables = {}
+    for header, event in binlogdemux.read_events(StringIO.StringIO(data[4:]), None):
+        if header[1] == binlogdemux.TABLE_MAP_EVENT:
+            tables[binlogdemux.table_id(event)] = compaction._TableMap(event)
+        elif header[1] in compaction._KINDS:
+            kind = compaction._KINDS[header[1]]
+            for row in tables[binlogdemux.table_id(event)].rows(event, 0):
+                if kind != 'write':
+                    assert row[0] in table, 'replaying a change of a missing row'
+                    table.remove(row[0])
+                if kind != 'delete':
+                    assert row[-1] not in table, 'duplicate row'
+                    table.add(row[-1])
+    return table
+
+class RowImageTest(unittest.TestCase):
+
+    def test_rows(self):
+        rows = [[_image(1, 'a', 'x' * 300)], [_image(2, '', None)], [_image(3, 'c' * 20, '')]]
+        event = _rows('write', rows)
+        table = compaction._TableMap(_table_map())
+        self.assertEqual(table.key, ('d', 't'))
+        self.assertEqual(table.rows(event, 0), rows)
+
+    def test_update_rows(self):
+        rows = [[_image(1, 'a'), _image(1, 'b', 'note')]]
+        table = compaction._TableMap(_table_map())
+        self.assertEqual(table.rows(_rows('update', rows), 0), rows)
+
+    def test_column_sizes(self):
+        # decimal(10,2), datetime2(3), timestamp2(6), char(255) in utf8mb4, enum
+        self.assertEqual(compaction._column_size(246, 10 << 8 | 2), 5)
+        self.assertEqual(compaction._column_size(18, 3), 7)
+        self.assertEqual(compaction._column_size(17, 6), 7)
+        self.assertEqual(compaction._column_size(254, 0xce << 8 | 0xfc), -2)
+        self.assertEqual(compaction._column_size(254, 247 << 8 | 1), 1)
+        self.assertEqual(compaction._column_size(3, 0), 4)
+        self.assertEqual(compaction._column_size(99, 0), None)
+
+    def test_checksum_size(self):
+        description = struct.pack('<H', 4) + '5.7.30-log'.ljust(50, '\0') + struct.pack('<IB', 1, 19)
+        self.assertEqual(compaction._checksum_size(_event(15, description + '\x01' + '\0' * 4)), 4)
+        self.assertEqual(compaction._checksum_size(_event(15, description + '\x00' + '\0' * 4)), 0)
+
+class CompactorTest(unittest.TestCase):
+
+    def test_net_effect(self):
+        transactions = [[('write', [[_image(i, 'row%d' % (i))]])] for i in range(1, 6)]
+        for n in range(20):
+            i = n % 5 + 1
+            transactions.append([('update', [[_image(i, 'row%d' % (i), str(n - 5)), _image(i, 'row%d' % (i), str(n))]])])
+        transactions.append([('delete', [[_image(2, 'row2', '16')]])])
+        transactions.append([('write', [[_image(9, 'gone')]])])
+        transactions.append([('delete', [[_image(9, 'gone')]])])
+        # the first images of the updates are those the writes left
+        for n in range(5):
+            transactions[5 + n][0][1][0][0] = _image(n + 1, 'row%d' % (n + 1))
+
+        data = _log(transactions)
+        compacted, stats = _compact(data)
+        self.assertEqual(_replay(compacted), _replay(data))
+        self.assertEqual(stats['transactions_in'], len(transactions))
+        self.assertEqual(stats['transactions_out'], 1)
+        self.assertEqual(stats['rows_out'], 4)
+        self.assertTrue(len(compacted) < len(data))
+
+    def test_windows(self):
+        transactions = [[('write', [[_image(1, 'a')]])]]
+        for n in range(9):
+            transactions.append([('update', [[_image(1, 'a' * (n + 1)), _image(1, 'a' * (n + 2))]])])
+        data = _log(transactions)
+        compacted, stats = _compact(data, window=3)
+        self.assertEqual(_replay(compacted), set([_image(1, 'a' * 10)]))
+        self.assertEqual(stats['transactions_out'], 4)
+
+    def test_tables_not_named_pass_through(self):
+        data = _log([[('write', [[_image(1, 'a')]])], [('update', [[_image(1, 'a'), _image(1, 'b')]])]])
+        for tables in ((), ('other.*',)):
+            compacted, stats = _compact(data, tables=tables)
+            self.assertEqual(compacted, data)
+            self.assertEqual(stats['rows_in'], 0)
+
+    def test_statements_close_the_window(self):
+        data = _log([[('write', [[_image(1, 'a')]])]])
+        data += _query('ALTER TABLE t ADD COLUMN x int')
+        data += _log([[('update', [[_image(1, 'a'), _image(1, 'b')]])]])[4:]
+        compacted, stats = _compact(data)
+        self.assertEqual(stats['transactions_out'], 3)
+        # the insert stays in front of the statement, the update behind it
+        self.assertEqual(_replay(compacted[:compacted.index('ALTER TABLE')]), set([_image(1, 'a')]))
+        self.assertEqual(_replay(compacted), set([_image(1, 'b')]))
+
+    def test_rolled_back_transactions_pass_through(self):
+        committed = _log([[('write', [[_image(1, 'a')]])]])
+        rolled_back = _log([[('write', [[_image(2, 'b')]])]], 'ROLLBACK')[len(_log([])):]
+        data = committed + rolled_back
+        compacted, stats = _compact(data)
+        self.assertTrue(compacted.endswith(rolled_back))
+        self.assertEqual(stats['transactions_out'], 2)
+        # the window before it ends in the XID of the committed transaction
+        window = compacted[:-len(rolled_back)]
+        self.assertEqual(window[-EVENT_HEADER.size - 8:][4], chr(binlogdemux.XID_EVENT))
+        self.assertEqual(_replay(window), set([_image(1, 'a')]))
+
+    def test_commit_query_ends_a_transaction(self):
+        data = _log([[('write', [[_image(1, 'a')]])], [('update', [[_image(1, 'a'), _image(1, 'b')]])]], 'COMMIT')
+        compacted, stats = _compact(data)
+        self.assertEqual(stats['transactions_out'], 1)
+        self.assertEqual(_replay(compacted), set([_image(1, 'b')]))
+
+    def test_unknown_events_outside_a_transaction(self):
+        data = _log([]) + _event(40, '\0' * 8)
+        self.assertRaises(compaction.CompactionError, _compact, data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Tests of the multi-threaded gzip of compression.py and its 'PM' members.
+
+import os
+import sys
+import gzip
+import zlib
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import compression
+
+def _compress(data, block_size=1000):
+    out = StringIO.StringIO()
+    compression.compressor(6, 2, block_size)(StringIO.StringIO(data), out)
+    return out.getvalue()
+
+def _decompress(data):
+    out = StringIO.StringIO()
+    compression.decompressor(2)(StringIO.StringIO(data), out)
+    return out.getvalue()
+
+def _gzip(data):
+    out = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+class GzipTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for size in (0, 1, 999, 1000, 1001, 12345):
+            data = os.urandom(size / 2).encode('hex')[:size]
+            self.assertEqual(_decompress(_compress(data)), data)
+
+    def test_members_are_plain_gzip(self):
+        data = 'INSERT INTO t VALUES (1);\n' * 500
+        compressed = _compress(data)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(compressed)).read(), data)
+
+    def test_member_sizes(self):
+        data = 'x' * 2500
+        compressed = _compress(data)
+        members = list(compression._read_members(compression._Buffered(StringIO.StringIO(compressed))))
+        self.assertEqual(''.join(members), compressed)
+        self.assertEqual(''.join([compression.decompress_block(m) for m in members]), data)
+
+    def test_foreign_gzip(self):
+        data = 'SELECT 1;\n' * 1000
+        self.assertEqual(_decompress(_gzip(data)), data)
+        self.assertEqual(_decompress(_gzip(data) + _gzip(data)), data + data)
+
+    def test_truncated_at_a_member_boundary(self):
+        data = 'y' * 3000
+        members = list(compression._read_members(compression._Buffered(StringIO.StringIO(_compress(data)))))
+        self.assertEqual(len(members), 4)
+        for n in range(len(members)):
+            self.assertRaises(compression.CompressionError, _decompress, ''.join(members[:n]) or members[0][:10])
+        # concatenated streams end with the marker of the last one
+        self.assertEqual(_decompress(_compress(data) + _compress(data)), data + data)
+
+    def test_empty_artifact(self):
+        self.assertRaises(compression.CompressionError, _decompress, '')
+        self.assertEqual(_decompress(_compress('')), '')
+
+    def test_unmarked_members(self):
+        # streams from before the end marker
+        data = 'z' * 3000
+        members = [compression.compress_block((data[i:i + 1000], 6)) for i in range(0, len(data), 1000)]
+        self.assertEqual(_decompress(''.join(members)), data)
+
+    def test_truncated_foreign_gzip(self):
+        compressed = _gzip(os.urandom(5000))
+        for size in (len(compressed) - 1, len(compressed) - 8, len(compressed) / 2):
+            self.assertRaises((compression.CompressionError, zlib.error), _decompress, compressed[:size])
+
+    def test_corrupt_member(self):
+        member = compression.compress_block(('some data', 6))
+        bad_crc = member[:-8] + chr(ord(member[-8]) ^ 1) + member[-7:]
+        self.assertRaises(compression.CompressionError, compression.decompress_block, bad_crc)
+        bad_body = member[:22] + chr(ord(member[22]) ^ 0xff) + member[23:]
+        self.assertRaises((compression.CompressionError, zlib.error), compression.decompress_block, bad_body)
+
+if __name__ == '__main__':
+    unittest.main()
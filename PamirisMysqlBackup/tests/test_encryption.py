@@ -0,0 +1,81 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Tests of the chunked encryption of encryption.py. The data key is "wrapped"
+# with cat, so no gpg key is needed.
+
+import os
+import sys
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import encryption
+
+WRAP = ['cat']
+
+def _encrypt(data, chunk_size=1024, data_key=None):
+    out = StringIO.StringIO()
+    encryption.encryptor(WRAP, chunk_size, 2, data_key)(StringIO.StringIO(data), out)
+    return out.getvalue()
+
+def _decrypt(data):
+    out = StringIO.StringIO()
+    encryption.decryptor(WRAP, 2)(StringIO.StringIO(data), out)
+    return out.getvalue()
+
+def _xor(a, b):
+    return ''.join([chr(ord(x) ^ ord(y)) for x, y in zip(a, b)])
+
+class ChunkedEncryptionTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for size in (0, 1, 1023, 1024, 1025, 5000):
+            data = os.urandom(size)
+            self.assertEqual(_decrypt(_encrypt(data)), data)
+
+    def test_chunks_are_authenticated(self):
+        encrypted = _encrypt(os.urandom(3000))
+        for position in (len(encrypted) - 1, len(encrypted) - 2000):
+            tampered = encrypted[:position] + chr(ord(encrypted[position]) ^ 1) + encrypted[position + 1:]
+            self.assertRaises(encryption.EncryptionError, _decrypt, tampered)
+
+    def test_truncated_at_a_chunk_boundary(self):
+        encrypted = _encrypt(os.urandom(3000))
+        # the last chunk is 3000 - 2048 bytes and its tag
+        cut = encrypted[:len(encrypted) - (3000 - 2048) - encryption.TAG_SIZE]
+        self.assertRaises(encryption.EncryptionError, _decrypt, cut)
+
+    def test_files_sharing_a_data_key_share_no_keystream(self):
+        data_key = encryption.DataKey(WRAP)
+        first = os.urandom(4096)
+        second = os.urandom(4096)
+        one = _encrypt(first, data_key=data_key)
+        two = _encrypt(second, data_key=data_key)
+        start = len(one) - len(first) - 4 * encryption.TAG_SIZE
+        self.assertEqual(start, len(two) - len(second) - 4 * encryption.TAG_SIZE)
+        # with the same key and nonces the ciphertexts would xor to the plaintexts' xor
+        chunk = 1024
+        self.assertNotEqual(_xor(one[start:start + chunk], two[start:start + chunk]),
+                _xor(first[:chunk], second[:chunk]))
+        self.assertEqual(_decrypt(one), first)
+        self.assertEqual(_decrypt(two), second)
+        # and a chunk of one file doesn't authenticate in the other
+        swapped = one[:start] + two[start:start + chunk + encryption.TAG_SIZE] + \
+                one[start + chunk + encryption.TAG_SIZE:]
+        self.assertRaises(encryption.EncryptionError, _decrypt, swapped)
+
+    def test_random_access(self):
+        data = os.urandom(10000)
+        path = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'pmb_test_%d.enc' % (os.getpid()))
+        f = open(path, 'wb')
+        f.write(_encrypt(data))
+        f.close()
+        try:
+            reader = encryption.Reader(path, WRAP)
+            for offset, size in ((0, 1), (1000, 2000), (9999, 1), (3072, 1024)):
+                self.assertEqual(reader.read(offset, size), data[offset:offset + size])
+        finally:
+            os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()
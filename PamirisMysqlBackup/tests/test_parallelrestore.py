@@ -0,0 +1,113 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Tests of the splitting of a single stream dump and of the commits of the
+# parallel loader of parallelrestore.py.
+
+import os
+import sys
+import logging
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import parallelrestore
+
+logging.getLogger('PMB LOG').addHandler(logging.NullHandler())
+
+DUMP = '''/*!40101 SET NAMES utf8 */;
+/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;
+
+--
+-- Current Database: `shop`
+--
+
+CREATE DATABASE `shop`;
+
+USE `shop`;
+
+--
+-- Table structure for table `orders`
+--
+
+CREATE TABLE `orders` (
+  `id` int NOT NULL,
+  `customer` int NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `by_customer` (`customer`)
+);
+
+--
+-- Dumping data for table `orders`
+--
+
+LOCK TABLES `orders` WRITE;
+/*!40000 ALTER TABLE `orders` DISABLE KEYS */;
+INSERT INTO `orders` VALUES (1,1),(2,1);
+INSERT INTO `orders` VALUES (3,2);
+/*!40000 ALTER TABLE `orders` ENABLE KEYS */;
+UNLOCK TABLES;
+/*!50003 SET @saved_cs_client = @@character_set_client */ ;
+DELIMITER ;;
+/*!50003 CREATE*/ /*!50003 TRIGGER `audit` AFTER INSERT ON `orders` FOR EACH ROW BEGIN
+  INSERT INTO log VALUES (NEW.id);
+END */;;
+DELIMITER ;
+
+--
+-- Table structure for table `log`
+--
+
+CREATE TABLE `log` (
+  `id` int NOT NULL
+);
+
+--
+-- Dumping data for table `log`
+--
+
+INSERT INTO `log` VALUES (1);
+'''
+
+class SplitTest(unittest.TestCase):
+
+    def test_split(self):
+        pieces = []
+        statements = []
+        splitter = parallelrestore.DumpSplitter(pieces.append, lambda use, sql: statements.append((use, sql)))
+        splitter.split(StringIO.StringIO(DUMP))
+
+        # the schema of a table runs before its data, without its secondary keys
+        self.assertEqual(len(pieces), 2)
+        self.assertTrue('CREATE TABLE `orders`' in pieces[0] and 'by_customer' not in pieces[0])
+        self.assertTrue('CREATE TABLE `log`' in pieces[1])
+        self.assertEqual(splitter.alters, ['ALTER TABLE `shop`.`orders` ADD KEY `by_customer` (`customer`);\n'])
+        self.assertEqual(statements, [
+            ('USE `shop`;\n', 'INSERT INTO `orders` VALUES (1,1),(2,1);\n'),
+            ('USE `shop`;\n', 'INSERT INTO `orders` VALUES (3,2);\n'),
+            ('USE `shop`;\n', 'INSERT INTO `log` VALUES (1);\n'),
+        ])
+        self.assertEqual(len(splitter.preamble), 2)
+        post = ''.join(splitter.post)
+        self.assertTrue('TRIGGER `audit`' in post and post.startswith('USE `shop`;\n'))
+        self.assertFalse('TRIGGER' in ''.join(pieces))
+
+class CommitTest(unittest.TestCase):
+
+    def _write(self, blocks, every):
+        out = StringIO.StringIO()
+        writer = parallelrestore._CommittingWriter(out, every)
+        for block in blocks:
+            writer.write(block)
+        return out.getvalue()
+
+    def test_commit_every(self):
+        sql = 'INSERT INTO t VALUES (1);\n' * 5
+        self.assertEqual(self._write([sql], 2).count('COMMIT;\n'), 2)
+        self.assertTrue(self._write([sql], 2).startswith('INSERT INTO t VALUES (1);\n' * 2 + 'COMMIT;\n'))
+        # statement ends cut between two writes
+        for cut in range(len(sql)):
+            self.assertEqual(self._write([sql[:cut], sql[cut:]], 2), self._write([sql], 2))
+        self.assertEqual(self._write([sql], None), sql)
+
+if __name__ == '__main__':
+    unittest.main()
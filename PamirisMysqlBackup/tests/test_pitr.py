@@ -0,0 +1,70 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Tests of the stop filter of pitr.py on mysqlbinlog output.
+
+import os
+import sys
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pitr
+
+def _output(events):
+    """mysqlbinlog output of `events`, (offset, end position, text) of one log"""
+    lines = []
+    for n, (at, end, text) in enumerate(events):
+        kind = n == 0 and 'Start: binlog v 4, server v 5.7.30-log' or 'Query\tthread_id=1'
+        lines.append('# at %d\n#201018 10:00:%02d server id 1  end_log_pos %d CRC32 0x00000000 \t%s\n%s\n/*!*/;\n' %
+                (at, n, end, kind, text))
+    return 'DELIMITER /*!*/;\n' + ''.join(lines) + 'DELIMITER ;\n# End of log file\n'
+
+def _stop(output, position):
+    stop = pitr.StopFilter(stop_log='mysql-bin.000002', stop_position=position)
+    stop.start_logs(['mysql-bin.000002'])
+    out = StringIO.StringIO()
+    stop(StringIO.StringIO(output), out)
+    return out.getvalue(), stop.reached
+
+# the whole log, `# at` is the position in the server's log
+LOG = _output([(4, 123, 'START'), (123, 200, 'BEGIN'), (200, 300, 'INSERT 1'), (300, 400, 'INSERT 2'),
+        (400, 431, 'COMMIT'), (431, 478, 'ROTATE')])
+# the log split by database, the events from 200 to 400 went to another one
+SPLIT = _output([(4, 123, 'START'), (123, 200, 'BEGIN'), (200, 500, 'INSERT 3'), (300, 531, 'COMMIT')])
+
+class StopPositionTest(unittest.TestCase):
+
+    def test_event_starting_before_the_stop_position(self):
+        for position in (201, 250, 300):
+            out, reached = _stop(LOG, position)
+            self.assertTrue(reached)
+            self.assertTrue('INSERT 1' in out)
+            self.assertFalse('INSERT 2' in out)
+        out, reached = _stop(LOG, 200)
+        self.assertFalse('INSERT 1' in out)
+
+    def test_stop_position_past_the_log(self):
+        out, reached = _stop(LOG, 1000)
+        self.assertFalse(reached)
+        self.assertEqual(out, LOG)
+
+    def test_split_log(self):
+        # INSERT 3 starts at 400 in the server's log
+        out, reached = _stop(SPLIT, 450)
+        self.assertTrue('INSERT 3' in out)
+        self.assertFalse('COMMIT' in out)
+        for position in (250, 400):
+            out, reached = _stop(SPLIT, position)
+            self.assertTrue(reached)
+            self.assertTrue('BEGIN' in out)
+            self.assertFalse('INSERT 3' in out)
+            self.assertTrue(out.endswith(pitr._END))
+
+    def test_last_event_of_the_input(self):
+        out, reached = _stop(LOG, 450)
+        self.assertTrue(reached)
+        self.assertTrue('COMMIT' in out)
+        self.assertFalse('ROTATE' in out)
+
+if __name__ == '__main__':
+    unittest.main()
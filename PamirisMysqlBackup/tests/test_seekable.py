@@ -0,0 +1,96 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Tests of the sections a seekable backup of seekable.py cuts a dump into.
+
+import os
+import sys
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import seekable
+
+DUMP = '''-- MySQL dump 10.13
+/*!40101 SET NAMES utf8 */;
+
+--
+-- Current Database: `shop`
+--
+
+USE `shop`;
+
+--
+-- Table structure for table `orders`
+--
+
+CREATE TABLE `orders` (id int);
+
+--
+-- Dumping data for table `orders`
+--
+
+INSERT INTO `orders` VALUES (1),(2);
+
+--
+-- Temporary table structure for view `recent`
+--
+
+CREATE TABLE `recent` (id int);
+
+--
+-- Dumping events for database 'shop'
+--
+
+--
+-- Dumping routines for database 'shop'
+--
+
+CREATE PROCEDURE `purge`() DELETE FROM `orders`;
+
+--
+-- Final view structure for view `recent`
+--
+
+CREATE VIEW `recent` AS SELECT id FROM `orders`;
+/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
+/*!40101 SET NAMES @OLD_NAMES */;
+'''
+
+def _sections(dump, block_size=64):
+    index = seekable.new_index({})
+    splitter = seekable._Splitter(index, block_size)
+    blocks = list(splitter.blocks(StringIO.StringIO(dump)))
+    return index, blocks
+
+class SectionTest(unittest.TestCase):
+
+    def test_sections(self):
+        index, blocks = _sections(DUMP)
+        self.assertEqual(''.join(blocks), DUMP)
+        self.assertEqual([(s['kind'], s['database'], s['table']) for s in index['sections']], [
+            ('prelude', None, None),
+            ('database', 'shop', None),
+            ('schema', 'shop', 'orders'),
+            ('data', 'shop', 'orders'),
+            ('schema', 'shop', 'recent'),
+            ('events', 'shop', None),
+            ('routines', 'shop', None),
+            ('schema', 'shop', 'recent'),
+            ('trailer', None, None),
+        ])
+
+    def test_routines_are_not_restored_with_a_table(self):
+        index, blocks = _sections(DUMP)
+        parts = seekable.select(index, ['orders'])
+        restored = ''.join([isinstance(p, str) and p or blocks[p] for p in parts])
+        self.assertTrue('INSERT INTO `orders`' in restored)
+        self.assertFalse('PROCEDURE' in restored)
+        self.assertEqual([t['table'] for t in seekable.tables(index)], ['orders', 'recent'])
+
+    def test_quoted_names(self):
+        index, blocks = _sections('-- Table structure for table `a``b`\n-- Dumping routines for database \'x`y\'\n')
+        self.assertEqual([s['table'] for s in index['sections'] if s['kind'] == 'schema'], ['a`b'])
+        self.assertEqual([s['database'] for s in index['sections'] if s['kind'] == 'routines'], ['x`y'])
+
+if __name__ == '__main__':
+    unittest.main()
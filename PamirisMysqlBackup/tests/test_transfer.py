@@ -0,0 +1,51 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Tests of the resumable transfers of transfer.py, over the local transport.
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import transfer
+
+class TransferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'backup.sql.gz')
+        self.data = os.urandom(300000)
+        f = open(self.source, 'wb')
+        f.write(self.data)
+        f.close()
+        self.destination = os.path.join(self.directory, 'fetched')
+        self.transfer = transfer.Transfer(transfer.LocalTransport(), 3, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _fetch(self, sha256):
+        files = [{'source': self.source, 'path': 'backup.sql.gz', 'size': len(self.data), 'sha256': sha256}]
+        path = self.transfer.fetch(files, self.destination)[0]
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_fetch(self):
+        self.assertEqual(self._fetch(hashlib.sha256(self.data).hexdigest()), self.data)
+        self.assertRaises(transfer.TransferError, self._fetch, '0' * 64)
+
+    def test_stale_file_of_the_same_size(self):
+        os.makedirs(self.destination)
+        f = open(os.path.join(self.destination, 'backup.sql.gz'), 'wb')
+        f.write('\0' * len(self.data))
+        f.close()
+        self.assertEqual(self._fetch(hashlib.sha256(self.data).hexdigest()), self.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,279 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Throttling. A backup running at full speed on the database host competes
+# with the queries for the disks and the cpus. The throttle caps what the
+# stages of the pipelines may use, by the name the run report gives them
+# (mysqldump, compress, gpg, write...):
+#
+#   * a bandwidth cap limits the bytes a stage writes per second. a filter's
+#     writes are paced, a command's output passes through a pacing filter, and
+#     the pipe backpressure slows the command down to the cap. stages running
+#     several times at once (a parallel dump) share their cap.
+#   * a cpu cap limits a command to a share of a cpu, by stopping it with
+#     SIGSTOP whenever it used more than its share and continuing it once the
+#     share is back in line (the way cpulimit does).
+#
+# In adaptive mode a LoadMonitor samples the load of the server (threads
+# running, replication lag, disk utilization) and scales every cap down when
+# one of them is over its limit and back up when they are all fine again.
+
+import os
+import time
+import errno
+import signal
+import threading
+import logging
+
+logger = logging.getLogger("PMB LOG")
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+class TokenBucket(object):
+    """allows `rate` bytes per second on average, None for no limit"""
+
+    def __init__(self, rate=None, burst=1024 * 1024):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        self.lock.acquire()
+        try:
+            self._refill()
+            self.rate = rate
+        finally:
+            self.lock.release()
+
+    def _refill(self):
+        now = time.time()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, n):
+        """take `n` bytes, sleeping for as long as it takes to earn them"""
+        self.lock.acquire()
+        try:
+            if self.rate is None:
+                return
+            self._refill()
+            # the debt is paid by sleeping, the next caller waits for it too
+            self.tokens -= n
+            delay = -self.tokens / float(self.rate)
+        finally:
+            self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
+
+def _process_cpu(pid):
+    """cpu seconds used by the process `pid` so far"""
+    f = open('/proc/%d/stat' % (pid))
+    try:
+        # the command name may hold spaces, the fields after it don't
+        fields = f.read().rsplit(')', 1)[1].split()
+    finally:
+        f.close()
+    return (int(fields[11]) + int(fields[12])) / float(_CLOCK_TICKS)
+
+class _Watched(object):
+    def __init__(self, pid, share):
+        self.pid = pid
+        self.share = share
+        self.stopped = False
+        self.resume = None
+        self.mark_time = time.time()
+        self.mark_cpu = _process_cpu(pid)
+
+class CPULimiter(threading.Thread):
+    """keeps the processes it watches to their share of a cpu (0.5 is half of one)"""
+
+    def __init__(self, period=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.period = period
+        self.factor = 1.0
+        self.watched = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def watch(self, pid, share):
+        try:
+            watched = _Watched(pid, share)
+        except (IOError, IndexError, ValueError):
+            # gone already
+            return
+        self.lock.acquire()
+        try:
+            self.watched[pid] = watched
+        finally:
+            self.lock.release()
+
+    def unwatch(self, pid):
+        """stop watching `pid`, continuing it if it is stopped. call it before the process is reaped"""
+        self.lock.acquire()
+        try:
+            watched = self.watched.pop(pid, None)
+            if watched is not None and watched.stopped:
+                self._signal(watched, signal.SIGCONT)
+        finally:
+            self.lock.release()
+
+    def _signal(self, watched, signum):
+        try:
+            os.kill(watched.pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def run(self):
+        while not self.done.is_set():
+            self.lock.acquire()
+            try:
+                for watched in self.watched.values():
+                    self._limit(watched)
+            finally:
+                self.lock.release()
+            self.done.wait(self.period / 5)
+
+    def _limit(self, watched):
+        now = time.time()
+        if watched.stopped:
+            if now >= watched.resume:
+                self._signal(watched, signal.SIGCONT)
+                watched.stopped = False
+                watched.mark_time = now
+            return
+        if now - watched.mark_time < self.period:
+            return
+        try:
+            cpu = _process_cpu(watched.pid)
+        except (IOError, IndexError, ValueError):
+            return
+        share = watched.share * self.factor
+        # stopped for as long as it takes to bring its average down to its share
+        excess = (cpu - watched.mark_cpu) - share * (now - watched.mark_time)
+        watched.mark_time, watched.mark_cpu = now, cpu
+        if excess > 0:
+            self._signal(watched, signal.SIGSTOP)
+            watched.stopped = True
+            watched.resume = now + excess / share
+
+    def close(self):
+        """stop limiting, every watched process is continued"""
+        self.done.set()
+        self.lock.acquire()
+        try:
+            for watched in self.watched.values():
+                if watched.stopped:
+                    self._signal(watched, signal.SIGCONT)
+            self.watched = {}
+        finally:
+            self.lock.release()
+
+class Throttle(object):
+    """the caps of the stages: `rates` in bytes per second and `shares` of a cpu, by stage name
+
+    everything is scaled by `factor`, which adaptive mode lowers under load.
+    """
+
+    def __init__(self, rates=None, shares=None):
+        self.rates = rates or {}
+        self.shares = shares or {}
+        self.factor = 1.0
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.limiter = None
+        if self.shares:
+            self.limiter = CPULimiter()
+            self.limiter.start()
+
+    def bucket(self, name):
+        """the bucket the output of the stage `name` goes through, None when it isn't capped"""
+        if name not in self.rates:
+            return None
+        self.lock.acquire()
+        try:
+            if name not in self.buckets:
+                rate = self.rates[name] * self.factor
+                # a quarter second of burst, enough to not pace every small write
+                self.buckets[name] = TokenBucket(rate, max(65536, int(rate / 4)))
+            return self.buckets[name]
+        finally:
+            self.lock.release()
+
+    def watch(self, name, pid):
+        """the command of the stage `name` started as `pid`"""
+        if self.limiter is not None and name in self.shares:
+            self.limiter.watch(pid, self.shares[name])
+
+    def unwatch(self, pid):
+        """the command `pid` exited, it is about to be reaped"""
+        if self.limiter is not None:
+            self.limiter.unwatch(pid)
+
+    def set_factor(self, factor):
+        self.lock.acquire()
+        try:
+            self.factor = factor
+            for name, bucket in self.buckets.items():
+                bucket.set_rate(self.rates[name] * factor)
+        finally:
+            self.lock.release()
+        if self.limiter is not None:
+            self.limiter.factor = factor
+
+    def close(self):
+        if self.limiter is not None:
+            self.limiter.close()
+
+class LoadMonitor(threading.Thread):
+    """adapts the `throttle` to the load of the server every `interval` seconds
+
+    `probes` are (name, func, limit): func() returns the current value, or
+    None when it isn't known, and the server is overloaded while it is above
+    the limit. caps are halved under load, down to `min_factor` of their
+    configured value, and raised by a tenth every quiet interval.
+    """
+
+    def __init__(self, throttle, probes, interval=5, min_factor=0.05):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.throttle = throttle
+        self.probes = probes
+        self.interval = interval
+        self.min_factor = min_factor
+        self.done = threading.Event()
+
+    def overloaded(self):
+        """the probes over their limits, as "name value/limit" strings"""
+        over = []
+        for name, func, limit in self.probes:
+            try:
+                value = func()
+            except Exception, e:
+                logger.warn('Could not sample %s: %s' % (name, e))
+                continue
+            if value is not None and value > limit:
+                over.append('%s %s/%s' % (name, value, limit))
+        return over
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            over = self.overloaded()
+            factor = self.throttle.factor
+            if over:
+                factor = max(self.min_factor, factor / 2)
+            else:
+                factor = min(1.0, factor + 0.1)
+            if factor != self.throttle.factor:
+                if over:
+                    logger.info('Server under load (%s), slowing the backup down to %d%%' %
+                            (', '.join(over), factor * 100))
+                else:
+                    logger.info('Server load is back to normal, speeding the backup up to %d%%' % (factor * 100))
+                self.throttle.set_factor(factor)
+
+    def stop(self):
+        self.done.set()
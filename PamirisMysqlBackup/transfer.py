@@ -0,0 +1,310 @@
+# Author: Kyle Terry (Pamiric Inc)
+#
+# Transfers for fetch. Files are cut into parts of `part_size` bytes which are
+# copied by a pool of threads, so several files and several ranges of a big
+# file move at the same time. Every part is written straight to its offset in
+# `<file>.part` and the parts that are done are remembered in
+# `<file>.part.done`, so an interrupted fetch carries on where it stopped. A
+# file only gets its real name once its sha256 matches the backup index.
+#
+# Where the files come from is up to the transport. SSHTransport reads ranges
+# of the remote files over a shared ssh connection, LocalTransport reads them from the local
+# filesystem, a mounted share or a loopback copy for testing.
+
+import os
+import json
+import pipes
+import Queue
+import posixpath
+import tempfile
+import threading
+import subprocess
+import logging
+
+import remote
+from pipeline import BLOCK_SIZE, file_digest
+
+logger = logging.getLogger("PMB LOG")
+
+class TransferError(Exception):
+    """raised when files can not be transferred"""
+
+class Transport(object):
+    """where fetch copies the backups from"""
+
+    def list_files(self, path):
+        """(path, size) of the file `path` or of every file under the directory `path`
+
+        the paths are relative to the directory holding `path`.
+        """
+        raise NotImplementedError
+
+    def read_file(self, path):
+        """the contents of the small file `path`"""
+        raise NotImplementedError
+
+    def read_range(self, path, offset, length, writer):
+        """write `length` bytes of the file `path` from `offset` on to `writer`
+
+        returns the number of bytes written.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class LocalTransport(Transport):
+    """files on the local filesystem"""
+
+    def list_files(self, path):
+        if not os.path.exists(path):
+            raise TransferError('%s does not exist' % (path))
+        parent = os.path.dirname(path.rstrip('/'))
+        if not os.path.isdir(path):
+            return [(os.path.basename(path), os.path.getsize(path))]
+        files = []
+        for root, dirs, names in os.walk(path):
+            for name in names:
+                f = os.path.join(root, name)
+                files.append((os.path.relpath(f, parent), os.path.getsize(f)))
+        return sorted(files)
+
+    def read_file(self, path):
+        try:
+            f = open(path, 'rb')
+        except IOError, e:
+            raise TransferError(str(e))
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def read_range(self, path, offset, length, writer):
+        f = open(path, 'rb')
+        try:
+            f.seek(offset)
+            return _copy_range(f, writer, length)
+        finally:
+            f.close()
+
+class SSHTransport(Transport):
+    """files on another host, read over the connection of a remote.RemoteSession"""
+
+    def __init__(self, session):
+        self.session = session
+
+    def close(self):
+        self.session.close()
+
+    def _run(self, command, stdout=subprocess.PIPE):
+        stderr = tempfile.TemporaryFile()
+        process = subprocess.Popen(self.session.args(command),
+                stdout=stdout,
+                stderr=stderr,
+                close_fds=True)
+        return process, stderr
+
+    def _wait(self, process, stderr, command):
+        returncode = process.wait()
+        stderr.seek(0)
+        output = stderr.read().strip()
+        stderr.close()
+        if returncode != 0:
+            raise TransferError('ssh %s "%s" exited with %d: %s' %
+                    (self.session.connection_string, command, returncode, output))
+
+    def list_files(self, path):
+        command = 'find %s -type f -printf "%%p\\t%%s\\n"' % (pipes.quote(path.rstrip('/')))
+        process, stderr = self._run(command)
+        out = process.stdout.read()
+        self._wait(process, stderr, command)
+
+        parent = posixpath.dirname(path.rstrip('/'))
+        files = []
+        for line in out.splitlines():
+            name, size = line.rsplit('\t', 1)
+            files.append((posixpath.relpath(name, parent), int(size)))
+        return sorted(files)
+
+    def read_file(self, path):
+        try:
+            return self.session.read(path)
+        except remote.RemoteError, e:
+            raise TransferError(str(e))
+
+    def read_range(self, path, offset, length, writer):
+        command = 'tail -c +%d %s | head -c %d' % (offset + 1, pipes.quote(path), length)
+        process, stderr = self._run(command)
+        try:
+            copied = _copy_range(process.stdout, writer, length)
+        finally:
+            process.stdout.close()
+        self._wait(process, stderr, command)
+        return copied
+
+def _copy_range(reader, writer, length):
+    copied = 0
+    while copied < length:
+        block = reader.read(min(BLOCK_SIZE, length - copied))
+        if not block:
+            break
+        writer.write(block)
+        copied += len(block)
+    return copied
+
+class _TransferFile(object):
+    """one file being transferred and the parts of it that are done"""
+
+    def __init__(self, source, target, size, sha256, part_size):
+        self.source = source
+        self.target = target
+        self.size = size
+        self.sha256 = sha256
+        self.partial = target + '.part'
+        self.state = target + '.part.done'
+        self.offsets = range(0, max(size, 1), part_size)
+        self.part_size = part_size
+        self.done = set()
+        self.lock = threading.Lock()
+        self.completed = None
+
+    def complete(self):
+        """True when an earlier fetch got the whole file already
+
+        a file of the right size whose sha256 doesn't match the index is
+        stale or corrupt, it is removed and copied again.
+        """
+        if self.completed is None:
+            self.completed = os.path.exists(self.target) and os.path.getsize(self.target) == self.size
+            if self.completed and self.sha256 is not None and file_digest(self.target) != self.sha256:
+                logger.warn('%s does not match the index, copying it again' % (self.target))
+                os.remove(self.target)
+                self.completed = False
+        return self.completed
+
+    def prepare(self):
+        """open (or pick up) the partial file, returns the parts still to copy"""
+        if not os.path.isdir(os.path.dirname(self.target)):
+            os.makedirs(os.path.dirname(self.target))
+
+        if os.path.exists(self.partial) and os.path.getsize(self.partial) == self.size:
+            try:
+                f = open(self.state)
+                self.done = set(json.load(f)) & set(self.offsets)
+                f.close()
+            except (IOError, ValueError):
+                self.done = set()
+        else:
+            f = open(self.partial, 'wb')
+            f.truncate(self.size)
+            f.close()
+            self.done = set()
+
+        if self.done:
+            logger.info('Resuming %s, %d of %d parts are done' %
+                    (os.path.basename(self.target), len(self.done), len(self.offsets)))
+        return [o for o in self.offsets if o not in self.done]
+
+    def copy_part(self, transport, offset):
+        length = min(self.part_size, self.size - offset)
+        f = open(self.partial, 'r+b')
+        try:
+            f.seek(offset)
+            copied = transport.read_range(self.source, offset, length, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if copied != length:
+            raise TransferError('%s: got %d bytes at %d instead of %d' %
+                    (self.source, copied, offset, length))
+
+        self.lock.acquire()
+        try:
+            self.done.add(offset)
+            f = open(self.state + '.partial', 'w')
+            json.dump(sorted(self.done), f)
+            f.close()
+            os.rename(self.state + '.partial', self.state)
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        """verify the copied file and give it its real name"""
+        if self.sha256 is not None:
+            digest = file_digest(self.partial)
+            if digest != self.sha256:
+                os.remove(self.partial)
+                if os.path.exists(self.state):
+                    os.remove(self.state)
+                raise TransferError('%s: sha256 %s does not match the index (%s)' %
+                        (self.target, digest, self.sha256))
+        os.rename(self.partial, self.target)
+        if os.path.exists(self.state):
+            os.remove(self.state)
+
+class Transfer(object):
+    """copy files with `workers` threads through `transport`
+
+    files bigger than `part_size` are copied in ranges at the same time.
+    """
+
+    def __init__(self, transport, workers=4, part_size=64 * 1024 * 1024):
+        self.transport = transport
+        self.workers = max(1, workers)
+        self.part_size = max(BLOCK_SIZE, part_size)
+
+    def fetch(self, files, destination):
+        """copy `files` into the directory `destination`
+
+        `files` are dicts with the `source` path, the `path` relative to
+        `destination`, the `size` and the `sha256` to verify (or None).
+        returns the local paths.
+        """
+        transfers = []
+        jobs = Queue.Queue()
+        for f in files:
+            t = _TransferFile(f['source'], os.path.join(destination, f['path']),
+                    f['size'], f.get('sha256'), self.part_size)
+            transfers.append(t)
+            if t.complete():
+                logger.info('%s is already here' % (f['path']))
+                continue
+            for offset in t.prepare():
+                jobs.put((t, offset))
+
+        errors = []
+        def work():
+            while not errors:
+                try:
+                    t, offset = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    t.copy_part(self.transport, offset)
+                except Exception, e:
+                    errors.append(str(e))
+
+        threads = [threading.Thread(target=work) for i in range(min(self.workers, jobs.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise TransferError('; '.join(errors))
+
+        for t in transfers:
+            if t.complete():
+                continue
+            try:
+                t.finish()
+            except TransferError, e:
+                errors.append(str(e))
+                continue
+            logger.info('Transferred %s (%d bytes)' % (os.path.basename(t.target), t.size))
+
+        if errors:
+            raise TransferError('; '.join(errors))
+        return [t.target for t in transfers]